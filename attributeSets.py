@@ -7,7 +7,11 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
+import time
+import numpy
 import skimUtils
+import skimMetrics
+import skimProfile
 from os.path import basename
 from sys import exit
 
@@ -83,6 +87,7 @@ class AttributeSets(object):
 	self.imageHeader  = {}
 	self.dataHeader   = {}
 	self.coordHeader  = {}
+	self.linearHeader = {}
 	self.sourceHeader = {}
 	self.processhistHeader = {}
 
@@ -136,7 +141,18 @@ class AttributeSets(object):
 			     "COORDINATE_TYPES",
 			     ]
 
-	self.dataSetList = ["GROUTYPE",
+	self.linearSetList = ["GROUPTYPE",
+			      "COORDINATE_TYPE",
+			      "NOF_AXES",
+			      "AXIS_NAMES",
+			      "AXIS_UNITS",
+			      "REFERENCE_VALUE",
+			      "REFERENCE_PIXEL",
+			      "INCREMENT",
+			      "PC",
+			      ]
+
+	self.dataSetList = ["GROUPTYPE",
 			    "DATASET",
 			    "DATASETNAME",
 			    "WCSINFO",
@@ -150,13 +166,15 @@ class AttributeSets(object):
 	self.processhistSetList = ["GROUPTYPE"]
 
 
-    def initHeader(self, groupType, obs=None, nimages=None):
+    def initHeader(self, groupType, obs=None, nimages=None, wcs=None):
 	"""Populate a particular attribute set for a passed groupType
 
 	where,
 
 	obs:           the observation name,
 	nimages:       number of subband images in obs.
+	wcs:           the world coordinates of the image, for 'Coordinates' and
+		       'LinearCoord', see fitsHandlers.wcsKeywords().
 	groupType:     the LOFAR defined group whose attributes are to be populated.
 
 	In a LOFAR Sky Image, this string value will be one of,
@@ -168,6 +186,7 @@ class AttributeSets(object):
 	'Source'
 	'ProcessHist'
 	'Coordinates'
+	'LinearCoord'
 
 	See LOFAR-USG-ICD-004, Table 2: LOFAR Group Type Listing, for further details.
 	"""
@@ -212,9 +231,18 @@ class AttributeSets(object):
 	    self.coordHeader["NOF_COORDINATES"]    = None
 	    self.coordHeader["NOF_AXES"]           = 4
 	    self.coordHeader["COORDINATE_TYPES"]   = None
+	    if wcs:
+		self.coordHeader.update(coordOverrides(wcs))
+
+	elif groupType == 'LinearCoord':
+	    self.linearHeader.clear()
+	    self.linearHeader["GROUPTYPE"]       = 'LinearCoord'
+	    self.linearHeader["COORDINATE_TYPE"] = 'Linear'
+	    if wcs:
+		self.linearHeader.update(linearOverrides(wcs))
 
 	elif groupType == 'skyData':
-	    self.dataHeader["GROUTYPE"]    = 'skyData'
+	    self.dataHeader["GROUPTYPE"]   = 'skyData'
 	    self.dataHeader["DATASET"]     = 'true'
 	    self.dataHeader["DATASETNAME"] = ''
 	    self.dataHeader["WCSINFO"]     = '../Coordinates'
@@ -230,7 +258,8 @@ class AttributeSets(object):
 	else:
 	    msg="\n!Fatal Error: Passed groupType, "+groupType+", undefined.\n\n" + \
 		 "Permissable values of groupType:\n" + \
-		 "Root, Syslog, Image, Coordinates, skyData, Source, ProcessHist\n" + \
+		 "Root, Syslog, Image, Coordinates, LinearCoord, skyData, Source,\n" + \
+		 "ProcessHist\n" + \
 		 "See Document LOFAR-USG-ICD-004 for details.\n"
 	    exit(msg)
 
@@ -282,6 +311,14 @@ class AttributeSets(object):
 		else:
 		    attributeSetList.append((key,''))
 
+	elif group == 'LinearCoord':
+	    headKeys = self.linearHeader.keys()
+	    for key in self.linearSetList:
+		if key in headKeys:
+		    attributeSetList.append((key, self.linearHeader[key]))
+		else:
+		    attributeSetList.append((key,''))
+
 	elif group == 'skyData':
 	    headKeys = self.dataHeader.keys()
 	    for key in self.dataSetList:
@@ -312,3 +349,90 @@ class AttributeSets(object):
 
 	return attributeSetList
 
+
+#----------------------------------------------------------------------------#
+# Compiled attribute schemas.
+#
+# The attribute set of each group type but Root is the same for every
+# subband but for a few fields.  It is compiled once per process, by
+# AttributeSets, into an immutable ordered schema, and groupAttributes()
+# overrides only the per-subband fields, eg.
+#
+# writeAttributes(datasetHook, groupAttributes('skyData', DATASETNAME=name))
+#----------------------------------------------------------------------------#
+
+_schemas = {}
+
+def schema(groupType):
+    """Returns the compiled schema of groupType: the ordered tuple of its
+    (key, default value) pairs.  Root, whose attributes depend on the
+    observation, has no schema; use AttributeSets.initHeader('Root', ...).
+    """
+    if groupType not in _schemas:
+	attributes = AttributeSets()
+	attributes.initHeader(groupType)
+	_schemas[groupType] = tuple(attributes.attributeSet(groupType))
+    return _schemas[groupType]
+
+
+def groupAttributes(groupType, **overrides):
+    """Returns the ordered (key, value) attribute list of groupType, from its
+    schema, with the given fields overridden.  ValueError for a field that
+    is not in the schema.
+    """
+    if not overrides:
+	return schema(groupType)
+    attrList = [(key, overrides.pop(key, value)) for key, value in schema(groupType)]
+    if overrides:
+	raise ValueError("Not "+groupType+" attributes: "+", ".join(sorted(overrides)))
+    return attrList
+
+
+@skimProfile.profiled('attributes')
+def writeAttributes(node, attrList):
+    """Write an attribute list, as from groupAttributes(), to the HDF5 node,
+    in one pass over its attribute set.  Timed, see skimMetrics.
+    """
+    start = time.time()
+    attrs = node._v_attrs
+    for key, value in attrList:
+	setattr(attrs, key, value)
+    skimMetrics.add('attributes', time.time() - start)
+    return
+
+
+def coordOverrides(wcs):
+    """Returns the Coordinates attributes given by the world coordinates wcs
+    of an image, see fitsHandlers.wcsKeywords().
+    """
+    overrides = {"NOF_COORDINATES":  len(wcs['TYPES']),
+		 "NOF_AXES":         wcs['NAXIS'],
+		 "COORDINATE_TYPES": numpy.array(wcs['TYPES']),
+		 }
+    if wcs['EQUINOX'] is not None:
+	equinox = float(wcs['EQUINOX'])
+	if equinox == 1950.0:
+	    overrides["EQUINOX"] = 'B1950'
+	else:
+	    overrides["EQUINOX"] = 'J%g' % equinox
+    if wcs['RADESYS']:
+	overrides["SYSTEM_RADEC"] = wcs['RADESYS']
+    if wcs['OBSGEO'] is not None:
+	overrides["REF_LOCATION_VALUE"] = numpy.array(wcs['OBSGEO'])
+	overrides["REF_LOCATION_UNIT"]  = 'm'
+	overrides["REF_LOCATION_FRAME"] = 'ITRF'
+    return overrides
+
+
+def linearOverrides(wcs):
+    """Returns the LinearCoord attributes given by the world coordinates wcs
+    of an image, see fitsHandlers.wcsKeywords().
+    """
+    return {"NOF_AXES":        wcs['NAXIS'],
+	    "AXIS_NAMES":      numpy.array(wcs['CTYPE']),
+	    "AXIS_UNITS":      numpy.array(wcs['CUNIT']),
+	    "REFERENCE_VALUE": numpy.array(wcs['CRVAL']),
+	    "REFERENCE_PIXEL": numpy.array(wcs['CRPIX']),
+	    "INCREMENT":       numpy.array(wcs['CDELT']),
+	    "PC":              numpy.array(wcs['PC']),
+	    }
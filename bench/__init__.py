@@ -0,0 +1,20 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Skim build benchmarks.
+#
+# synth:   generator of synthetic pipeline results trees,
+#          OBS/results/<yyyy-mm-ddThh:mm:ss>/SBn.fits
+# run:     times skim.run() and skimAll.buildSkim() on such a tree, end to end
+#          and by stage, and saves the results as JSON to compare between
+#          versions on the one machine.
+#
+# Run from the top of the package, eg.
+#
+# % python -m bench.run --nbands=32 --size=2048 --out=before.json
+# % python -m bench.run --nbands=32 --size=2048 --compare=before.json
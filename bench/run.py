@@ -0,0 +1,284 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Benchmark runner.
+#
+# Builds the skim file of a synthetic results tree (see bench.synth) with
+# each builder, skim.run() and skimAll.buildSkim(), 'repeat' times, every
+# build in a fresh process so that its peak RSS is its own and no header or
+# page cache of this process carries over.  Reported per builder: wall time
+# (best and median), input MB/s and files/s over the best time, the median
+# seconds of each skimMetrics stage, and the peak RSS, of the builder or any
+# of its reader processes.
+#
+# Results are written as JSON, with the machine, library versions and git
+# revision, and may be compared with those of an earlier run, eg. of
+# another version, on the same machine.
+
+import sys
+import os
+import time
+import json
+import getopt
+import logging
+import platform
+import resource
+import subprocess
+import multiprocessing
+from   os.path import abspath, dirname, getsize, join
+import skimUtils
+import skimMetrics
+from   bench import synth
+
+BUILDERS = ('skim', 'skimAll')
+STAGES   = ('discover', 'read', 'write', 'attributes')
+REPEAT   = 3
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: python -m bench.run [options]\n\n' + \
+	'\tTime skim builds of a synthetic results tree.\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--dir=DIR         where the synthetic tree is made (default ./benchdata)\n' + \
+	'\t--nbands=N        subband images (default 8)\n' + \
+	'\t--size=N          image side in pixels (default 512)\n' + \
+	'\t--planes=N        Stokes planes per image (default 1)\n' + \
+	'\t--ave             add an average image\n' + \
+	'\t--seed=N          pixel generator seed (default 0)\n' + \
+	'\t--builders=B,...  skim, skimAll or both (default)\n' + \
+	'\t--repeat=N        builds per builder (default '+str(REPEAT)+')\n' + \
+	'\t--out=FILE        write the results as JSON to FILE\n' + \
+	'\t--compare=FILE    compare with the results of an earlier --out\n\n' + \
+	'\tFurther optional keyword arguments, passed to every build, as for\n' + \
+	'\tskim:\n\n' + \
+	skimUtils.BUILD_USAGE
+    return useBurp
+
+
+def _build(results, builder, obs, runTimeLabel, buildOpts):
+    """Build process.  Builds the skim file of obs with builder, and puts
+    back the dictionary of its seconds, stages, rssMB and error.
+    """
+    devNull    = open(os.devnull, 'w')
+    sys.stdout = devNull
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+    skyName = skimUtils.mkOutFileName(obs, runTimeLabel)
+    if os.path.exists(skyName):
+	os.remove(skyName)
+    skimMetrics.reset()
+    error = None
+    start = time.time()
+    try:
+	if builder == 'skim':
+	    import skim
+	    skim.run(obs, runTimeLabel, logging.getLogger(), **buildOpts)
+	else:
+	    import skimAll
+	    skimAll.buildSkim(obs, runTimeLabel, **buildOpts)
+    except Exception, err:
+	error = err.__class__.__name__ + ": " + str(err)
+    seconds = time.time() - start
+    # ru_maxrss is in kB on Linux.
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put({'seconds': seconds,
+		 'stages':  skimMetrics.snapshot(),
+		 'rssMB':   rss / 1024.0,
+		 'error':   error})
+    return
+
+
+def build(builder, obs, runTimeLabel, **buildOpts):
+    """Time one build by builder in a process of its own.  Returns the
+    result dictionary of _build().
+    """
+    results = multiprocessing.Queue()
+    proc    = multiprocessing.Process(target=_build,
+				      args=(results, builder, obs, runTimeLabel,
+					    buildOpts))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def runCase(builder, obs, runTimeLabel, repeat=REPEAT, **buildOpts):
+    """Time repeat builds by builder, and return their summary dictionary,
+    with keys
+
+    builder, builds, best, median, inputMB, files, MBs, filesPerSec,
+    stages, rssMB, error,
+
+    MBs and filesPerSec being over the best time, and stages the median
+    seconds of each stage.
+    """
+    resultsPath = skimUtils.makePipeResultsPath(obs, runTimeLabel)
+    aveImage, imageList = skimUtils.mkFitsImageList(resultsPath)
+    images  = ([aveImage] if aveImage else []) + imageList
+    inputMB = sum([getsize(join(resultsPath, image)) for image in images]) / 1e6
+    builds  = [build(builder, obs, runTimeLabel, **buildOpts) for n in range(repeat)]
+    errors  = [result['error'] for result in builds if result['error']]
+    times   = [result['seconds'] for result in builds]
+    best    = min(times)
+    stages  = {}
+    for stage in STAGES:
+	stages[stage] = _median([result['stages'].get(stage, {}).get('seconds', 0.0)
+				 for result in builds])
+    return {'builder':     builder,
+	    'builds':      times,
+	    'best':        best,
+	    'median':      _median(times),
+	    'inputMB':     inputMB,
+	    'files':       len(images),
+	    'MBs':         inputMB / best,
+	    'filesPerSec': len(images) / best,
+	    'stages':      stages,
+	    'rssMB':       max([result['rssMB'] for result in builds]),
+	    'error':       errors and errors[0] or None,
+	    }
+
+
+def environment():
+    """The machine, library versions and git revision of a benchmark run."""
+    import numpy
+    import tables
+    try:
+	revision = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+				    cwd=dirname(abspath(skimUtils.__file__)),
+				    stdout=subprocess.PIPE,
+				    stderr=open(os.devnull, 'w')).communicate()[0].strip()
+    except OSError:
+	revision = ''
+    return {'host':     platform.node(),
+	    'machine':  platform.machine(),
+	    'cpus':     multiprocessing.cpu_count(),
+	    'python':   platform.python_version(),
+	    'numpy':    numpy.__version__,
+	    'tables':   tables.__version__,
+	    'revision': revision or None,
+	    'date':     time.strftime("%Y-%m-%dT%H:%M:%S"),
+	    }
+
+
+def report(cases):
+    print
+    print "%-8s %9s %9s %9s %9s %8s" % ("builder", "best s", "median s",
+					"MB/s", "files/s", "RSS MB"),
+    print " ".join(["%10s" % stage for stage in STAGES])
+    for case in cases:
+	print "%-8s %9.3f %9.3f %9.1f %9.1f %8.1f" % (case['builder'], case['best'],
+						      case['median'], case['MBs'],
+						      case['filesPerSec'], case['rssMB']),
+	print " ".join(["%10.3f" % case['stages'][stage] for stage in STAGES])
+	if case['error']:
+	    print "\t" + case['error']
+    print
+    return
+
+
+def compare(old, new):
+    """Print the best time of each builder of new against that of old."""
+    print "Against", old['environment'].get('revision'), "of", old['environment']['date']
+    if old['environment'].get('host') != new['environment'].get('host'):
+	print "(measured on another machine, " + str(old['environment'].get('host')) + ")"
+    if old['settings'] != new['settings'] or old['buildOpts'] != new['buildOpts']:
+	print "(with other settings or build options)"
+    oldCases = dict([(case['builder'], case) for case in old['cases']])
+    for case in new['cases']:
+	before = oldCases.get(case['builder'])
+	if before is None:
+	    continue
+	print "%-8s %9.3f s -> %9.3f s   x %.2f" % (case['builder'], before['best'],
+						   case['best'],
+						   before['best'] / case['best'])
+    print
+    return
+
+
+def handleCLargs(args):
+    """Parse the command line, args being sys.argv.  Returns a 3-tuple,
+
+    (benchOpts, synthOpts, buildOpts),
+
+    dictionaries of the runner's, the generator's (see synth.makeRun()) and
+    the builds' keyword arguments.
+    """
+    mod = "bench.run"
+    long_options = ['help', 'dir=', 'nbands=', 'size=', 'planes=', 'ave',
+		    'seed=', 'builders=', 'repeat=', 'out=', 'compare='
+		    ] + skimUtils.BUILD_OPTIONS
+    try:
+	opts, arg = getopt.getopt(args[1:], '', long_options)
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if arg:
+	sys.exit(usage(mod))
+
+    benchOpts = {'dir': 'benchdata', 'builders': BUILDERS, 'repeat': REPEAT,
+		 'out': None, 'compare': None}
+    synthOpts = {}
+    buildOpts = {}
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--nbands", "--size", "--planes", "--seed"):
+	    synthOpts[o[2:]] = skimUtils.intArg(o, a)
+	elif o in ("--ave",):
+	    synthOpts['average'] = True
+	elif o in ("--repeat",):
+	    benchOpts['repeat'] = max(1, skimUtils.intArg(o, a))
+	elif o in ("--builders",):
+	    builders = tuple(a.split(','))
+	    if [builder for builder in builders if builder not in BUILDERS]:
+		sys.exit("\n\n\tError: --builders must be from "+", ".join(BUILDERS)+".\n")
+	    benchOpts['builders'] = builders
+	elif o in ("--dir", "--out", "--compare"):
+	    benchOpts[o[2:]] = a
+	elif skimUtils.buildOption(o, a, buildOpts):
+	    pass
+	else:
+	    sys.exit(usage(mod))
+    return benchOpts, synthOpts, buildOpts
+
+
+if __name__ == '__main__':
+    benchOpts, synthOpts, buildOpts = handleCLargs(sys.argv)
+    old = None
+    if benchOpts['compare']:
+	fob = open(benchOpts['compare'])
+	try:
+	    old = json.load(fob)
+	finally:
+	    fob.close()
+    obs, runTimeLabel, settings = synth.makeRun(benchOpts['dir'], **synthOpts)
+    cases = []
+    for builder in benchOpts['builders']:
+	cases.append(runCase(builder, obs, runTimeLabel, benchOpts['repeat'],
+			     **buildOpts))
+    report(cases)
+    new = {'environment': environment(),
+	   'settings':    settings,
+	   'buildOpts':   buildOpts,
+	   'repeat':      benchOpts['repeat'],
+	   'cases':       cases,
+	   }
+    if old:
+	compare(old, new)
+    if benchOpts['out']:
+	fob = open(benchOpts['out'], 'w')
+	try:
+	    json.dump(new, fob, indent=1, sort_keys=True)
+	finally:
+	    fob.close()
+    sys.exit(0)
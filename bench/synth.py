@@ -0,0 +1,135 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Synthetic pipeline results trees.
+#
+# Writes OBS/results/<runTimeLabel>/SBn.fits subband images, as the imaging
+# pipeline would: (FREQ, STOKES, DEC, RA) float32 cubes of Gaussian noise
+# with a few sources, Gaussians as wide as a restoring beam, BEAM, for
+# source finding to find, with the world coordinates of a LOFAR subband,
+# and optionally an average image, ave.fits.  The fits files are written
+# here, card by card, so that no fits library is needed, and the pixels
+# come from a seeded generator, so that a tree is the same every time it is
+# made.  A tree records its settings in SYNTHNAME, and is only written again
+# when they change.
+
+import os
+import json
+from   os.path import exists, join
+import numpy
+
+OBS       = "L2009_99999_1"
+RUNLABEL  = "2009-10-13T13:44:49"
+SYNTHNAME = "synth.json"
+NSOURCES  = 20
+BEAM      = 1.5             # pixels, standard deviation of the sources
+BLOCKSIZE = 2880
+FREQ0     = 1.2e8           # Hz, subband 0
+SBWIDTH   = 195312.5        # Hz
+
+
+def card(key, value=None):
+    """One 80 character fits header card."""
+    if value is None:
+	return key.ljust(80)
+    if isinstance(value, bool):
+	value = (value and 'T' or 'F').rjust(20)
+    elif isinstance(value, basestring):
+	value = ("'" + value.ljust(8) + "'").ljust(20)
+    elif isinstance(value, float):
+	value = ("%.12G" % value).rjust(20)
+    else:
+	value = str(value).rjust(20)
+    return (key.ljust(8) + "= " + value).ljust(80)
+
+
+def header(size, planes, subband):
+    """The header cards of one subband image."""
+    cards = [card('SIMPLE', True), card('BITPIX', -32), card('NAXIS', 4),
+	     card('NAXIS1', size), card('NAXIS2', size), card('NAXIS3', planes),
+	     card('NAXIS4', 1),
+	     card('CTYPE1', 'RA---SIN'), card('CRVAL1', 10.0), card('CDELT1', -0.01),
+	     card('CRPIX1', float(size // 2)), card('CUNIT1', 'deg'),
+	     card('CTYPE2', 'DEC--SIN'), card('CRVAL2', 50.0), card('CDELT2', 0.01),
+	     card('CRPIX2', float(size // 2)), card('CUNIT2', 'deg'),
+	     card('CTYPE3', 'STOKES'), card('CRVAL3', 1.0), card('CDELT3', 1.0),
+	     card('CRPIX3', 1.0),
+	     card('CTYPE4', 'FREQ'), card('CRVAL4', FREQ0 + subband * SBWIDTH),
+	     card('CDELT4', SBWIDTH), card('CRPIX4', 1.0), card('CUNIT4', 'Hz'),
+	     card('EQUINOX', 2000.0), card('RADESYS', 'FK5'),
+	     card('END')]
+    return ''.join(cards)
+
+
+def writeImage(fName, size, planes, subband, seed):
+    """Write one synthetic subband image, a plane at a time."""
+    rs   = numpy.random.RandomState(seed)
+    ys   = rs.randint(0, size, NSOURCES)
+    xs   = rs.randint(0, size, NSOURCES)
+    flux = rs.uniform(5.0, 100.0, NSOURCES)
+    # The pixels of each source, out to 4 beam widths, and its peak there.
+    r      = int(numpy.ceil(4 * BEAM))
+    dy, dx = numpy.mgrid[-r:r+1, -r:r+1]
+    yy     = ys[:, None, None] + dy
+    xx     = xs[:, None, None] + dx
+    beam   = flux[:, None, None] * numpy.exp(-(dy ** 2 + dx ** 2) / (2.0 * BEAM ** 2))
+    inside = (yy >= 0) & (yy < size) & (xx >= 0) & (xx < size)
+    yy, xx, beam = yy[inside], xx[inside], beam[inside]
+    text = header(size, planes, subband)
+    fob  = open(fName, 'wb')
+    try:
+	fob.write(text + ' ' * (-len(text) % BLOCKSIZE))
+	for plane in range(planes):
+	    data = rs.normal(0.0, 1.0, (size, size))
+	    numpy.add.at(data, (yy, xx), beam / (plane + 1))
+	    fob.write(data.astype('>f4').tostring())
+	fob.write('\0' * (-(size * size * planes * 4) % BLOCKSIZE))
+    finally:
+	fob.close()
+    return
+
+
+def makeRun(root, nbands=8, size=512, planes=1, average=False, seed=0,
+	    obs=OBS, runTimeLabel=RUNLABEL):
+    """Make, unless it is already there with the same settings, a synthetic
+    results tree under the directory root.  Returns a 3-tuple,
+
+    (observation, runTimeLabel, settings),
+
+    the observation directory and run of the tree, and the dictionary of the
+    settings it was made with.
+    """
+    obsDir      = join(root, obs)
+    resultsPath = join(obsDir, "results", runTimeLabel)
+    settings    = {'nbands': nbands, 'size': size, 'planes': planes,
+		   'average': average, 'seed': seed, 'beam': BEAM}
+    synthName   = join(resultsPath, SYNTHNAME)
+    if exists(synthName):
+	fob = open(synthName)
+	try:
+	    made = json.load(fob)
+	finally:
+	    fob.close()
+	if made == settings:
+	    return obsDir, runTimeLabel, settings
+    if not exists(resultsPath):
+	os.makedirs(resultsPath)
+    for name in os.listdir(resultsPath):
+	if name.endswith('.fits') or name.endswith('.h5'):
+	    os.remove(join(resultsPath, name))
+    for subband in range(nbands):
+	writeImage(join(resultsPath, "SB%d.fits" % subband), size, planes,
+		   subband, seed + subband)
+    if average:
+	writeImage(join(resultsPath, "ave.fits"), size, 1, 0, seed + nbands)
+    fob = open(synthName, 'w')
+    try:
+	json.dump(settings, fob)
+    finally:
+	fob.close()
+    return obsDir, runTimeLabel, settings
@@ -5,30 +5,203 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
-from pyrap.tables import table
+# Reader backend for CASA images, see skimReaders.
+#
+# A CASA image is a table, a directory, whose one row holds the whole image
+# in its 'map' column cell, in (..., y, x) order as pyrap returns it.  The
+# cell is never read whole: each tile is read with getcellslice(), so memory
+# is set by the tile, as for fits.  The coordinate system, the table's
+# 'coords' keyword, is translated into fits header keywords, so that the
+# world coordinates and frequency come from the same code as for fits.
+
+import math
+from   pyrap.tables import table
+import fitsHandlers
+import skimReaders
+
+# fits STOKES axis value of each CASA Stokes name.
+STOKES_CODES = {'I': 1, 'Q': 2, 'U': 3, 'V': 4,
+		'RR': -1, 'LL': -2, 'RL': -3, 'LR': -4,
+		'XX': -5, 'YY': -6, 'XY': -7, 'YX': -8}
+
+# fits CTYPE longitude and latitude axis names of CASA direction systems.
+DIRECTION_TYPES = {'GALACTIC': ('GLON', 'GLAT'),
+		   'ECLIPTIC': ('ELON', 'ELAT')}
+
+_headerCache = {}
+
 
 def slingData(fName):
-    """Ufunc gets a full path file name, opens the casa image,
-    slings back the ndarray, closes things up.
+    """Ufunc gets a full path file name, opens the casa image, slings back
+    the ndarray of its 2D image plane, closes things up.
     """
-    fob  = table(fName)
-    dataChunk = fob.getcol('map')
-    fob.close()
-    del fob
-    return dataChunk, dataChunk.shape
+    for key, dataChunk in slingTiles(fName, [(slice(None), slice(None))]):
+	return dataChunk, dataChunk.shape
 
 def slingHeader(fName):
-    """Ufunc gets a full path file name, opens the casa image,
-    slings back the 'map' column header, closes things up.
+    """Ufunc gets a full path file name, opens the casa image, and slings
+    back its coordinates as a flat dictionary of fits header keywords, see
+    translate().  Cached for as long as the image is unchanged.
     """
-    fob  = table(fName)
-    casaKeys = fob.getkeywords()
-    fob.close()
-    del fob
+    stamp  = skimReaders.sourceStat(fName)
+    cached = _headerCache.get(fName)
+    if cached is not None and cached[0] == stamp:
+	return cached[1]
+    fob = table(fName, ack=False)
+    try:
+	casaKeys = fob.getkeywords()
+	shape    = _cellShape(fob)
+    finally:
+	fob.close()
+    fHeader = translate(casaKeys, shape)
+    _headerCache[fName] = (stamp, fHeader)
+    return fHeader
+
+def _cellShape(fob):
+    """The (..., y, x) shape of the 'map' cell of an open image table."""
+    casaShape = fob.getcolshapestring('map', 0, 1)[0]
+    return tuple([int(n) for n in casaShape.strip('[]').split(',')][::-1])
 
-    # some imagined function "translate" will convert the hideous
-    # casa image keyword structure into a standard, flat key-val
-    # dictionary or tuple.
+def slingShape(fName, cube=False):
+    """Returns the (NAXIS2, NAXIS1) shape of the 2D image plane of a casa
+    image, or with cube=True its full data shape.
+    """
+    fHeader = slingHeader(fName)
+    shape   = tuple([fHeader['NAXIS%d' % n] for n in range(fHeader['NAXIS'], 0, -1)])
+    if cube:
+	return shape
+    return shape[-2:]
+
+def _cellSlice(key, shape):
+    """Returns the (blc, trc, axes) of getcellslice() for the index tuple key
+    into an array of shape: the inclusive corners, and the axes of the slice
+    that key keeps.  Steps are not supported.
+    """
+    blc  = []
+    trc  = []
+    axes = []
+    for n in range(len(shape)):
+	if n < len(key):
+	    idx = key[n]
+	else:
+	    idx = slice(None)
+	if isinstance(idx, slice):
+	    start, stop, step = idx.indices(shape[n])
+	    if step != 1:
+		raise ValueError("Strided casa image slices are not supported.")
+	    blc.append(start)
+	    trc.append(stop - 1)
+	    axes.append(n)
+	else:
+	    idx = int(idx) % shape[n]
+	    blc.append(idx)
+	    trc.append(idx)
+    return blc, trc, axes
 
-    fHeader = translate(casaKeys)
+def slingTiles(fName, keys, cube=False):
+    """Generator, yields (key, dataTile) 2-tuples for each index tuple in keys,
+    into the 2D image plane, or with cube=True the full data cube, as for
+    fitsHandlers.slingTiles().  Each tile is its own cell slice read, so only
+    the tile is ever in memory.
+    """
+    shape = slingShape(fName, cube=True)
+    lead  = (0,) * (len(shape) - 2)
+    fob   = table(fName, ack=False)
+    try:
+	for key in keys:
+	    if cube:
+		fullKey = tuple(key)
+	    else:
+		fullKey = lead + tuple(key)
+	    blc, trc, axes = _cellSlice(fullKey, shape)
+	    dataTile = fob.getcellslice('map', 0, blc, trc)
+	    yield key, dataTile.reshape([trc[n] - blc[n] + 1 for n in axes])
+    finally:
+	fob.close()
+    return
+
+def slingWcs(fName):
+    """Returns the world coordinates of a casa image, as from
+    fitsHandlers.wcsKeywords().
+    """
+    return fitsHandlers.wcsKeywords(slingHeader(fName))
+
+def slingFrequency(fName):
+    """Returns the frequency, in Hz, of the first channel of a casa image."""
+    return fitsHandlers.frequency(slingHeader(fName))
+
+def translate(casaKeys, shape):
+    """Converts the casa image keyword structure, and the (..., y, x) shape
+    of its map, into a flat dictionary of fits header keywords: NAXIS and
+    NAXISn, the CTYPE, CUNIT, CRVAL, CRPIX and CDELT of each axis, PCi_j of
+    the direction axes, EQUINOX and RADESYS.  Direction axes are given in
+    degrees, the others in their casa units.  Pixel axes without a
+    coordinate are left without keywords.
+    """
+    naxis   = len(shape)
+    fHeader = {'NAXIS': naxis}
+    for n in range(naxis):
+	fHeader['NAXIS%d' % (n + 1)] = shape[naxis - 1 - n]
+    coords  = casaKeys.get('coords', {})
+
+    def setAxis(axis, ctype, cunit, crval, crpix, cdelt):
+	n = axis + 1
+	fHeader['CTYPE%d' % n] = ctype
+	fHeader['CUNIT%d' % n] = cunit
+	fHeader['CRVAL%d' % n] = float(crval)
+	fHeader['CRPIX%d' % n] = float(crpix) + 1.0      # casa is 0-relative
+	fHeader['CDELT%d' % n] = float(cdelt)
+	return
+
+    for name in sorted(coords):
+	coord = coords[name]
+	if not isinstance(coord, dict) or not name[-1:].isdigit():
+	    continue
+	number = name.lstrip('abcdefghijklmnopqrstuvwxyz')
+	axes   = coords.get('pixelmap' + number)
+	if axes is None:
+	    continue
+	axes = [int(axis) for axis in axes]
+	if name.startswith('direction'):
+	    system = str(coord.get('system', 'J2000')).upper()
+	    lon, lat = DIRECTION_TYPES.get(system, ('RA', 'DEC'))
+	    proj   = str(coord.get('projection', 'SIN'))
+	    scale  = [_toDegrees(unit) for unit in coord.get('units', ['rad', 'rad'])]
+	    for i in range(len(axes)):
+		ctype = (i == 0 and lon or lat).ljust(5, '-') + '-' + proj
+		setAxis(axes[i], ctype, 'deg', coord['crval'][i] * scale[i],
+			coord['crpix'][i], coord['cdelt'][i] * scale[i])
+	    pc = coord.get('pc')
+	    if pc is not None:
+		for i in range(len(axes)):
+		    for j in range(len(axes)):
+			fHeader['PC%d_%d' % (axes[i] + 1, axes[j] + 1)] = float(pc[i][j])
+	    if system in ('J2000', 'B1950'):
+		fHeader['EQUINOX'] = float(system[1:])
+		fHeader['RADESYS'] = system == 'J2000' and 'FK5' or 'FK4'
+	    elif system == 'ICRS':
+		fHeader['RADESYS'] = 'ICRS'
+	elif name.startswith('spectral'):
+	    wcs = coord.get('wcs', coord)
+	    setAxis(axes[0], 'FREQ', str(coord.get('unit', 'Hz')),
+		    wcs['crval'], wcs['crpix'], wcs['cdelt'])
+	    if 'restfreq' in coord:
+		fHeader['RESTFRQ'] = float(coord['restfreq'])
+	elif name.startswith('stokes'):
+	    stokes = list(coord.get('stokes', ['I']))
+	    codes  = [STOKES_CODES.get(str(s), 1) for s in stokes]
+	    cdelt  = len(codes) > 1 and codes[1] - codes[0] or 1
+	    setAxis(axes[0], 'STOKES', '', codes[0], 0, cdelt)
+	else:
+	    for i in range(len(axes)):
+		setAxis(axes[i], str(coord.get('axes', [''] * len(axes))[i]),
+			str(coord.get('units', [''] * len(axes))[i]),
+			coord['crval'][i], coord['crpix'][i], coord['cdelt'][i])
     return fHeader
+
+def _toDegrees(unit):
+    """Factor from a casa angle unit to degrees."""
+    return {'rad':    180.0 / math.pi,
+	    'deg':    1.0,
+	    'arcmin': 1.0 / 60,
+	    'arcsec': 1.0 / 3600}.get(str(unit), 1.0)
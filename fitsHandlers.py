@@ -5,19 +5,54 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
-import pyfits
+import os
+import numpy
+
+# fits files are a sequence of 2880 byte blocks of 80 character header cards,
+# followed by the data, big-endian, in the type given by BITPIX.
+BLOCKSIZE = 2880
+CARDSIZE  = 80
+
+BITPIX_DTYPES = {8:   '>u1',
+		 16:  '>i2',
+		 32:  '>i4',
+		 64:  '>i8',
+		 -32: '>f4',
+		 -64: '>f8'
+		 }
+
+# Parsed primary headers, by file name, see readHeader().  Each entry is kept
+# with the size and mtime of its file, so a rewritten file is parsed again.
+HEADERCACHE  = 4096
+_headerCache = {}
+
+# Coordinate type of each fits CTYPE axis name, see wcsKeywords().
+COORDINATE_TYPES = {'RA':     'Direction',
+		    'DEC':    'Direction',
+		    'GLON':   'Direction',
+		    'GLAT':   'Direction',
+		    'ELON':   'Direction',
+		    'ELAT':   'Direction',
+		    'FREQ':   'Spectral',
+		    'VELO':   'Spectral',
+		    'VRAD':   'Spectral',
+		    'VOPT':   'Spectral',
+		    'FELO':   'Spectral',
+		    'WAVE':   'Spectral',
+		    'STOKES': 'Stokes',
+		    }
 
 def slingData(fName):
     """Ufunc gets a subband tuple from nameStruct data structure,
     which is of the form,
     ('SB000', 'Image000', 'Sub-band 000', 'Data', 'Coordinates',
     'Source', 'ProcessHist', 'SB0.fits'),
-    and opens the fits image, slings back the ndarray, closes things up."""
+    and maps the fits image, slings back the 2D image plane ndarray.
+    Unless the image is scaled by BSCALE/BZERO, or has BLANK pixels, the
+    ndarray is a view on the memory-mapped file, see mapPlane()."""
 
-    fob  = pyfits.open(fName)
-    dataChunk = fob[0].data[0,0,:,:] #2D slice of the 1,1,2048,2048 array
-    fob.close()
-    del fob
+    dataPlane, fHeader = mapPlane(fName)
+    dataChunk = scaleTile(dataPlane, fHeader)
     return dataChunk, dataChunk.shape
 
 def slingHeader(fName):
@@ -26,10 +61,299 @@ def slingHeader(fName):
     ('SB000', 'Image000', 'Sub-band 000', 'Data', 'Coordinates',
     'Source', 'ProcessHist', 'SB0.fits'),
     opens the fits image, slings back the header, closes things up.
+    For the parsed keywords, without a pyfits open, see slingImage().
     """
+    import pyfits
     fob  = pyfits.open(fName)
     fHeader = fob[0].header.ascardlist()
     fob.close()
     del fob
     return fHeader
 
+
+def slingImage(fName, cube=False):
+    """Single-open access to a fits image.  Returns a 3-tuple,
+
+    (dataArray, fHeader, wcs),
+
+    where dataArray is the memory-mapped 2D image plane, or with cube=True
+    the full data cube (see mapPlane() and mapData()), fHeader the parsed
+    header keywords and wcs its world coordinates, see wcsKeywords().  The
+    header is parsed once, and cached, see readHeader().
+    """
+    if cube:
+	dataArray, fHeader = mapData(fName)
+    else:
+	dataArray, fHeader = mapPlane(fName)
+    return dataArray, fHeader, wcsKeywords(fHeader)
+
+
+def slingWcs(fName):
+    """Returns the world coordinates of a fits image, see wcsKeywords(),
+    from its cached header, see readHeader().
+    """
+    return wcsKeywords(readHeader(fName)[0])
+
+def slingFrequency(fName):
+    """Returns the frequency of a fits image, see frequency(), from its
+    cached header, see readHeader().
+    """
+    return frequency(readHeader(fName)[0])
+
+def slingShape(fName, cube=False):
+    """Returns the (NAXIS2, NAXIS1) shape of the 2D image plane of a fits
+    image, or with cube=True the full (NAXISn, ..., NAXIS1) data shape,
+    reading only the header.
+    """
+    fHeader, dataOffset = readHeader(fName)
+    if cube:
+	return tuple([fHeader['NAXIS%d' % n] for n in range(fHeader['NAXIS'], 0, -1)])
+    return (fHeader['NAXIS2'], fHeader['NAXIS1'])
+
+def slingTiles(fName, keys, cube=False):
+    """Generator, yields (key, dataTile) 2-tuples for each index tuple in keys.
+    Keys index the 2D image plane, as in slingData(), or with cube=True the
+    full data cube.  Tiles are views on the memory-mapped file, so only the
+    pages of each tile are read from disk, and memory use is set by the tile,
+    not by the image size.
+    """
+    dataArray, fHeader, wcs = slingImage(fName, cube)
+    for key in keys:
+	yield key, scaleTile(dataArray[key], fHeader)
+    del dataArray
+    return
+
+def readTile(fName, key, cube=False, out=None):
+    """Returns the tile at key of the 2D image plane, or with cube=True the
+    full data cube, as native float32, converted from the memory-mapped file
+    in one pass, byte swap, type conversion and any BSCALE/BZERO together,
+    into out if given, a native float32 array of the tile's shape, eg. a
+    buffer used again for every tile.
+    """
+    if cube:
+	dataArray, fHeader = mapData(fName)
+    else:
+	dataArray, fHeader = mapPlane(fName)
+    if out is None:
+	out = numpy.empty(dataArray[key].shape, numpy.float32)
+    dataTile = scaleTile(dataArray[key], fHeader, out)
+    del dataArray
+    return dataTile
+
+def readHeader(fName):
+    """Returns the 2-tuple (fHeader, dataOffset) of parseHeader(), parsing
+    the header only once for as long as the file's size and mtime stay the
+    same.  The fHeader dictionary is shared, and must not be changed.
+    """
+    fStat  = os.stat(fName)
+    stamp  = (fStat.st_size, fStat.st_mtime)
+    cached = _headerCache.get(fName)
+    if cached is not None and cached[0] == stamp:
+	return cached[1]
+    parsed = parseHeader(fName)
+    cacheHeader(fName, stamp, parsed[0], parsed[1])
+    return parsed
+
+def cacheHeader(fName, stamp, fHeader, dataOffset):
+    """Put the parsed header of fName in the header cache, stamp being the
+    (size, mtime) of the file it was parsed from, eg. to prime the cache from
+    a skimCatalog index.
+    """
+    if len(_headerCache) >= HEADERCACHE:
+	_headerCache.clear()
+    _headerCache[fName] = (tuple(stamp), (fHeader, dataOffset))
+    return
+
+def parseHeader(fName):
+    """Parse the primary header of a fits file, reading only its 2880 byte
+    header blocks.  Returns a 2-tuple,
+
+    (fHeader, dataOffset),
+
+    where fHeader is a dictionary of keyword values, and dataOffset is the
+    byte offset of the primary data in the file.  Commentary cards
+    (COMMENT, HISTORY, blank) are not kept.
+    """
+    fHeader = {}
+    fob     = open(fName, 'rb')
+    try:
+	nblocks = 0
+	while True:
+	    block = fob.read(BLOCKSIZE)
+	    if len(block) < BLOCKSIZE:
+		raise IOError(fName + ": no END card found in fits header.")
+	    nblocks += 1
+	    for i in range(0, BLOCKSIZE, CARDSIZE):
+		card = block[i:i+CARDSIZE]
+		key  = card[:8].strip()
+		if key == 'END':
+		    return fHeader, nblocks * BLOCKSIZE
+		if card[8:10] == '= ':
+		    fHeader[key] = cardValue(card[10:])
+    finally:
+	fob.close()
+
+def cardValue(valueField):
+    """Returns the python value of the value field (columns 11-80) of a fits
+    header card: str, bool, int or float.
+    """
+    valueField = valueField.strip()
+    if valueField.startswith("'"):
+	# A quote inside a fits string is written as two quotes.
+	end = 1
+	while True:
+	    end = valueField.find("'", end)
+	    if end < 0:
+		end = len(valueField)
+		break
+	    if valueField[end+1:end+2] == "'":
+		end += 2
+		continue
+	    break
+	return valueField[1:end].replace("''", "'").rstrip()
+
+    value = valueField.split('/')[0].strip()
+    if value == 'T':
+	return True
+    if value == 'F':
+	return False
+    try:
+	return int(value)
+    except ValueError:
+	pass
+    try:
+	return float(value.replace('D', 'E'))
+    except ValueError:
+	return value
+
+def mapData(fName):
+    """Memory-map the primary data of a fits file.  Returns a 2-tuple,
+
+    (dataArray, fHeader),
+
+    where dataArray is a read-only numpy.memmap, in the file's big-endian
+    BITPIX type, shaped (NAXISn, ..., NAXIS2, NAXIS1), and fHeader is as
+    returned by readHeader().  Nothing but the header blocks is read until
+    the array is sliced and touched.
+    """
+    fHeader, dataOffset = readHeader(fName)
+    naxis = fHeader.get('NAXIS', 0)
+    if naxis < 2:
+	raise IOError(fName + ": primary HDU holds no image, NAXIS = " + str(naxis))
+    try:
+	dtype = numpy.dtype(BITPIX_DTYPES[fHeader['BITPIX']])
+    except KeyError:
+	raise IOError(fName + ": bad BITPIX, " + str(fHeader.get('BITPIX')))
+    shape = tuple([fHeader['NAXIS%d' % n] for n in range(naxis, 0, -1)])
+    dataArray = numpy.memmap(fName, dtype=dtype, mode='r',
+			     offset=dataOffset, shape=shape)
+    return dataArray, fHeader
+
+def mapPlane(fName):
+    """Returns a 2-tuple, (dataPlane, fHeader), where dataPlane is a view of
+    the 2D image plane at index 0 of all leading axes of the memory-mapped
+    primary data, see mapData().  No pixel data are copied.
+    """
+    dataArray, fHeader = mapData(fName)
+    dataPlane = dataArray[(0,) * (dataArray.ndim - 2)]
+    return dataPlane, fHeader
+
+def scaleTile(dataTile, fHeader, out=None):
+    """Apply BSCALE/BZERO, if the header asks for it, to a tile of raw fits
+    data, and make the BLANK pixels of integer data NaN.  Without out,
+    unscaled tiles without BLANK are passed back untouched, ie. without a
+    copy.  With out, a float32 array of the tile's shape, the tile is
+    scaled, or only converted, into it, and out is passed back.
+    """
+    bscale = fHeader.get('BSCALE', 1.0)
+    bzero  = fHeader.get('BZERO', 0.0)
+    blank  = None
+    if fHeader.get('BITPIX', -32) > 0:
+	blank = fHeader.get('BLANK')
+    if bscale == 1.0 and bzero == 0.0 and blank is None:
+	if out is None:
+	    return dataTile
+	out[...] = dataTile
+	return out
+    if out is None:
+	out = numpy.empty(dataTile.shape, numpy.float32)
+    numpy.multiply(dataTile, bscale, out=out, casting='unsafe')
+    if bzero != 0.0:
+	out += bzero
+    if blank is not None:
+	out[dataTile == blank] = numpy.nan
+    return out
+
+def frequency(fHeader):
+    """Returns the frequency, in Hz, of the first channel of an image, from
+    the header's FREQ axis, else its RESTFRQ/RESTFREQ keyword, else NaN.
+    """
+    for n in range(1, fHeader.get('NAXIS', 0) + 1):
+	if str(fHeader.get('CTYPE%d' % n, '')).startswith('FREQ'):
+	    crval = fHeader.get('CRVAL%d' % n, 0.0)
+	    crpix = fHeader.get('CRPIX%d' % n, 1.0)
+	    cdelt = fHeader.get('CDELT%d' % n, 0.0)
+	    scale = {'HZ': 1.0, 'KHZ': 1e3, 'MHZ': 1e6,
+		     'GHZ': 1e9}.get(str(fHeader.get('CUNIT%d' % n, 'Hz')).upper(), 1.0)
+	    return (crval + (1.0 - crpix) * cdelt) * scale
+    for key in ('RESTFRQ', 'RESTFREQ'):
+	if key in fHeader:
+	    return float(fHeader[key])
+    return float('nan')
+
+def wcsKeywords(fHeader):
+    """Returns the world coordinate system of a parsed fits header as a
+    dictionary, with lists over the fits axes, in fits order (NAXIS1 first),
+
+    CTYPE, CUNIT, CRVAL, CRPIX, CDELT:  the axis keywords,
+    PC:        the NAXIS x NAXIS linear transform, from PCi_j, else CDi_j
+	       (then CDELT is 1), else CROTA2 on the celestial axes,
+    TYPES:     the coordinate type of each coordinate, in axis order, eg.
+	       ['Direction', 'Stokes', 'Spectral'], a Direction coordinate
+	       taking a pair of axes,
+
+    and the scalars NAXIS, EQUINOX (None if not given), RADESYS ('' if not
+    given) and OBSGEO, the observatory [x, y, z] in m, or None.
+    """
+    naxis = fHeader.get('NAXIS', 0)
+    axes  = range(1, naxis + 1)
+    wcs   = {'NAXIS': naxis}
+    wcs['CTYPE'] = [str(fHeader.get('CTYPE%d' % n, '')) for n in axes]
+    wcs['CUNIT'] = [str(fHeader.get('CUNIT%d' % n, '')) for n in axes]
+    wcs['CRVAL'] = [float(fHeader.get('CRVAL%d' % n, 0.0)) for n in axes]
+    wcs['CRPIX'] = [float(fHeader.get('CRPIX%d' % n, 0.0)) for n in axes]
+    wcs['CDELT'] = [float(fHeader.get('CDELT%d' % n, 1.0)) for n in axes]
+
+    pc = numpy.identity(naxis)
+    if [1 for i in axes for j in axes if 'PC%d_%d' % (i, j) in fHeader]:
+	for i in axes:
+	    for j in axes:
+		pc[i-1, j-1] = fHeader.get('PC%d_%d' % (i, j), float(i == j))
+    elif [1 for i in axes for j in axes if 'CD%d_%d' % (i, j) in fHeader]:
+	for i in axes:
+	    for j in axes:
+		pc[i-1, j-1] = fHeader.get('CD%d_%d' % (i, j), 0.0)
+	wcs['CDELT'] = [1.0] * naxis
+    elif fHeader.get('CROTA2', 0.0) and naxis >= 2:
+	rho   = numpy.radians(fHeader['CROTA2'])
+	ratio = wcs['CDELT'][1] / (wcs['CDELT'][0] or 1.0)
+	pc[0, 0] = pc[1, 1] = numpy.cos(rho)
+	pc[0, 1] = -numpy.sin(rho) * ratio
+	pc[1, 0] = numpy.sin(rho) / ratio
+    wcs['PC'] = pc.tolist()
+
+    types = []
+    for ctype in wcs['CTYPE']:
+	coordType = COORDINATE_TYPES.get(ctype.split('-')[0], 'Linear')
+	if coordType == 'Direction' and 'Direction' in types:
+	    continue
+	types.append(coordType)
+    wcs['TYPES'] = types
+
+    wcs['EQUINOX'] = fHeader.get('EQUINOX', fHeader.get('EPOCH'))
+    wcs['RADESYS'] = str(fHeader.get('RADESYS', fHeader.get('RADECSYS', '')))
+    if 'OBSGEO-X' in fHeader:
+	wcs['OBSGEO'] = [float(fHeader.get('OBSGEO-%s' % c, 0.0)) for c in 'XYZ']
+    else:
+	wcs['OBSGEO'] = None
+    return wcs
@@ -5,71 +5,67 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
+import skimDiscovery
 
-class GroupNames(object)
+
+class GroupNames(object):
     """Container and method(s) to build the full set of group names
     for all groups in a skim file."""
 
-    def __init__(self, imageList, coordType="Linear-coord"):
+    def __init__(self, imageList, coordType="Linear-coord", pattern=None):
         self.nims      = len(imageList)
         self.coordType = coordType
         self.imageList = imageList
+	self.pattern   = pattern
 
     def makeGroupNames(self):
         """Make the group names for all image group groups for each
-        sub-band image The final entry per record is the present fits
-        file name, which will not have the inserted zeros of our
-        spec'd subband indices.  We must open the file as it is
-        originally named.
+        sub-band image, in subband order.  The final entry per record is
+        the fits file name as found, which need not have the inserted
+        zeros of our spec'd subband indices.  We must open the file as
+        it is originally named.
         """
 
         self.imGroupNames = []
-	sortedSubBands    = self.subBandList()
-        for band in sortedSubBands:
-	    if band == '000':
-		self.imGroupNames.append( ("SB"+band,
-					   "Image"+band,
-					   "Sub-band "+band,
-					   "skyData",
-					   "Coordinates",
-					   "Source",
-					   "ProcessHist",
-					   "SB0.fits")
-					  )
-            else: self.imGroupNames.append( ("SB"+band,
-				      "Image"+band,
-				      "Sub-band "+band,
-				      "skyData",
-				      "Coordinates",
-				      "Source",
-				      "ProcessHist",
-				       "SB" +band.lstrip('0') +".fits")
+	for band, im in self.subBands():
+	    self.imGroupNames.append( ("SB"+band,
+				       "Image"+band,
+				       "Sub-band "+band,
+				       "skyData",
+				       "Coordinates",
+				       "Source",
+				       "ProcessHist",
+				       im)
 				      )
         return self.imGroupNames
 
-    def subBandList(self):
-	"""Returns a sorted list of 'filled' subband names ('SB000','SB001',...).
-	I.e. fits image files appear as 'SB0.fits,' SB09.fits,' 'SB243.fits'
-	This method will do a fill on those file names so that 'SB0.fits'
-	becomes 'SB000.fits,' which allows for easy iteration and sorting.
+    def subBands(self):
+	"""Returns the sorted list of ('filled' subband ID, file name) of the
+	images, eg. [('000', 'SB0.fits'), ('009', 'SB09.fits'), ...].  The
+	ID is filled to at least 3 digits, 'SB1234.fits' being '1234', and
+	parsed with the subband pattern, see skimDiscovery.subbandId().
+	ValueError if an image has no parseable subband ID, or two have the
+	same.
 	"""
-	newSubBandIds = []
+	pattern = skimDiscovery.compilePattern(self.pattern)
+	bands   = []
 	for im in self.imageList:
-	    unitID       = []
-	    filledUnitID = []
-	    subBandId = ''
-	    fileId = im.split('.')[0]
-	    try: unitID.append(int(fileId[-3]))
-	    except ValueError: pass
-	    try: unitID.append(int(fileId[-2]))
-	    except ValueError: pass
-	    try: unitID.append(int(fileId[-1]))
-	    except ValueError:
+	    subband = skimDiscovery.subbandId(im, pattern)
+	    if subband is None:
 		msg = "Error: Parse on filename, "+im+". No parseable subband ID found.\n\n"
 		raise ValueError(msg)
-	    # unitID is now a list like [1,7,2], or even [2].  Concatenate!
-	    for n in unitID:
-		subBandId = subBandId + str(n)
-	    newSubBandIds.append(subBandId.rjust(3,"0"))
-	newSubBandIds.sort()
-	return newSubBandIds
+	    bands.append((subband, im))
+	bands.sort()
+	for n in range(1, len(bands)):
+	    if bands[n][0] == bands[n-1][0]:
+		raise ValueError("Error: "+bands[n-1][1]+" and "+bands[n][1]+
+				 " are both subband "+str(bands[n][0])+".\n\n")
+	return [("%03d" % subband, im) for subband, im in bands]
+
+    def subBandList(self):
+	"""Returns a sorted list of 'filled' subband names ('000','001',...).
+	I.e. fits image files appear as 'SB0.fits,' SB09.fits,' 'SB243.fits'
+	This method will do a fill on those file names so that 'SB0.fits'
+	becomes '000,' which allows for easy iteration and sorting.
+	"""
+	return [band for band, im in self.subBands()]
@@ -0,0 +1,58 @@
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Reader backend for raw numpy .npy arrays, see skimReaders.
+#
+# An .npy file is an image with no coordinates: a (..., y, x) array, read
+# memory-mapped, so that as for fits only the pages of each tile are read.
+# Having no header to parse it is the cheapest input there is, a stand-in
+# for real images when testing or timing the rest of the ingest.
+
+import numpy
+import fitsHandlers
+
+
+def mapData(fName):
+    """Returns the read-only numpy.memmap of the array in fName."""
+    dataArray = numpy.load(fName, mmap_mode='r')
+    if dataArray.ndim < 2:
+	raise IOError(fName + ": holds no image, ndim = " + str(dataArray.ndim))
+    return dataArray
+
+def slingShape(fName, cube=False):
+    """Returns the (y, x) shape of the first image plane of an .npy array,
+    or with cube=True its full shape.
+    """
+    shape = mapData(fName).shape
+    if cube:
+	return shape
+    return shape[-2:]
+
+def slingTiles(fName, keys, cube=False):
+    """Generator, yields (key, dataTile) 2-tuples for each index tuple in keys,
+    into the first image plane, or with cube=True the full array, as views on
+    the memory-mapped file.
+    """
+    dataArray = mapData(fName)
+    if not cube:
+	dataArray = dataArray[(0,) * (dataArray.ndim - 2)]
+    for key in keys:
+	yield key, dataArray[key]
+    del dataArray
+    return
+
+def slingWcs(fName):
+    """Returns the world coordinates of an .npy array: linear pixel axes."""
+    shape   = mapData(fName).shape
+    fHeader = {'NAXIS': len(shape)}
+    for n in range(len(shape)):
+	fHeader['NAXIS%d' % (n + 1)] = shape[-1 - n]
+    return fitsHandlers.wcsKeywords(fHeader)
+
+def slingFrequency(fName):
+    """An .npy array has no frequency: NaN."""
+    return float('nan')
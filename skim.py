@@ -8,23 +8,103 @@ __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
 import sys
+import time
 import skimUtils
 
 from   os.path import join
-import tables
-import fitsHandlers
+import skimReaders
+import skimIngest
+import skimCatalog
 import groupNames
 import attributeSets
+import skimMetrics
+import skimProfile
+import skimQuantize
+import skimPyramid
 import logging
 
 #------------------------------ Initialize ----------------------------------#
 
-def run(obs,runTimeLabel,logger):
-    """Run it all."""
+def run(obs,runTimeLabel,logger,workers=1,depth=None,
+	tileBytes=skimIngest.TILEBYTES,complib=None,complevel=None,
+	shuffle=True,bitshuffle=False,chunks='plane',cube=False,
+	stack=False,stackDepth=None,resume=False,fitsImages=None,
+	bandwidth=None,average=False,pattern=None,recursive=False,
+	metrics=None,tree=False,profile=None,quantize=None,
+	maxError=skimQuantize.MAXERROR,pyramid=False,stats=False,sources=False):
+    """Run it all.  Images are copied into the file in row tiles of about
+    tileBytes.  With workers > 1, tiles are read by that many reader
+    processes, at most depth tiles ahead of the HDF5 writer, and at most
+    bandwidth bytes per second if given.  See skimIngest.slingImages().
+
+    complib, complevel, shuffle and bitshuffle set the compression of all
+    image datasets, see skimFilters.makeFilters(), and chunks names their
+    chunk policy, see skimIngest.chunkShape().  With cube=True, the data group
+    of each subband holds its full Stokes/channel cube rather than the first
+    image plane.  With stack=True, all subband image planes are written into
+    the one /SkyCube/skyCube dataset instead, chunked stackDepth subbands
+    deep, by default skimStack.STACKDEPTH, see skimStack.buildStack().
+
+    With resume=True an existing skim file is added to rather than
+    overwritten: only images that are new, changed or were left half-written
+    are (re)built, see skimManifest.  Only resumed builds take the checksums
+    of their images, which costs a read of each.
+
+    fitsImages is the (aveImage, imageList) 2-tuple of images to skim, as from
+    skimUtils.mkFitsImageList(); by default all images of the run, found
+    with the subband pattern and recursive, see skimDiscovery.
+
+    With average=True and no average image in the results, the average of
+    the subband image planes is summed as they are written, and stored as
+    /AverageImages/averageImage, see skimIngest.ImageSum.  A resumed build
+    reads the images of the subbands it keeps for the sum.
+
+    The build's metrics, see skimMetrics, are written to the file metrics if
+    given, and the node tree of the skim file is printed with tree=True.
+    With profile, a directory name, the build stages are profiled into it,
+    see skimProfile.
+
+    With quantize, one of skimQuantize.QUANTIZE_MODES, each subband image is
+    stored quantized to its noise, with errors of at most maxError times the
+    noise, see skimQuantize.
+
+    With pyramid=True, each subband image and the average image get a
+    pyramid of binned levels next to them, built from the tiles as they are
+    written, see skimPyramid.  With stats=True, the statistics of each
+    subband image are taken as it is written, and stored with it and in the
+    /Statistics table, see skimStats.  With sources=True, the sources of each
+    subband image are found as it is written, into the sourceList table of
+    its Source group, see skimSources.
+    """
+    if cube and stack:
+	raise ValueError("Subband cubes cannot be stacked; use cube or stack.")
+    if quantize and stack:
+	raise ValueError("Stacked subbands cannot be quantized; use quantize or stack.")
+    if pyramid and stack:
+	raise ValueError("Stacked subbands have no pyramids; use pyramid or stack.")
+    if sources and stack:
+	raise ValueError("Sources are not found in stacked subbands; use sources or stack.")
+    # PyTables, and what is built on it, only for a build, not for --help.
+    import tables
+    import skimFilters
+    import skimStack
+    import skimManifest
+    import skimStats
+    if sources:
+	import skimSources
+    start               = time.time()
+    skimMetrics.reset()
+    if profile:
+	skimProfile.start(profile)
+    filters             = skimFilters.makeFilters(complib, complevel,
+							  shuffle, bitshuffle)
     lofarFileName       = skimUtils.mkOutFileName(obs,runTimeLabel)
     resultsPath         = skimUtils.makePipeResultsPath(obs,runTimeLabel)
-    aveImage, imageList = skimUtils.mkFitsImageList(resultsPath)
-    nameObj             = groupNames.GroupNames(imageList)
+    if fitsImages is None:
+	fitsImages = skimUtils.mkFitsImageList(resultsPath, pattern, recursive)
+    aveImage, imageList = fitsImages
+    skimCatalog.useCatalog(resultsPath, fitsImages)
+    nameObj             = groupNames.GroupNames(imageList, pattern=pattern)
     nameStruct          = nameObj.makeGroupNames()
 
     # nameStruct is a structured tuple, wherein each tuple element has
@@ -38,147 +118,284 @@ def run(obs,runTimeLabel,logger):
 
     #------------------------------ Root Group --------------------------------#
     logger.info("Building LOFAR Sky Image file ...")
-    skyFile = tables.openFile(lofarFileName, mode="w", title="LOFAR Sky Image")
-    root    = skyFile.root
-
-    # Populate Root attributes.
-
-    attributes = attributeSets.AttributeSets()
-    attributes.initHeader('Root', obs=obs, nimages=len(imageList))
-    rootHeader = attributes.attributeSet('Root')
-
-    for key, val in rootHeader:
-	root.key = val
-
-    #------------------------------ Syslog Group ------------------------------#
-    # All Sky Images will have a SysLog group at root level.
-    # See LOFAR-USG-ICD-004, et al for specification.
-
-    syslog = skyFile.createGroup(root, "SysLog", title = "Root System Log")
-    attributes.initHeader('Syslog')
-    syslogHeader = attributes.attributeSet('Syslog')
-
-    for key, value in syslogHeader:
-	syslog.key = value
-
-    #---------------------------- Average Image Group -------------------------#
-    # If average image found in the output.
-    if aveImage != '':
-	logger.debug("Got average image, " + str(aveImage) + "handling ...")
-	aName     = join(resultsPath,aveImage)
-	aveImroot =  skyFile.createGroup(root,"AverageImages",title = "Image Sums")
-	atom      = tables.Float32Atom()
-	dataChunk, dataShape = fitsHandlers.slingData(aName)
-	filters   = tables.Filters()
-	cArr = skyFile.createCArray(aveImroot,
+    skyFile, fresh = skimManifest.openSkim(lofarFileName, resume)
+    try:
+	root    = skyFile.root
+	if not fresh:
+	    logger.info("Resuming " + lofarFileName)
+
+	# Populate Root attributes.
+
+	attributes = attributeSets.AttributeSets()
+	attributes.initHeader('Root', obs=obs, nimages=len(imageList))
+	rootHeader = attributes.attributeSet('Root')
+	attributeSets.writeAttributes(root, rootHeader)
+
+	#------------------------------ Syslog Group ------------------------------#
+	# All Sky Images will have a SysLog group at root level.
+	# See LOFAR-USG-ICD-004, et al for specification.
+
+	if "/SysLog" not in skyFile:
+	    syslog = skyFile.createGroup(root, "SysLog", title = "Root System Log")
+	    attributeSets.writeAttributes(syslog, attributeSets.groupAttributes('Syslog'))
+
+	# The manifest of the source images already in the file.  Images that are
+	# unchanged since are skipped; stale and half-written nodes are removed
+	# here, to be built again.
+	manifest   = skimManifest.openManifest(skyFile)
+	entries    = skimManifest.readManifest(manifest)
+	allBands   = nameStruct
+	nbands     = len(nameStruct)
+	nameStruct = skimManifest.pendingSubbands(skyFile, entries, nameStruct,
+						  resultsPath, logger)
+
+	#---------------------------- Average Image Group -------------------------#
+	# If average image found in the output.
+	# It is skipped, like the subbands, if already in the file and unchanged.
+	aName = join(resultsPath,aveImage)
+	if aveImage != '' and skimManifest.isPending(skyFile, entries,
+						     '/AverageImages', aveImage,
+						     aName, logger):
+	    logger.debug("Got average image %s, handling ...", aveImage)
+	    aveImroot =  skyFile.createGroup(root,"AverageImages",title = "Image Sums")
+	    atom      = tables.Float32Atom()
+	    dataShape = skimReaders.slingShape(aName)
+	    cArr = skimProfile.call('createCArray', skyFile.createCArray, aveImroot,
 				    "averageImage",
 				    atom,
 				    dataShape,
 				    filters=filters,
+				    chunkshape=skimIngest.chunkShape(dataShape, chunks),
 				    title="Incoherent Sum Image"
 				    )
-	cArr[:,:] = dataChunk
-    else: pass
-
-    #------------------------------ Image Groups ------------------------------#
-    # First build level is the image group sub-group.
-    for sBand in nameStruct:
-	imGroup = sBand[1]
-	logger.debug("Got file " + str(sBand[-1]))
-        logger.debug("Glomming " + str(imGroup) + " onto Root group...")
-	imroot = skyFile.createGroup(root, imGroup, title = sBand[2])
-	attributes.initHeader('Image')
-	imHeader = attributes.attributeSet('Image')
-	for key, value in imHeader:
-	    imroot.key = value
-	logger.debug("success!")
-	logger.debug("glomming data to image group..." + str(imGroup))
-	# append associated sub-groups to this new Image Group
-	for newGroup in sBand[3:7]:
-	    #---------------------------- Data Group ------------------------#
-	    if "Data" in newGroup:
-		logger.debug("Datagroup found...")
-		logger.debug("Image group is " + str(imGroup)+ ";" + \
-			     " Data group is " + str(newGroup))
-		datasetHook = skyFile.createGroup(imroot, newGroup, title=newGroup)
-		datasetName = "ImageDataArray_"+sBand[0]
-		attributes.initHeader('skyData')
-		attributes.dataHeader["DATASETNAME"] = datasetName
-		dataHeader = attributes.attributeSet('skyData')
-		for key, value in dataHeader:
-		    datasetHook.key = value
-	    #---------------------- Dataset Arrays ------------------------#
-	        fName = join(resultsPath, sBand[-1])
-		atom  = tables.Float32Atom()
-		dataChunk, dataShape = fitsHandlers.slingData(fName)
-		filters   = tables.Filters()
-		logger.debug("populating dataset arrays ...")
-		cArr = skyFile.createCArray(datasetHook,
+	    keys  = skimIngest.tileKeys(dataShape, tileBytes, chunks)
+	    tiles = skimIngest.slingTiles([(key, [aName], key, False) for key in keys])
+	    tiles = skimIngest.throttle(tiles, bandwidth)
+	    if pyramid:
+		levels = skimPyramid.Pyramid(skyFile, aveImroot, dataShape[-2:],
+					     filters, chunks)
+		tiles  = levels.tiles(tiles)
+	    skimIngest.writeTiles(cArr, tiles)
+	    if pyramid:
+		levels.close()
+	    skimManifest.record(skyFile, manifest, aveImage, aName, '/AverageImages',
+				resume)
+	else: pass
+
+	# Failing that, one can be summed from the subband tiles as they are
+	# written below.  Where a resumed build keeps some subbands, their
+	# images are read for it, so that the average stays that of them all.
+	imageSum = None
+	if average and aveImage == '' and (nameStruct or "/AverageImages" not in skyFile):
+	    kept = [join(resultsPath, sBand[-1]) for sBand in allBands
+		    if sBand not in nameStruct]
+	    if kept:
+		logger.info("Reading %d kept subbands for the average image ...",
+			    len(kept))
+	    imageSum = skimIngest.sumImages([join(resultsPath, sBand[-1])
+					     for sBand in nameStruct], kept, tileBytes)
+	    if imageSum is None:
+		logger.warning("Subband images not all of one shape, average image not summed.")
+		if "/AverageImages" in skyFile:
+		    logger.warning("Removing the stale average image.")
+		    skyFile.removeNode("/AverageImages", recursive=True)
+
+	statsTable = None
+	rowStats   = None
+	if stats:
+	    statsTable = skimStats.openTable(skyFile)
+	    rowStats   = {}
+
+	#---------------------------- Subband Stack -------------------------------#
+	# Optionally all subband planes go into one (subband, y, x) dataset, to
+	# which each subband's data group then refers.
+	if stack:
+	    logger.debug("Stacking all subband images into /SkyCube ...")
+	    stackRows = skimStack.buildStack(skyFile, nameStruct, resultsPath,
+					     filters=filters, workers=workers,
+					     depth=depth, tileBytes=tileBytes,
+					     stackDepth=stackDepth or skimStack.STACKDEPTH,
+					     bandwidth=bandwidth,
+					     imageSum=imageSum, stats=rowStats)
+	    fileNames = []
+	else:
+	    fileNames = [join(resultsPath, sBand[-1]) for sBand in nameStruct]
+
+	#------------------------------ Image Groups ------------------------------#
+	# Subband image tiles are read ahead, in nameStruct order, by the ingest
+	# pipeline; this process only writes.
+	images    = skimIngest.slingImages(fileNames, workers=workers, depth=depth,
+					   tileBytes=tileBytes, chunks=chunks,
+					   cube=cube, bandwidth=bandwidth)
+
+	# First build level is the image group sub-group.
+	progress  = skimMetrics.Progress(len(nameStruct))
+	for sBand in nameStruct:
+	    imGroup = sBand[1]
+	    since   = skimMetrics.mark()
+	    imroot = skyFile.createGroup(root, imGroup, title = sBand[2])
+	    attributeSets.writeAttributes(imroot, attributeSets.groupAttributes('Image'))
+	    # append associated sub-groups to this new Image Group
+	    for newGroup in sBand[3:7]:
+		#---------------------------- Data Group ------------------------#
+		if "Data" in newGroup:
+		    datasetHook = skyFile.createGroup(imroot, newGroup, title=newGroup)
+		    datasetName = "ImageDataArray_"+sBand[0]
+		    if stack:
+			datasetName = skimStack.STACKNAME
+		    attributeSets.writeAttributes(datasetHook,
+						  attributeSets.groupAttributes('skyData',
+										DATASETNAME=datasetName))
+		#---------------------- Dataset Arrays ------------------------#
+		    if stack:
+			skimStack.linkStack(skyFile, datasetHook, stackRows[sBand[0]])
+			if stats:
+			    imageStats = rowStats.get(stackRows[sBand[0]], skimStats.ImageStats())
+			    attrList   = imageStats.attributes()
+			    attributeSets.writeAttributes(datasetHook, attrList)
+			    skimStats.record(statsTable, int(sBand[0][2:]), '/'+imGroup,
+					     attrList)
+			continue
+		    fName, dataShape, tiles = images.next()
+		    atom  = tables.Float32Atom()
+		    if quantize:
+			quantizer = skimQuantize.quantizer(fName, quantize, maxError,
+							   cube, tileBytes)
+			atom      = quantizer.atom()
+			if quantizer.mode != quantize:
+			    logger.info("%s too wide in range for %s, stored as %s.",
+					sBand[-1], quantize, quantizer.mode)
+		    cArr = skimProfile.call('createCArray', skyFile.createCArray, datasetHook,
 					    datasetName,
 					    atom,
 					    dataShape,
 					    filters=filters,
+					    chunkshape=skimIngest.chunkShape(dataShape,
+									     chunks),
 					    title=newGroup)
-		cArr[:,:] = dataChunk
-		continue
-	    #----------------------- Coord Group ------------------------#
-            # Coord groups require one of <'linear','direction','tabular','
-
-            if "Coord" in newGroup:
-		logger.debug("Coorindate group found. ...")
-		logger.debug("glomming Coordinates groups...")
-		logger.debug("groups glommed: " + str(imroot) + str(newGroup))
-		coordroot = skyFile.createGroup(imroot, newGroup, title = newGroup)
-		attributes.initHeader('Coordinates')
-		coordsHeader = attributes.attributeSet('Coordinates')
-
-		for key, value in coordsHeader:
-		    coordroot.key = value
-		logger.debug("made coordroot group")
-                # this is the sub band identifier: +sBand[0][2:]
-                skyFile.createGroup(coordroot,"LinearCoord", \
-				    title = "Linear Coordinates, Subband "+sBand[0][2:])
-		continue
-	#---------------------- Source Group ------------------------#
-	    if "Source" in newGroup:
-		logger.debug("Source group found. Building...")
-		sourceHook = skyFile.createGroup(imroot, newGroup, title = newGroup)
-		attributes.initHeader('Source')
-		sourceHeader = attributes.attributeSet('Source')
-		for key, value in sourceHeader:
-		    sourceHook.key = value
-		continue
-	#---------------------- ProcHist Group ----------------------#
-	    if "ProcessHist" in newGroup:
-		logger.debug("Process History group found.  Building ...")
-		prochistHook =  skyFile.createGroup(imroot, newGroup, title = newGroup)
-		attributes.initHeader('ProcessHist')
-		prochistHeader = attributes.attributeSet('ProcessHist')
-		for key, value in prochistHeader:
-		    prochistHook.key = value
-		continue
-    skimUtils.finish(skyFile,logger)
+		    if imageSum is not None:
+			tiles = imageSum.tiles(tiles)
+		    if stats:
+			imageStats = skimStats.ImageStats()
+			tiles      = imageStats.tiles(tiles)
+		    if sources:
+			finder = skimSources.SourceFinder(dataShape[-2:])
+			tiles  = finder.tiles(tiles)
+		    # Levels are binned from the float tiles, before quantizing.
+		    if pyramid:
+			levels = skimPyramid.Pyramid(skyFile, datasetHook,
+						     dataShape[-2:], filters, chunks)
+			tiles  = levels.tiles(tiles)
+		    if quantize:
+			tiles = quantizer.tiles(tiles)
+			attributeSets.writeAttributes(cArr, quantizer.attributes())
+		    skimIngest.writeTiles(cArr, tiles)
+		    if pyramid:
+			levels.close()
+		    if stats:
+			attrList = imageStats.attributes()
+			attributeSets.writeAttributes(datasetHook, attrList)
+			skimStats.record(statsTable, int(sBand[0][2:]), '/'+imGroup,
+					 attrList)
+		    continue
+		#----------------------- Coord Group ------------------------#
+		# Coord groups require one of <'linear','direction','tabular','
+
+		if "Coord" in newGroup:
+		    coordroot = skyFile.createGroup(imroot, newGroup, title = newGroup)
+		    # World coordinates come from the header parsed for the ingest.
+		    wcs = skimReaders.slingWcs(join(resultsPath, sBand[-1]))
+		    attributeSets.writeAttributes(coordroot,
+						  attributeSets.groupAttributes('Coordinates',
+										**attributeSets.coordOverrides(wcs)))
+		    # this is the sub band identifier: +sBand[0][2:]
+		    linroot = skyFile.createGroup(coordroot,"LinearCoord", \
+					title = "Linear Coordinates, Subband "+sBand[0][2:])
+		    attributeSets.writeAttributes(linroot,
+						  attributeSets.groupAttributes('LinearCoord',
+										**attributeSets.linearOverrides(wcs)))
+		    continue
+	    #---------------------- Source Group ------------------------#
+		if "Source" in newGroup:
+		    sourceHook = skyFile.createGroup(imroot, newGroup, title = newGroup)
+		    attributeSets.writeAttributes(sourceHook,
+						  attributeSets.groupAttributes('Source'))
+		    if sources:
+			wcs    = skimReaders.slingWcs(join(resultsPath, sBand[-1]))
+			found  = finder.find(wcs and attributeSets.linearOverrides(wcs))
+			finder = None
+			skimSources.writeSources(skyFile, sourceHook, found)
+			logger.debug("Found %d sources in %s", len(found), sBand[-1])
+		    continue
+	    #---------------------- ProcHist Group ----------------------#
+		if "ProcessHist" in newGroup:
+		    prochistHook =  skyFile.createGroup(imroot, newGroup, title = newGroup)
+		    attributeSets.writeAttributes(prochistHook,
+						  attributeSets.groupAttributes('ProcessHist'))
+		    continue
+	    # Only now is the subband complete, see skimManifest.
+	    skimManifest.record(skyFile, manifest, sBand[-1],
+				join(resultsPath, sBand[-1]), '/'+imGroup, resume)
+	    skimMetrics.subbandDone(since)
+	    progress.update()
+	    logger.debug("Built %s from %s", imGroup, sBand[-1])
+	progress.close()
+
+	#--------------------------- Summed Average Image -------------------------#
+	if imageSum is not None:
+	    logger.debug("Writing the summed average image ...")
+	    if "/AverageImages" in skyFile:
+		skyFile.removeNode("/AverageImages", recursive=True)
+	    aveImroot = skyFile.createGroup(root,"AverageImages",title = "Image Sums")
+	    cArr = skimProfile.call('createCArray', skyFile.createCArray, aveImroot,
+				    "averageImage",
+				    tables.Float32Atom(),
+				    imageSum.planeShape,
+				    filters=filters,
+				    chunkshape=skimIngest.chunkShape(imageSum.planeShape, chunks),
+				    title="Incoherent Average Image"
+				    )
+	    average = imageSum.average()
+	    cArr[:] = average
+	    skyFile.setNodeAttr(cArr, 'NIMAGES', nbands)
+	    if pyramid:
+		levels = skimPyramid.Pyramid(skyFile, aveImroot, imageSum.planeShape,
+					     filters, chunks)
+		levels.add((slice(None), slice(None)), average)
+		levels.close()
+	skimUtils.finish(skyFile,logger,tree)
+    finally:
+	# A failed build closes the file too, so that it can be opened again,
+	# eg. by the next pass of a watch, see skimWatch.
+	if skyFile.isopen:
+	    skyFile.close()
+	if profile:
+	    skimProfile.stop()
+	    logger.info("Profiles written to %s.", profile)
+    if metrics:
+	skimMetrics.write(metrics, {'file':    lofarFileName,
+				    'seconds': time.time() - start,
+				    'images':  len(imageList)})
 
 
 if __name__ == '__main__':
     # Initalise a default logger
     logging.basicConfig(format="%(message)s")
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.INFO)
 
     #--------------------------------------------------------------------------#
     #                           Handle Cl Options
     ##-------------------------------------------------------------------------#
 
-    obs, runTimeLabel = skimUtils.handleCLargs(sys.argv)
+    obs, runTimeLabel, clOpts = skimUtils.handleCLargs(sys.argv)
 
     #--------------------------------------------------------------------------#
     #                         End Handle Cl Options
     ##-------------------------------------------------------------------------#
 
     # start run() function
-    run(obs, runTimeLabel, logger)
-    skimUtils.finish(skyFile, logger)
+    run(obs, runTimeLabel, logger, **clOpts)
     sys.exit("Done")
 
 
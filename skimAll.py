@@ -7,50 +7,168 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
+import sys
+import time
 import logging
-import skim_functionals
+from   os.path import join
+import skimIngest
+import skimCatalog
+import skimMetrics
+import skimProfile
+import skimQuantize
 import skimUtils
 
-def buildSkim(obs,runTimeLabel):
+def buildSkim(obs,runTimeLabel,workers=1,depth=None,
+	      tileBytes=skimIngest.TILEBYTES,complib=None,complevel=None,
+	      shuffle=True,bitshuffle=False,chunks='plane',cube=False,
+	      stack=False,stackDepth=None,resume=False,
+	      bandwidth=None,average=False,pattern=None,recursive=False,
+	      metrics=None,tree=False,profile=None,quantize=None,
+	      maxError=skimQuantize.MAXERROR,pyramid=False,stats=False,
+	      sources=False):
     """Build the whole file, pass an observation name and a runTimeLabel
     indicating a directory under an observation's results directory.
+    workers, depth, tileBytes and bandwidth configure the subband ingest
+    pipeline, see skimIngest.slingImages().  complib, complevel, shuffle and bitshuffle set
+    the compression of the image datasets, see skimFilters.makeFilters(), and
+    chunks their chunk policy, see skimIngest.chunkShape().  With cube=True
+    each subband's full Stokes/channel cube is stored, not just its first plane.
+    With stack=True all subband planes go into one (subband, y, x) dataset,
+    chunked stackDepth subbands deep, by default skimStack.STACKDEPTH, see
+    skimStack.buildStack().  With resume=True an existing skim file is
+    added to, rebuilding only new, changed or half-written images, see
+    skimManifest.  With average=True and no average image in the results,
+    the average of the subband images is summed as they are copied, and
+    read for those a resumed build keeps, see skimIngest.ImageSum.
+    pattern and recursive set how the subband images are found, see
+    skimDiscovery.  The build's metrics, see skimMetrics, are
+    written to the file metrics if given, and the node tree of the skim file
+    is printed with tree=True.  With profile, a directory name, the build
+    stages are profiled into it, see skimProfile.  With quantize, each
+    subband image is stored quantized to within maxError of its noise, see
+    skimQuantize.  With pyramid=True each image gets a pyramid of binned
+    levels, see skimPyramid, and with stats=True its statistics, taken as it
+    is copied, see skimStats.  With sources=True the sources of each subband
+    image are found as it is copied, see skimSources.
     """
+    if cube and stack:
+	raise ValueError("Subband cubes cannot be stacked; use cube or stack.")
+    if quantize and stack:
+	raise ValueError("Stacked subbands cannot be quantized; use quantize or stack.")
+    if pyramid and stack:
+	raise ValueError("Stacked subbands have no pyramids; use pyramid or stack.")
+    if sources and stack:
+	raise ValueError("Sources are not found in stacked subbands; use sources or stack.")
+    # PyTables, and what is built on it, only for a build, not for --help.
+    import skim_functionals
+    import skimFilters
+    import skimStack
+    import skimManifest
+    import skimStats
+    start         = time.time()
+    skimMetrics.reset()
+    if profile:
+	skimProfile.start(profile)
     # skimValues is a tuple like
     # (lofarFileName, resultsPath, aveImage, imageList, nameStruct)
 
-    skimValues    = skim_functionals.initialize(obs,runTimeLabel)
+    filters       = skimFilters.makeFilters(complib, complevel,
+					    shuffle, bitshuffle)
+    skimValues    = skim_functionals.initialize(obs,runTimeLabel,pattern,recursive)
     lofarFileName = skimValues[0]
     resultsPath   = skimValues[1]
     aveImage      = skimValues[2]
     imageList     = skimValues[3]
     nameStruct    = skimValues[4]
     attributes    = skimValues[5]
+    skimCatalog.useCatalog(resultsPath, (aveImage, imageList))
 
-    skimFileOb0 = skim_functionals.buildRoot(obs,lofarFileName,len(imageList))
-    skimFileOb1 = skim_functionals.buidSysLog(skimFileOb0)
+    skimFileOb0 = skim_functionals.buildRoot(obs,lofarFileName,len(imageList),attributes,
+					     resume=resume)
+    skimFileOb1 = skim_functionals.buildSysLog(skimFileOb0, attributes)
     #del skimFileOb0
-    skimFileOb2 = skim_functionals.buidAveIm(skimFileOb1, aveImage)
+    manifest    = skimManifest.openManifest(skimFileOb1)
+    allBands    = nameStruct
+    nbands      = len(nameStruct)
+    nameStruct  = skimManifest.pendingSubbands(skimFileOb1,
+					       skimManifest.readManifest(manifest),
+					       nameStruct, resultsPath)
+    skimFileOb2 = skim_functionals.buildAveIm(skimFileOb1, aveImage, resultsPath,
+					      tileBytes=tileBytes,
+					      filters=filters, chunks=chunks,
+					      manifest=manifest, bandwidth=bandwidth,
+					      pyramid=pyramid, checksums=resume)
     #del skimFileOb1
-    skimFileOb3 = skim_functionals.buildImageGrps(skimFileOb2, nameStruct)
-    finish(skimFileOb3)
+    # The images of the subbands a resumed build keeps are read for the sum,
+    # so that the average stays that of them all.
+    imageSum    = None
+    if (average and aveImage == '' and
+	(nameStruct or "/AverageImages" not in skimFileOb2)):
+	kept = [join(resultsPath, sBand[-1]) for sBand in allBands
+		if sBand not in nameStruct]
+	if kept:
+	    logging.getLogger().info("Reading %d kept subbands for the average image ...",
+				     len(kept))
+	imageSum = skimIngest.sumImages([join(resultsPath, sBand[-1])
+					 for sBand in nameStruct], kept, tileBytes)
+	if imageSum is None:
+	    logging.getLogger().warning("Subband images not all of one shape, average image not summed.")
+	    if "/AverageImages" in skimFileOb2:
+		logging.getLogger().warning("Removing the stale average image.")
+		skimFileOb2.removeNode("/AverageImages", recursive=True)
+    statsTable  = None
+    rowStats    = None
+    if stats:
+	statsTable = skimStats.openTable(skimFileOb2)
+	rowStats   = {}
+    stackRows   = None
+    if stack:
+	stackRows = skimStack.buildStack(skimFileOb2, nameStruct, resultsPath,
+					 filters=filters, workers=workers,
+					 depth=depth, tileBytes=tileBytes,
+					 stackDepth=stackDepth or skimStack.STACKDEPTH,
+					 bandwidth=bandwidth,
+					 imageSum=imageSum, stats=rowStats)
+    skimFileOb3 = skim_functionals.buildImageGrps(skimFileOb2, nameStruct,
+						   resultsPath, attributes,
+						   workers=workers, depth=depth,
+						   tileBytes=tileBytes,
+						   filters=filters, chunks=chunks,
+						   cube=cube, stackRows=stackRows,
+						   manifest=manifest, bandwidth=bandwidth,
+						   imageSum=imageSum, quantize=quantize,
+						   maxError=maxError, pyramid=pyramid,
+						   stats=statsTable, stackStats=rowStats,
+						   sources=sources, checksums=resume)
+    if imageSum is not None:
+	skim_functionals.buildSumIm(skimFileOb3, imageSum, nbands,
+				    filters=filters, chunks=chunks,
+				    pyramid=pyramid)
+    skimUtils.finish(skimFileOb3, logging.getLogger(), tree)
+    if profile:
+	skimProfile.stop()
+    if metrics:
+	skimMetrics.write(metrics, {'file':    lofarFileName,
+				    'seconds': time.time() - start,
+				    'images':  len(imageList)})
     return
 
 if __name__ == '__main__':
     # Initalise a default logger
     logging.basicConfig(format="%(message)s")
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.INFO)
 
     #--------------------------------------------------------------------------#
     #                             Handle Cl Options
     ##-------------------------------------------------------------------------#
 
-    obs, runTimeLabel = skimUtils.handleCLargs(sys.argv)
+    obs, runTimeLabel, clOpts = skimUtils.handleCLargs(sys.argv)
 
     #--------------------------------------------------------------------------#
     #                             End Handle Cl Options
     ##-------------------------------------------------------------------------#
 
     # start run() function
-    buildSkim(obs,runTimeLabel)
+    buildSkim(obs,runTimeLabel,**clOpts)
     sys.exit("Done")
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Batch mode.
+#
+# Skims every pipeline run, OBS/results/<yyyy-mm-ddThh:mm:ss>/, under any
+# number of observation directories, from one invocation.  Each run is one
+# job, built by skim.run() in a process of its own, with at most 'jobs' of
+# them running at once.  A job's output goes to a log file next to its skim
+# file, and a one line report of each job, success or failure, to stdout.
+# With --metrics, each job writes its metrics next to its log, named as the
+# log with the extension of the --metrics file, see metricsName(), and with
+# --profile its profiles into a directory of that name under the --profile
+# directory.
+#
+# Jobs are plain processes rather than a multiprocessing.Pool, whose daemonic
+# workers could not start the reader processes of a job's own ingest
+# pipeline (--workers).
+
+import sys
+import os
+import re
+import glob
+import time
+import getopt
+import logging
+import traceback
+import multiprocessing
+from   Queue   import Empty
+from   os.path import basename, isdir, join, splitext
+import skim
+import skimUtils
+
+RUNLABEL = re.compile(r"^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d$")
+POLL     = 1.0       # seconds between checks on running jobs
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: '+ mod + ' [options] obs [obs ...]\n\n' + \
+	'\tSkim every pipeline run, results/yyyy-mm-ddThh:mm:ss/, under each\n' + \
+	'\tobservation directory obs.  obs may be a glob pattern, eg.\n' + \
+	'\t"/archive/L2009_*".\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--jobs=N          runs skimmed at once (default 1)\n' + \
+	'\t--logdir=DIR      write job logs to DIR, rather than next to each\n' + \
+	'\t                  skim file\n\n' + \
+	'\tFurther optional keyword arguments, applied to every run, as for skim:\n\n' + \
+	skimUtils.BUILD_USAGE
+    return useBurp
+
+
+def findRuns(patterns):
+    """Returns the sorted list of (observation, runTimeLabel) of all pipeline
+    runs under the observation directories matching the glob patterns.
+    """
+    runs = set()
+    for pattern in patterns:
+	for obs in glob.glob(pattern):
+	    resultsDir = join(obs, "results")
+	    if not isdir(resultsDir):
+		continue
+	    for runTimeLabel in os.listdir(resultsDir):
+		if RUNLABEL.match(runTimeLabel) and isdir(join(resultsDir, runTimeLabel)):
+		    runs.add((obs, runTimeLabel))
+    return sorted(runs)
+
+
+def logName(obs, runTimeLabel, logDir=None):
+    """Returns the log file name of a job: the skim file name with a .log
+    extension, in logDir if given.
+    """
+    name = splitext(skimUtils.mkOutFileName(obs, runTimeLabel))[0] + ".log"
+    if logDir:
+	name = join(logDir, basename(obs.rstrip(os.sep)) + "_" +
+		    runTimeLabel.replace(":", "") + ".log")
+    return name
+
+
+def metricsName(logFileName, metrics):
+    """Returns the metrics file name of a job, its log file name with the
+    extension of metrics, so that jobs do not write over each other's.
+    """
+    return splitext(logFileName)[0] + (splitext(metrics)[1] or ".json")
+
+
+def _job(results, idx, obs, runTimeLabel, logFileName, clOpts):
+    """Job process.  Skims one run, with all output to logFileName, and puts
+    back an (idx, error, seconds) tuple, error being None on success.
+    """
+    start   = time.time()
+    if clOpts.get('metrics'):
+	clOpts = dict(clOpts, metrics=metricsName(logFileName, clOpts['metrics']))
+    if clOpts.get('profile'):
+	clOpts = dict(clOpts, profile=join(clOpts['profile'],
+					   splitext(basename(logFileName))[0]))
+    logFile = open(logFileName, "w")
+    sys.stdout = sys.stderr = logFile
+    logger  = logging.getLogger("skimBatch")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler(logFile))
+    error = None
+    try:
+	skim.run(obs, runTimeLabel, logger, **clOpts)
+    except Exception, err:
+	traceback.print_exc()
+	error = err.__class__.__name__ + ": " + str(err)
+    logFile.flush()
+    results.put((idx, error, time.time() - start))
+    return
+
+
+def runJobs(runs, jobs=1, logDir=None, report=None, **clOpts):
+    """Skim each (observation, runTimeLabel) of runs, at most jobs at once.
+    clOpts are passed on to skim.run().  report, if given, is called with
+    each job's result dictionary as the job ends.  Returns the list of result
+    dictionaries, in the order of runs, with keys
+
+    obs, run, ok, seconds, error, log.
+    """
+    results = multiprocessing.Queue()
+    waiting = list(enumerate(runs))
+    running = {}
+    done    = [None] * len(runs)
+
+    def finished(idx, error, seconds):
+	obs, runTimeLabel = runs[idx]
+	done[idx] = {'obs':     obs,
+		     'run':     runTimeLabel,
+		     'ok':      error is None,
+		     'seconds': seconds,
+		     'error':   error,
+		     'log':     logName(obs, runTimeLabel, logDir),
+		     }
+	running.pop(idx)[1].join()
+	if report:
+	    report(done[idx])
+	return
+
+    while waiting or running:
+	while waiting and len(running) < jobs:
+	    idx, (obs, runTimeLabel) = waiting.pop(0)
+	    proc = multiprocessing.Process(target=_job,
+					   args=(results, idx, obs, runTimeLabel,
+						 logName(obs, runTimeLabel, logDir),
+						 clOpts))
+	    proc.start()
+	    running[idx] = (time.time(), proc)
+	try:
+	    finished(*results.get(timeout=POLL))
+	except Empty:
+	    # A job that died without a word, eg. killed, or a crash in HDF5.
+	    for idx, (start, proc) in running.items():
+		if proc.exitcode:
+		    finished(idx, "exit code " + str(proc.exitcode),
+			     time.time() - start)
+    return done
+
+
+def printResult(result):
+    """One line report of a finished job."""
+    status = result['ok'] and "ok    " or "FAILED"
+    line   = "%s %8.1fs  %s  %s" % (status, result['seconds'],
+				    join(result['obs'], "results", result['run']),
+				    result['log'])
+    if not result['ok']:
+	line += "\n\t" + result['error']
+    print line
+    sys.stdout.flush()
+    return
+
+
+def handleCLargs(args):
+    """Parse the command line, args being sys.argv.  Returns a 2-tuple,
+
+    (patterns, batchOpts),
+
+    where batchOpts is a dictionary of keyword arguments for runJobs().
+    """
+    mod = basename(args[0])
+    long_options = ['help', 'jobs=', 'logdir='] + skimUtils.BUILD_OPTIONS
+    try:
+	opts, arg = getopt.getopt(args[1:], '', long_options)
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if not arg:
+	sys.exit(usage(mod))
+
+    batchOpts = {}
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--jobs",):
+	    batchOpts['jobs'] = skimUtils.intArg(o, a)
+	elif o in ("--logdir",):
+	    if not isdir(a):
+		sys.exit("\n\n\tError: Log directory "+a+" not found.\n")
+	    batchOpts['logDir'] = a
+	elif skimUtils.buildOption(o, a, batchOpts):
+	    pass
+	else:
+	    sys.exit(usage(mod))
+    return arg, batchOpts
+
+
+if __name__ == '__main__':
+    patterns, batchOpts = handleCLargs(sys.argv)
+    runs = findRuns(patterns)
+    if not runs:
+	sys.exit("\n\n\tError: No pipeline runs found under "+" ".join(patterns)+".\n")
+    print "Skimming", len(runs), "runs ..."
+    start   = time.time()
+    results = runJobs(runs, report=printResult, **batchOpts)
+    failed  = [result for result in results if not result['ok']]
+    print "%d runs, %d failed, %.1fs" % (len(results), len(failed),
+					 time.time() - start)
+    if failed:
+	sys.exit(1)
+    sys.exit(0)
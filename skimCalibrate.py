@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+import sys
+import os
+import time
+import shutil
+import getopt
+import tempfile
+from   os.path import basename, join, getsize
+import numpy
+import tables
+import fitsHandlers
+import skimIngest
+import skimFilters
+
+# (complib, complevel, shuffle, bitshuffle) settings tried by default.
+# Settings whose library is not built into this PyTables are skipped.
+DEFAULT_SETTINGS = [(None,        0, True,  False),
+		    ('zlib',      1, True,  False),
+		    ('zlib',      5, True,  False),
+		    ('lzo',       1, True,  False),
+		    ('blosc',     5, True,  False),
+		    ('blosc:lz4', 5, True,  False),
+		    ('blosc:lz4', 5, False, True),
+		    ('blosc:zstd',5, True,  False),
+		    ]
+
+DEFAULT_POLICIES = ('plane', 'tile')    # 'cube' chunks a plane as 'tile' does
+
+CUTOUT  = 64      # side of the boxes read for the cutout rate
+NCUTOUT = 200
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: '+ mod + ' [options] SBnnn.fits\n\n' + \
+	'\tWrite the image plane of a sample subband with each compression\n' + \
+	'\tsetting and chunk policy, and report write and read MB/s and the\n' + \
+	'\tcompression ratio.\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--complib=LIB[,LIB...]   libraries to try (default: a standard set)\n' + \
+	'\t--complevel=N[,N...]     levels to try with each --complib (default 5)\n' + \
+	'\t--bitshuffle             also try bit shuffle with each --complib\n' + \
+	'\t--chunks=P[,P...]        chunk policies to try (default '+','.join(DEFAULT_POLICIES)+')\n' + \
+	'\t--tmpdir=DIR             scratch directory (default: system temp)\n\n'
+    return useBurp
+
+
+def calibrate(fName, settings, policies, tmpDir=None):
+    """Returns a list of result dictionaries, one per (setting, policy), with
+    the write and read rates in MB/s, cutouts per second and the compression
+    ratio, for the image plane of the fits file fName.  The plane is read into
+    memory once, up front, so the rates are those of HDF5 and the codec only.
+    """
+    dataPlane, fHeader = fitsHandlers.mapPlane(fName)
+    dataPlane = numpy.array(dataPlane, dtype=numpy.float32)
+    rawMB     = dataPlane.nbytes / 1e6
+    nrows, ncols = dataPlane.shape
+    boxes = numpy.random.RandomState(0).randint(0, max(1, min(nrows, ncols)-CUTOUT),
+						size=(NCUTOUT, 2))
+    scratch = tempfile.mkdtemp(prefix='skimCalibrate', dir=tmpDir)
+    results = []
+    try:
+	for complib, complevel, shuffle, bitshuffle in settings:
+	    try:
+		filters = skimFilters.makeFilters(complib, complevel,
+						  shuffle, bitshuffle)
+	    except ValueError, err:
+		print "Skipping", skimFilters.describe(complib, complevel,
+						       shuffle, bitshuffle)+":", err
+		continue
+	    for policy in policies:
+		h5Name  = join(scratch, 'calibrate.h5')
+		h5File  = tables.openFile(h5Name, mode="w")
+		chunks  = skimIngest.chunkShape(dataPlane.shape, policy)
+		keys    = skimIngest.tileKeys(dataPlane.shape, policy=policy)
+		start   = time.time()
+		cArr = h5File.createCArray(h5File.root, 'plane',
+					   tables.Float32Atom(), dataPlane.shape,
+					   filters=filters, chunkshape=chunks)
+		skimIngest.writeTiles(cArr, [(key, dataPlane[key]) for key in keys])
+		h5File.close()
+		writeTime = time.time() - start
+		diskMB    = getsize(h5Name) / 1e6
+
+		h5File    = tables.openFile(h5Name, mode="r")
+		cArr      = h5File.root.plane
+		start     = time.time()
+		cArr[:]
+		readTime  = time.time() - start
+		start     = time.time()
+		for y, x in boxes:
+		    cArr[y:y+CUTOUT, x:x+CUTOUT]
+		cutTime   = time.time() - start
+		h5File.close()
+		os.remove(h5Name)
+
+		results.append({'setting':   skimFilters.describe(complib, complevel,
+								  shuffle, bitshuffle),
+				'chunks':    policy,
+				'chunkshape':chunks,
+				'writeMBs':  rawMB / max(writeTime, 1e-9),
+				'readMBs':   rawMB / max(readTime, 1e-9),
+				'cutouts':   NCUTOUT / max(cutTime, 1e-9),
+				'ratio':     rawMB / max(diskMB, 1e-9),
+				})
+    finally:
+	shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def report(fName, results):
+    print
+    print "Calibration on", fName
+    print
+    print "%-26s %-7s %-12s %10s %10s %10s %7s" % ("setting", "chunks", "chunkshape",
+						 "write MB/s", "read MB/s",
+						 "cutouts/s", "ratio")
+    for res in results:
+	print "%-26s %-7s %-12s %10.1f %10.1f %10.0f %7.2f" % (res['setting'],
+							    res['chunks'],
+							    "%dx%d" % res['chunkshape'],
+							    res['writeMBs'],
+							    res['readMBs'],
+							    res['cutouts'],
+							    res['ratio'])
+    print
+    return
+
+
+def handleCLargs(args):
+    mod = basename(args[0])
+    long_options = ['help', 'complib=', 'complevel=', 'bitshuffle',
+		    'chunks=', 'tmpdir=']
+    try:
+	opts, arg = getopt.getopt(args[1:], '', long_options)
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if len(arg) != 1:
+	sys.exit(usage(mod))
+
+    complibs   = None
+    complevels = [skimFilters.DEFAULT_COMPLEVEL]
+    bitshuffle = False
+    policies   = list(DEFAULT_POLICIES)
+    tmpDir     = None
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--complib",):
+	    complibs = a.split(',')
+	elif o in ("--complevel",):
+	    try:
+		complevels = [int(n) for n in a.split(',')]
+	    except ValueError:
+		sys.exit(usage(mod))
+	elif o in ("--bitshuffle",):
+	    bitshuffle = True
+	elif o in ("--chunks",):
+	    policies = a.split(',')
+	    for policy in policies:
+		if policy not in skimIngest.CHUNK_POLICIES:
+		    sys.exit(usage(mod))
+	elif o in ("--tmpdir",):
+	    tmpDir = a
+
+    if complibs is None:
+	settings = DEFAULT_SETTINGS
+    else:
+	settings = [(None, 0, True, False)]
+	for complib in complibs:
+	    for complevel in complevels:
+		settings.append((complib, complevel, True, False))
+		if bitshuffle:
+		    settings.append((complib, complevel, False, True))
+    return arg[0], settings, policies, tmpDir
+
+
+if __name__ == '__main__':
+    fName, settings, policies, tmpDir = handleCLargs(sys.argv)
+    report(fName, calibrate(fName, settings, policies, tmpDir))
+    sys.exit(0)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Header catalog of a results directory.
+#
+# A small JSON index, CATALOGNAME in the results directory, of every fits
+# image in it (other types of image are not indexed, see skimReaders):
+# file size and mtime, the parsed primary header and data offset, and from
+# those the image shape, BITPIX, frequency and world coordinates.  Only the
+# 2880 byte header blocks of each image are read, and on a rescan only
+# those of images whose size or mtime have changed.
+#
+# Where a results directory has a catalog, a skim build brings it up to date
+# and primes the fitsHandlers header cache from it, so that the build parses
+# no header the catalog already holds.
+
+import sys
+import os
+import json
+import getopt
+from   os.path import basename, exists, isdir, join
+import fitsHandlers
+import skimReaders
+import skimUtils
+
+CATALOGNAME    = "skimCatalog.json"
+CATALOGVERSION = 1
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: '+ mod + ' [options] --run=yyyy-mm-ddThh:mm:ss obs\n\n' + \
+	'\tScan the headers of the fits images of a pipeline run, as for skim,\n' + \
+	'\tinto the catalog '+CATALOGNAME+' in its results directory, and\n' + \
+	'\tlist them.  Only new and changed images are read.\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--rebuild         read every image header again\n' + \
+	'\t--quiet           do not list the images\n\n'
+    return useBurp
+
+
+def catalogName(resultsPath):
+    return join(resultsPath, CATALOGNAME)
+
+
+def _ascii(value):
+    """json gives back unicode, the rest of skim works in str."""
+    if isinstance(value, unicode):
+	return str(value)
+    if isinstance(value, list):
+	return [_ascii(item) for item in value]
+    if isinstance(value, dict):
+	return dict([(str(key), _ascii(item)) for key, item in value.items()])
+    return value
+
+
+def loadCatalog(resultsPath):
+    """Returns the catalog of resultsPath, a dictionary of entries by image
+    file name (see catalogEntry()), or None if there is no catalog, or it is
+    unreadable or of another version.
+    """
+    fName = catalogName(resultsPath)
+    if not exists(fName):
+	return None
+    try:
+	fob = open(fName)
+	try:
+	    catalog = _ascii(json.load(fob))
+	finally:
+	    fob.close()
+    except (IOError, ValueError):
+	return None
+    if catalog.get('version') != CATALOGVERSION:
+	return None
+    return catalog['images']
+
+
+def saveCatalog(resultsPath, images):
+    """Write the catalog, atomically, so that a reader never sees half of it."""
+    fName   = catalogName(resultsPath)
+    tmpName = fName + ".tmp"
+    fob = open(tmpName, "w")
+    try:
+	json.dump({'version': CATALOGVERSION, 'images': images}, fob,
+		  sort_keys=True, separators=(',', ':'))
+    finally:
+	fob.close()
+    os.rename(tmpName, fName)
+    return
+
+
+def catalogEntry(fName, fStat, average=False):
+    """Returns the catalog entry of the fits image fName, reading only its
+    header blocks.  fStat is its os.stat().
+    """
+    fHeader, dataOffset = fitsHandlers.readHeader(fName)
+    freq = fitsHandlers.frequency(fHeader)
+    if freq != freq:
+	freq = None
+    return {'size':       fStat.st_size,
+	    'mtime':      fStat.st_mtime,
+	    'average':    average,
+	    'dataOffset': dataOffset,
+	    'shape':      list(fitsHandlers.slingShape(fName, cube=True)),
+	    'bitpix':     fHeader.get('BITPIX'),
+	    'frequency':  freq,
+	    'wcs':        fitsHandlers.wcsKeywords(fHeader),
+	    'header':     fHeader,
+	    }
+
+
+def scanCatalog(resultsPath, fitsImages=None, rebuild=False):
+    """Bring the catalog of resultsPath up to date with the images in it, and
+    return it.  fitsImages is the (aveImage, imageList) of the images, as from
+    skimUtils.mkFitsImageList(), by default all in resultsPath.  Entries whose
+    file size and mtime are unchanged are kept, unless rebuild is set, and
+    entries of files since gone are dropped.  Only fits images are indexed.
+    The catalog is only written if anything changed.
+    """
+    if fitsImages is None:
+	fitsImages = skimUtils.mkFitsImageList(resultsPath)
+    aveImage, imageList = fitsImages
+    old     = (not rebuild and loadCatalog(resultsPath)) or {}
+    images  = {}
+    changed = rebuild or not exists(catalogName(resultsPath))
+    for image in ([aveImage] if aveImage else []) + list(imageList):
+	fName = join(resultsPath, image)
+	if skimReaders.readerName(fName) != 'fits':
+	    continue
+	fStat = os.stat(fName)
+	entry = old.get(image)
+	if (entry is None or entry['size'] != fStat.st_size or
+	    entry['mtime'] != fStat.st_mtime):
+	    entry   = catalogEntry(fName, fStat, average=(image == aveImage))
+	    changed = True
+	images[image] = entry
+    if changed or set(old) != set(images):
+	saveCatalog(resultsPath, images)
+    return images
+
+
+def primeHeaders(resultsPath, images):
+    """Prime the fitsHandlers header cache with the headers of a catalog."""
+    for image, entry in images.items():
+	fitsHandlers.cacheHeader(join(resultsPath, image),
+				 (entry['size'], entry['mtime']),
+				 entry['header'], entry['dataOffset'])
+    return
+
+
+def useCatalog(resultsPath, fitsImages=None):
+    """For a build: if resultsPath has a catalog, bring it up to date, prime
+    the header cache from it, and return it; otherwise return None.
+    """
+    if not exists(catalogName(resultsPath)):
+	return None
+    images = scanCatalog(resultsPath, fitsImages)
+    primeHeaders(resultsPath, images)
+    return images
+
+
+def report(resultsPath, images):
+    print
+    print "Catalog of", resultsPath
+    print
+    print "%-24s %-20s %6s %14s %10s" % ("image", "shape", "BITPIX",
+					 "frequency/MHz", "MB")
+    for image in sorted(images, key=lambda image: (not images[image]['average'],
+						   image)):
+	entry = images[image]
+	freq  = entry['frequency']
+	print "%-24s %-20s %6s %14s %10.1f" % (image,
+					       "x".join([str(n) for n in entry['shape']]),
+					       entry['bitpix'],
+					       freq is None and "-" or "%.4f" % (freq / 1e6),
+					       entry['size'] / 1e6)
+    print
+    print len(images), "images"
+    return
+
+
+def handleCLargs(args):
+    """Parse the command line, args being sys.argv.  Returns a 4-tuple,
+
+    (observation, runTimeLabel, rebuild, quiet).
+    """
+    mod = basename(args[0])
+    try:
+	opts, arg = getopt.getopt(args[1:], '', ['help', 'run=', 'rebuild', 'quiet'])
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if len(arg) != 1:
+	sys.exit(usage(mod))
+
+    runTimeLabel = None
+    rebuild      = False
+    quiet        = False
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--run",):
+	    runTimeLabel = a
+	elif o in ("--rebuild",):
+	    rebuild = True
+	elif o in ("--quiet",):
+	    quiet = True
+    if runTimeLabel is None:
+	sys.exit(usage(mod))
+    if not isdir(skimUtils.makePipeResultsPath(arg[0], runTimeLabel)):
+	sys.exit("\n\n\tError: Path to directory "+runTimeLabel+" not found.\n")
+    return arg[0], runTimeLabel, rebuild, quiet
+
+
+if __name__ == '__main__':
+    obs, runTimeLabel, rebuild, quiet = handleCLargs(sys.argv)
+    resultsPath = skimUtils.makePipeResultsPath(obs, runTimeLabel)
+    images      = scanCatalog(resultsPath, rebuild=rebuild)
+    if not quiet:
+	report(resultsPath, images)
+    sys.exit(0)
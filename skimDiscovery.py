@@ -0,0 +1,157 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Subband image discovery.
+#
+# Finds the subband images of a results directory, and, with recursive, of
+# the directories under it, eg. results/<run>/beam0/L12345_SB1234_uv.fits.
+# Image names are returned relative to the results directory, as stored in
+# the manifest, so that join(resultsPath, name) is the file either way.
+#
+# The subband ID of an image is the digits matched by a regular expression
+# on its file name, by default SUBBANDPATTERN, and images are in numeric
+# subband order, so SB2 comes before SB10 and IDs may have any number of
+# digits.  A pattern names its ID group 'subband', or has it as group 1.
+#
+# Images are the files, or for CASA directories, whose names end in one of
+# the suffixes of the skimReaders backends.
+#
+# Directories are read with scandir where available, which gives the entry
+# types without a stat per file.  Nothing here changes the working directory
+# or any module state, so discovery is safe from several threads at once.
+
+import os
+import re
+from   os.path import basename, join
+import skimReaders
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+	from scandir import scandir
+    except ImportError:
+	scandir = None
+
+SUBBANDPATTERN = r"SB(?P<subband>\d+)"
+AVEMARK        = "ave"          # in the file name of an average image
+
+_digits = re.compile(r"(\d+)")
+
+
+def naturalKey(name):
+    """Sort key of a name that orders its runs of digits by value, so that
+    'SB2.fits' sorts before 'SB10.fits'.
+    """
+    return [(part.isdigit() and (0, int(part)) or (1, part))
+	    for part in _digits.split(name)]
+
+
+def compilePattern(pattern=None):
+    """Returns the compiled subband pattern; pattern may be a regular
+    expression string, already compiled, or None for SUBBANDPATTERN.
+    """
+    if pattern is None:
+	pattern = SUBBANDPATTERN
+    if isinstance(pattern, basestring):
+	pattern = re.compile(pattern)
+    if not pattern.groups:
+	raise ValueError("Subband pattern "+pattern.pattern+" has no group "
+			 "for the subband ID.")
+    return pattern
+
+
+def subbandId(name, pattern=None):
+    """Returns the integer subband ID of the image file name, from the last
+    match of pattern (see compilePattern()) on its base name, or None if
+    there is none.
+    """
+    pattern = compilePattern(pattern)
+    group   = 'subband' in pattern.groupindex and 'subband' or 1
+    found   = None
+    for match in pattern.finditer(basename(name)):
+	found = match
+    if found is None or found.group(group) is None:
+	return None
+    return int(found.group(group))
+
+
+def _entries(path, recursive):
+    """(name, isDir) of the entries of the directory path.  Without scandir,
+    entries are only stat'ed when their type is needed, ie. when recursing.
+    """
+    if scandir is not None:
+	for entry in scandir(path):
+	    yield entry.name, entry.is_dir(follow_symlinks=False)
+	return
+    for name in os.listdir(path):
+	yield name, (recursive and os.path.isdir(join(path, name)) and
+		     not os.path.islink(join(path, name)))
+    return
+
+
+def findImages(top, suffix=None, recursive=False):
+    """Returns the naturally sorted list of images named *suffix in the
+    directory top, or with recursive in it and every directory under it,
+    as paths relative to top.  suffix may be a tuple of suffixes, and is by
+    default that of all reader backends, see skimReaders.suffixes().  As in
+    skimReaders.readerName(), suffixes match in any case, so SB000.FITS is
+    found.  A directory named as an image is an image, as a CASA image is,
+    and is not searched.
+    """
+    if suffix is None:
+	suffix = skimReaders.suffixes()
+    if isinstance(suffix, basestring):
+	suffix = (suffix,)
+    suffix = tuple([s.lower() for s in suffix])
+    found = []
+    dirs  = [""]
+    while dirs:
+	rel = dirs.pop()
+	for name, isDir in _entries(join(top, rel), recursive):
+	    if name.lower().endswith(suffix):
+		found.append(join(rel, name))
+	    elif isDir and recursive:
+		dirs.append(join(rel, name))
+    found.sort(key=naturalKey)
+    return found
+
+
+def splitImages(names, pattern=None):
+    """Split image names into a 2-tuple,
+
+    (aveImage, imageList),
+
+    as for skimUtils.mkFitsImageList(): the average image, or '' if there is
+    none, and the subband images in subband ID order.  Images whose names do
+    not match pattern are neither.  ValueError if two images have the same
+    subband ID.
+    """
+    pattern  = compilePattern(pattern)
+    aveImage = ''
+    bands    = []
+    for name in names:
+	if not aveImage and AVEMARK in basename(name):
+	    aveImage = name
+	    continue
+	subband = subbandId(name, pattern)
+	if subband is not None:
+	    bands.append((subband, naturalKey(name), name))
+    bands.sort()
+    for n in range(1, len(bands)):
+	if bands[n][0] == bands[n-1][0]:
+	    raise ValueError("Images "+bands[n-1][2]+" and "+bands[n][2]+
+			     " are both subband "+str(bands[n][0])+".")
+    return aveImage, [band[2] for band in bands]
+
+
+def discover(resultsPath, pattern=None, recursive=False, suffix=None):
+    """Returns the (aveImage, imageList) of the images in resultsPath, see
+    findImages() and splitImages().
+    """
+    return splitImages(findImages(resultsPath, suffix, recursive), pattern)
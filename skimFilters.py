@@ -0,0 +1,85 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+import tables
+
+DEFAULT_COMPLEVEL = 5
+COMPLIBS          = ('zlib', 'lzo', 'bzip2', 'blosc')
+
+
+def available(complib):
+    """True if the compression library complib, as for makeFilters(), is
+    available in this PyTables, blosc codecs included.
+    """
+    lib, sep, codec = complib.partition(':')
+    try:
+	if tables.whichLibVersion(lib) is None:
+	    return False
+    except ValueError:
+	# Not a library PyTables knows of at all.
+	return False
+    if codec:
+	if lib != 'blosc':
+	    return False
+	listCodecs = getattr(tables, 'blosc_compressor_list', None)
+	return listCodecs is None or codec in listCodecs()
+    return True
+
+
+def makeFilters(complib=None, complevel=None, shuffle=True, bitshuffle=False):
+    """Returns the tables.Filters instance used for all image datasets.
+
+    complib:       compression library, one of 'zlib', 'lzo', 'bzip2', 'blosc',
+		   or a blosc codec as 'blosc:<codec>', eg. 'blosc:lz4'.
+    complevel:     0-9.  Defaults to DEFAULT_COMPLEVEL when only complib is
+		   given, and to zlib when only complevel is given.
+    shuffle:       byte shuffle the data ahead of compression.
+    bitshuffle:    bit shuffle instead, which needs blosc and PyTables >= 3.3.
+
+    With neither complib nor complevel, this is the bare tables.Filters(),
+    ie. no compression, as skim files have always been written.
+
+    Raises ValueError for a library that is not available in this PyTables.
+    """
+    if complib is None and not complevel:
+	return tables.Filters()
+    if complib is None:
+	complib = 'zlib'
+    if complevel is None:
+	complevel = DEFAULT_COMPLEVEL
+
+    if not available(complib):
+	raise ValueError("Compression library "+complib+" is not available.")
+
+    filterArgs = {'complevel': complevel,
+		  'complib':   complib,
+		  'shuffle':   shuffle and not bitshuffle,
+		  }
+    if bitshuffle:
+	filterArgs['bitshuffle'] = True
+    try:
+	return tables.Filters(**filterArgs)
+    except (TypeError, ValueError), err:
+	raise ValueError("Bad filter settings, "+describe(complib, complevel,
+							  shuffle, bitshuffle)+
+			 ": "+str(err))
+
+
+def describe(complib, complevel, shuffle=True, bitshuffle=False):
+    """One line description of a filter setting, eg. 'blosc:lz4/5/shuffle'."""
+    if complib is None and not complevel:
+	return 'none'
+    if bitshuffle:
+	shuffleName = 'bitshuffle'
+    elif shuffle:
+	shuffleName = 'shuffle'
+    else:
+	shuffleName = 'noshuffle'
+    return "%s/%s/%s" % (complib or 'zlib',
+			 complevel is None and DEFAULT_COMPLEVEL or complevel,
+			 shuffleName)
@@ -0,0 +1,438 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Pipelined, tiled subband ingest.
+#
+# Images are moved from disk into the skim file as tiles: bands of whole rows
+# of one image plane, or of all planes, see tileKeys().  A tile is a whole
+# number of CArray chunks (see chunkShape()), so each tile is written as soon
+# as it is read, and peak memory is set by the tile size, not by the image
+# size.  Tiles are passed around as (key, dataTile), key being the index
+# tuple of the tile in the dataset.  Images of every type are read through
+# their skimReaders backend.
+#
+# By default the dataset is the 2D image plane at index 0 of the leading
+# (Stokes, channel) axes.  With cube=True it is the full N-D data cube,
+# filled plane by plane.
+#
+# Tiles reach the writer as native-endian float32, the type of the datasets,
+# so that tables writes them as they are.  Each is converted from the
+# big-endian, and maybe BSCALE/BZERO scaled, image data in one pass, see
+# skimReaders.readTile(), and when read in this process into a buffer that
+# is used again for every tile of its shape.  The datasets are native-endian
+# too: tables converts whatever it writes to native byte order first, so a
+# big-endian dataset would cost a second byte swap, not save the first.
+#
+# A pool of reader processes reads tiles while the calling process, which
+# owns the open tables file, consumes them strictly in nameStruct order and
+# writes the datasets.  At most 'depth' tiles are ever in flight between the
+# readers and the writer.
+#
+# Usage is the same whether or not reader processes are used,
+#
+# images = skimIngest.slingImages(fileNames, workers=4)
+# for sBand in nameStruct:
+#     fName, dataShape, tiles = images.next()
+#     cArr = skyFile.createCArray(..., dataShape, filters=filters,
+#                                 chunkshape=skimIngest.chunkShape(dataShape))
+#     skimIngest.writeTiles(cArr, tiles)
+
+import time
+import select
+import itertools
+import multiprocessing
+import numpy
+import skimReaders
+import skimMetrics
+import skimProfile
+
+# Target size of one CArray chunk, and the default size of one ingest tile.
+CHUNKBYTES = 256 * 1024
+TILEBYTES  = 16 * 1024 * 1024
+
+ITEMSIZE   = 4      # Float32Atom
+
+# Seconds the writer waits for a tile before it checks that its readers are
+# still alive.
+READERPOLL = 1.0
+
+# Chunkshape policies, by access pattern:
+#
+# 'plane':   chunks span full image rows of one plane.  Best for whole-plane
+#            reads.
+# 'tile':    square chunks of one plane.  Best for cutouts and other small-box
+#            reads.
+# 'cube':    square chunks through all Stokes/channel planes, so that all the
+#            values of a pixel are in one chunk.  Best for per-pixel reads
+#            across the planes of a cube; a single-plane read decompresses
+#            every plane's data.  The same as 'tile' for 2D datasets.
+CHUNK_POLICIES = ('plane', 'tile', 'cube')
+
+
+def chunkShape(dataShape, policy='plane'):
+    """Returns the chunkshape, about CHUNKBYTES, for an image dataset of
+    shape dataShape, (..., NAXIS2, NAXIS1), under the named chunk policy (see
+    CHUNK_POLICIES).  Whatever the policy, a chunk holds whole rows of its
+    column range, so row band tiles map onto whole chunks.
+    """
+    nrows, ncols = dataShape[-2:]
+    lead = dataShape[:-2]
+    if policy == 'plane':
+	chunkRows = max(1, CHUNKBYTES // (ncols * ITEMSIZE))
+	return (1,) * len(lead) + (min(chunkRows, nrows), ncols)
+    elif policy == 'tile':
+	side = int((CHUNKBYTES // ITEMSIZE) ** 0.5)
+	return (1,) * len(lead) + (min(side, nrows), min(side, ncols))
+    elif policy == 'cube':
+	nplanes = int(numpy.prod(lead))
+	side    = max(1, int((CHUNKBYTES // (ITEMSIZE * nplanes)) ** 0.5))
+	return tuple(lead) + (min(side, nrows), min(side, ncols))
+    else:
+	raise ValueError("Unknown chunk policy, "+str(policy)+
+			 ". Use one of "+", ".join(CHUNK_POLICIES))
+
+
+def tileRows(dataShape, tileBytes=TILEBYTES, policy='plane'):
+    """Returns the number of image rows per ingest tile: the largest multiple
+    of the chunk rows that fits in tileBytes, and at least one chunk.
+    Under the 'cube' policy a tile runs through all planes, otherwise it is
+    taken from one plane.
+    """
+    nrows, ncols = dataShape[-2:]
+    chunks       = chunkShape(dataShape, policy)
+    rowBytes     = ncols * ITEMSIZE * int(numpy.prod(chunks[:-2]))
+    nchunks      = max(1, tileBytes // (chunks[-2] * rowBytes))
+    return min(nchunks * chunks[-2], nrows)
+
+
+def tileKeys(dataShape, tileBytes=TILEBYTES, policy='plane'):
+    """Returns the list of dataset index tuples of all ingest tiles of an
+    image dataset, in write order: row bands of each plane in turn, or
+    under the 'cube' policy row bands through all planes.
+    """
+    nrows, ncols = dataShape[-2:]
+    lead  = dataShape[:-2]
+    bands = tileRows(dataShape, tileBytes, policy)
+    rowSlices = [slice(row, min(row+bands, nrows)) for row in range(0, nrows, bands)]
+    if policy == 'cube':
+	planes = [(slice(None),) * len(lead)]
+    else:
+	planes = list(numpy.ndindex(*lead))
+    keys = []
+    for plane in planes:
+	for rows in rowSlices:
+	    keys.append(tuple(plane) + (rows, slice(None)))
+    return keys
+
+
+@skimProfile.profiled('data')
+def writeTiles(cArr, tiles):
+    """Write each (key, dataTile) of tiles into cArr as it arrives.  The
+    wait for each tile, and its write, are timed, see skimMetrics.
+    """
+    for key, dataTile in skimMetrics.timeTiles(tiles):
+	start = time.time()
+	cArr[key] = dataTile
+	skimMetrics.add('write', time.time() - start, dataTile.nbytes)
+    return
+
+
+def throttle(tiles, bandwidth=None):
+    """Generator, passes on each (key, dataTile) of tiles, holding back as
+    need be to keep the average rate within bandwidth bytes per second.  With
+    no bandwidth, tiles are passed on as they come.
+    """
+    start  = time.time()
+    nbytes = 0
+    try:
+	for key, dataTile in tiles:
+	    yield key, dataTile
+	    if bandwidth:
+		nbytes += dataTile.nbytes
+		ahead   = nbytes / float(bandwidth) - (time.time() - start)
+		if ahead > 0:
+		    time.sleep(ahead)
+    finally:
+	if hasattr(tiles, 'close'):
+	    tiles.close()
+    return
+
+
+class ImageSum(object):
+    """Running per-pixel float64 sum, and count of valid (finite) values, of
+    image planes of shape planeShape, taken from ingest tiles as they pass, so
+    an average image costs no extra read of the input.  Only the first image
+    plane of a tile is summed, ie. the plane at index 0 of its leading
+    (Stokes, channel) axes.
+    """
+
+    def __init__(self, planeShape):
+	self.planeShape = tuple(planeShape)
+	self.total      = numpy.zeros(self.planeShape, dtype=numpy.float64)
+	self.count      = numpy.zeros(self.planeShape, dtype=numpy.int32)
+
+    def add(self, key, dataTile, stacked=False):
+	"""Add the tile at key of an image dataset or, stacked, of a
+	(subband, y, x) stack, see skimStack.  Tiles of planes other than the
+	first are ignored.
+	"""
+	rows, cols = key[-2:]
+	if stacked:
+	    planes = dataTile
+	else:
+	    for idx in key[:-2]:
+		if not isinstance(idx, slice) and idx != 0:
+		    return
+	    planes = dataTile.reshape((-1,) + dataTile.shape[-2:])[:1]
+	for plane in planes:
+	    valid = numpy.isfinite(plane)
+	    self.total[rows, cols] += numpy.where(valid, plane, 0)
+	    self.count[rows, cols] += valid
+	return
+
+    def tiles(self, tiles, stacked=False):
+	"""Generator, passes on each (key, dataTile) of tiles, adding each."""
+	for key, dataTile in tiles:
+	    self.add(key, dataTile, stacked)
+	    yield key, dataTile
+	return
+
+    def average(self):
+	"""Returns the float32 average image, NaN where no value was valid."""
+	count = numpy.maximum(self.count, 1)
+	average = (self.total / count).astype(numpy.float32)
+	average[self.count == 0] = numpy.nan
+	return average
+
+
+def sumImages(fileNames, keptNames=(), tileBytes=TILEBYTES):
+    """Returns an ImageSum for the image planes of the image files fileNames
+    and keptNames, or None if there are none, or they are not all of one
+    shape.  The planes of fileNames are to be added as they are written;
+    those of keptNames, the images a resumed build keeps, are read here, in
+    tiles of about tileBytes, and added.
+    """
+    shapes = set([skimReaders.slingShape(fName)
+		  for fName in list(fileNames) + list(keptNames)])
+    if len(shapes) != 1:
+	return None
+    imageSum = ImageSum(shapes.pop())
+    for fName in keptNames:
+	buffers = {}
+	for key in tileKeys(imageSum.planeShape, tileBytes):
+	    imageSum.add(key, readTile([fName], key, False, buffers))
+    return imageSum
+
+
+def tileShape(dataShape, key):
+    """Returns the shape of the tile at index tuple key of an array of
+    shape dataShape.  key holds slices and integers.
+    """
+    shape = []
+    for n, size in enumerate(dataShape):
+	if n >= len(key):
+	    shape.append(size)
+	elif isinstance(key[n], slice):
+	    shape.append(len(xrange(*key[n].indices(size))))
+    return tuple(shape)
+
+
+def readTile(fNames, key, cube, buffers=None):
+    """Returns the tile at key of the image in fNames or, for several file
+    names, the tiles of all stacked along a new leading axis, as native
+    float32.  Given a buffers dictionary, the tile is read into the buffer of
+    its shape there, made on first use, and is only good until the next.
+    """
+    shape = tileShape(skimReaders.slingShape(fNames[0], cube), key)
+    if len(fNames) > 1:
+	shape = (len(fNames),) + shape
+    if buffers is None:
+	dataTile = numpy.empty(shape, numpy.float32)
+    else:
+	dataTile = buffers.get(shape)
+	if dataTile is None:
+	    dataTile = buffers[shape] = numpy.empty(shape, numpy.float32)
+    if len(fNames) == 1:
+	return skimReaders.readTile(fNames[0], key, cube, dataTile)
+    for n, fName in enumerate(fNames):
+	skimReaders.readTile(fName, key, cube, dataTile[n])
+    return dataTile
+
+
+def _reader(tasks, results, others):
+    """Reader process loop.  Gets (index, fNames, key, cube) tile tasks until
+    a None sentinel arrives, sends back (index, dataTile, error) tuples on
+    its own connection, results.  others are the sending ends of the other
+    readers' connections, closed here, so that each connection closes when
+    its reader dies.
+    """
+    for conn in others:
+	conn.close()
+    for idx, fNames, key, cube in iter(tasks.get, None):
+	try:
+	    results.send((idx, readTile(fNames, key, cube), None))
+	except Exception, err:
+	    results.send((idx, None, ", ".join(fNames) + ": " + str(err)))
+    results.close()
+    return
+
+
+def slingTiles(tileTasks, workers=1, depth=None):
+    """Generator, yields (key, dataTile) for each tile task in tileTasks, in
+    order.  A tile task is a 4-tuple,
+
+    (key, fNames, fileKey, cube),
+
+    where key is the index tuple of the tile in the dataset written, fNames
+    a list of image file names, fileKey the index tuple of the tile in each
+    image, and cube as for slingImages().  The tiles of several files are
+    stacked along a new leading axis.
+
+    workers:       number of reader processes.  With workers <= 1, tiles are
+		   read serially in the calling process.
+    depth:         maximum number of tiles read ahead of the writer, i.e. the
+		   bound on the reader -> writer queue.  Defaults to 2*workers.
+
+    Tiles are native float32.  Read serially, each is only good until the
+    next is asked for; the writer must be done with it by then.
+
+    A read failure in a reader process is raised here as an IOError, as is
+    the death of a reader process, killed say, naming the file of the tile
+    waited for.  Each reader sends its tiles on a pipe of its own, so that a
+    reader that dies part way through sending one cannot leave the writer
+    waiting for the rest of it.
+    """
+    if workers <= 1:
+	buffers = {}
+	for key, fNames, fileKey, cube in tileTasks:
+	    yield key, readTile(fNames, fileKey, cube, buffers)
+	return
+
+    if not depth:
+	depth = 2 * workers
+    tasks   = multiprocessing.Queue()
+    pipes   = [multiprocessing.Pipe(False) for n in range(workers)]
+    readers = []
+    for n in range(workers):
+	others = [sender for receiver, sender in pipes[:n] + pipes[n+1:]]
+	proc   = multiprocessing.Process(target=_reader,
+					args=(tasks, pipes[n][1], others))
+	proc.daemon = True
+	proc.start()
+	readers.append(proc)
+    results = {}
+    for receiver, sender in pipes:
+	sender.close()
+	results[receiver.fileno()] = receiver
+
+    # Tile tasks are queued in the same order in which the writer takes
+    # them, and only 'depth' are ever outstanding.  A new task is queued each
+    # time the writer takes a tile, so the oldest outstanding tile is always
+    # the next one needed and a slow file cannot let the readers run
+    # arbitrarily far ahead.
+    tileTasks = iter(tileTasks)
+    keys      = []
+    names     = []
+    pending   = {}
+
+    def queueNext():
+	for key, fNames, fileKey, cube in tileTasks:
+	    tasks.put((len(keys), fNames, fileKey, cube))
+	    keys.append(key)
+	    names.append(fNames)
+	    break
+	return
+
+    def died(idx):
+	return IOError("Reader process died, reading " + ", ".join(names[idx]))
+
+    def receive(idx, timeout):
+	"""Take the tiles sent so far, waiting at most timeout seconds for
+	one.  Returns the number taken.
+	"""
+	ready = select.select(list(results), [], [], timeout)[0]
+	for fd in ready:
+	    try:
+		doneIdx, dataTile, err = results[fd].recv()
+	    except EOFError:
+		raise died(idx)
+	    if err:
+		raise IOError(err)
+	    pending[doneIdx] = dataTile
+	return len(ready)
+
+    for n in range(depth):
+	queueNext()
+    try:
+	idx = 0
+	while idx < len(keys):
+	    while idx not in pending:
+		if not receive(idx, READERPOLL):
+		    # Readers only exit at the end, so a dead one has lost a tile.
+		    for proc in readers:
+			if not proc.is_alive():
+			    raise died(idx)
+	    # Tiles read ahead are taken as they come, so that no reader
+	    # waits on the writer to send its tile.
+	    receive(idx, 0)
+	    dataTile = pending.pop(idx)
+	    # Queue depths: tiles read ahead and waiting here, and tiles
+	    # queued to the readers and not yet taken by the writer.
+	    skimMetrics.gauge('ingest_tiles_ready', len(pending))
+	    skimMetrics.gauge('ingest_tiles_outstanding', len(keys) - idx)
+	    queueNext()
+	    yield keys[idx], dataTile
+	    keys[idx]  = None
+	    names[idx] = None
+	    idx += 1
+    finally:
+	for proc in readers:
+	    tasks.put(None)
+	for proc in readers:
+	    proc.join(1)
+	    if proc.is_alive():
+		proc.terminate()
+	for receiver in results.values():
+	    receiver.close()
+    return
+
+
+def _imageTasks(fileNames, tileBytes, chunks, cube):
+    """Generator over the tile tasks of all images, in the order the writer
+    will consume them.  See slingTiles().
+    """
+    for fName in fileNames:
+	dataShape = skimReaders.slingShape(fName, cube)
+	for key in tileKeys(dataShape, tileBytes, chunks):
+	    yield key, [fName], key, cube
+    return
+
+
+def slingImages(fileNames, workers=1, depth=None, tileBytes=TILEBYTES,
+		chunks='plane', cube=False, bandwidth=None):
+    """Generator, yields (fName, dataShape, tiles) 3-tuples in the order of the
+    passed list of full path image file names, where tiles is an iterator of
+    (key, dataTile) over the image dataset.  Each tiles iterator must be
+    used up before the next image is asked for.
+
+    workers, depth:  see slingTiles().
+    tileBytes:       approximate size of one tile, see tileRows().
+    chunks:          chunk policy of the datasets written, see chunkShape().
+    cube:            ingest the full N-D data cube, rather than the 2D image
+		     plane.
+    bandwidth:       cap on the ingest rate, in bytes per second, see
+		     throttle().
+    """
+    tileStream = throttle(slingTiles(_imageTasks(fileNames, tileBytes, chunks, cube),
+				     workers=workers, depth=depth), bandwidth)
+    for fName in fileNames:
+	dataShape = skimReaders.slingShape(fName, cube)
+	ntiles    = len(tileKeys(dataShape, tileBytes, chunks))
+	yield fName, dataShape, itertools.islice(tileStream, ntiles)
+    tileStream.close()
+    return
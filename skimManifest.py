@@ -0,0 +1,184 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Input manifest, for incremental and resumable skim builds.
+#
+# Every source image written into a skim file gets a row in the manifest
+# table, /SysLog/manifest: its path under the results directory, size, mtime
+# and, in resumed builds, adler32 checksum, and the node it was written to.
+# The row is only appended once the node is completely written and flushed,
+# so a node with no manifest row is one left half-written by a crashed run.
+#
+# On a resumed build, a node is kept if its source file is unchanged: same
+# size and mtime or, failing that, same size and checksum.  Anything else is
+# removed and rebuilt, and new source files are added.  The checksum reads
+# the whole file again, so it is only taken where a later resume may want
+# it, in resumed builds, as watch mode's are; rows without one, NOCHECKSUM,
+# vouch for size and mtime only.
+
+import os
+import zlib
+from   os.path import isdir, join
+import tables
+import skimReaders
+
+MANIFESTNAME = "manifest"
+SYSLOGGROUP  = "/SysLog"
+READBYTES    = 1024 * 1024
+SOURCEBYTES  = 256              # longest SOURCE path the manifest holds
+NOCHECKSUM   = 0                # no checksum taken
+
+
+class ManifestEntry(tables.IsDescription):
+    # SOURCE is the path under the results directory, see checkSource().
+    SOURCE   = tables.StringCol(SOURCEBYTES, pos=0)
+    SIZE     = tables.Int64Col(pos=1)
+    MTIME    = tables.Float64Col(pos=2)
+    CHECKSUM = tables.UInt32Col(pos=3)        # adler32
+    NODE     = tables.StringCol(128, pos=4)
+
+
+def openSkim(lofarFileName, resume=False):
+    """Open a skim file for building.  Returns a 2-tuple,
+
+    (skyFile, fresh),
+
+    where fresh is False only when resume is set and an existing file was
+    opened for appending; otherwise the file is created anew.
+    """
+    if resume and os.path.isfile(lofarFileName) and tables.isHDF5File(lofarFileName):
+	return tables.openFile(lofarFileName, mode="a"), False
+    return tables.openFile(lofarFileName, mode="w", title="LOFAR Sky Image"), True
+
+
+def checksum(fName):
+    """Returns the adler32 checksum of a file, as an unsigned 32 bit int.
+    Of a directory, as a CASA image is, the checksum runs over all the files
+    in it, in sorted order.
+    """
+    if isdir(fName):
+	fNames = []
+	for dirPath, dirNames, fileNames in os.walk(fName):
+	    fNames.extend([join(dirPath, name) for name in fileNames])
+	fNames.sort()
+    else:
+	fNames = [fName]
+    value = 1
+    for fName in fNames:
+	fob = open(fName, 'rb')
+	try:
+	    block = fob.read(READBYTES)
+	    while block:
+		value = zlib.adler32(block, value)
+		block = fob.read(READBYTES)
+	finally:
+	    fob.close()
+    return value & 0xffffffff
+
+
+def openManifest(skyFile):
+    """Returns the manifest table of an open skim file, creating it if need be."""
+    if SYSLOGGROUP + '/' + MANIFESTNAME in skyFile:
+	return skyFile.getNode(SYSLOGGROUP, MANIFESTNAME)
+    return skyFile.createTable(SYSLOGGROUP, MANIFESTNAME, ManifestEntry,
+			       title="Input Manifest")
+
+
+def readManifest(manifest):
+    """Returns the manifest as a dictionary of row dictionaries by SOURCE."""
+    entries = {}
+    for row in manifest:
+	entries[row['SOURCE']] = {'SIZE':     row['SIZE'],
+				  'MTIME':    row['MTIME'],
+				  'CHECKSUM': row['CHECKSUM'],
+				  'NODE':     row['NODE'],
+				  }
+    return entries
+
+
+def checkSource(source):
+    """Raises ValueError if source, a path under the results directory, is
+    too long for the manifest's SOURCE column, which would silently truncate
+    it and so lose or confuse its row.
+    """
+    if len(source) > SOURCEBYTES:
+	raise ValueError("Source path longer than %d bytes: %s"
+			 % (SOURCEBYTES, source))
+
+
+def isCurrent(entry, fName):
+    """True if the file fName is unchanged since it was recorded in entry,
+    a readManifest() row dictionary (or None).
+    """
+    if entry is None:
+	return False
+    size, mtime = skimReaders.sourceStat(fName)
+    if size != entry['SIZE']:
+	return False
+    if mtime == entry['MTIME']:
+	return True
+    if entry['CHECKSUM'] == NOCHECKSUM:
+	return False
+    return checksum(fName) == entry['CHECKSUM']
+
+
+def isPending(skyFile, entries, nodePath, source, fName, logger=None):
+    """True if the node nodePath, written from the file fName (source being
+    its path under the results directory), has to be built.  A node that
+    exists but is stale or half-written is removed here.  Raises ValueError
+    for a source the manifest cannot hold, see checkSource(), before anything
+    is built from it.
+    """
+    checkSource(source)
+    if nodePath not in skyFile:
+	return True
+    entry = entries.get(source)
+    if entry is not None and entry['NODE'] == nodePath and isCurrent(entry, fName):
+	if logger:
+	    logger.debug("Unchanged, keeping " + nodePath)
+	return False
+    if logger:
+	logger.info("Replacing stale or incomplete " + nodePath)
+    skyFile.removeNode(nodePath, recursive=True)
+    return True
+
+
+def pendingSubbands(skyFile, entries, nameStruct, resultsPath, logger=None):
+    """Returns the records of nameStruct whose Image groups have to be built,
+    see isPending().
+    """
+    return [sBand for sBand in nameStruct
+	    if isPending(skyFile, entries, '/'+sBand[1], sBand[-1],
+			 join(resultsPath, sBand[-1]), logger)]
+
+
+def record(skyFile, manifest, source, fName, nodePath, withChecksum=False):
+    """Record the completed node nodePath, written from the file fName, in
+    the manifest, replacing any earlier row for source.  The node's data are
+    flushed to disk before its manifest row is, so a row never vouches for
+    unwritten data.  With withChecksum, the checksum is computed here, so
+    fName is read once more; else NOCHECKSUM is recorded.
+    """
+    checkSource(source)
+    skyFile.flush()
+    for rowNum in reversed(manifest.getWhereList('SOURCE == src',
+						 condvars={'src': source})):
+	manifest.removeRows(rowNum, rowNum+1)
+    size, mtime = skimReaders.sourceStat(fName)
+    row = manifest.row
+    row['SOURCE']   = source
+    row['SIZE']     = size
+    row['MTIME']    = mtime
+    row['CHECKSUM'] = NOCHECKSUM
+    if withChecksum:
+	row['CHECKSUM'] = checksum(fName)
+    row['NODE']     = nodePath
+    row.append()
+    manifest.flush()
+    skyFile.flush()
+    return
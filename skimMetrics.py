@@ -0,0 +1,267 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Build metrics.
+#
+# Running totals of the seconds, bytes and count of each stage of a skim
+# build, kept in this process:
+#
+# discover:     finding and naming the subband images
+# read:         waiting on the ingest pipeline for the next image tile
+# write:        writing image tiles into HDF5 datasets
+# attributes:   writing group attribute sets
+#
+# and besides those, named counters, gauges (last and highest value, eg. of
+# the ingest queue depth) and observations (eg. of the read, write and
+# attribute seconds of each subband, see subbandDone()), summarized by
+# their quantiles.  They cost a time.time() call or two per tile or group,
+# and are always on.  reset() before a build; after it, snapshot() for the
+# stage totals, report() for everything, or write() it to a JSON summary or
+# a Prometheus text file.
+#
+# Progress is the one-line console display of a build's progress.
+
+import sys
+import time
+import json
+import os
+
+PROMETHEUS_SUFFIXES = ('.prom',)
+PROMETHEUS_PREFIX   = "skim"
+PROGRESS_INTERVAL   = 1.0       # seconds between progress line updates
+QUANTILES           = (0.5, 0.9, 0.99)
+
+_stages   = {}
+_counters = {}
+_gauges   = {}
+_observed = {}
+
+
+def reset():
+    """Zero all metrics."""
+    _stages.clear()
+    _counters.clear()
+    _gauges.clear()
+    _observed.clear()
+    return
+
+
+def add(stage, seconds, nbytes=0, count=1):
+    """Add seconds, nbytes and count to the totals of stage."""
+    totals = _stages.get(stage)
+    if totals is None:
+	totals = _stages[stage] = [0.0, 0, 0]
+    totals[0] += seconds
+    totals[1] += nbytes
+    totals[2] += count
+    return
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    _counters[name] = _counters.get(name, 0) + n
+    return
+
+
+def gauge(name, value):
+    """Set the gauge name to value, keeping its highest value too."""
+    last = _gauges.get(name)
+    if last is None or value > last[1]:
+	_gauges[name] = [value, value]
+    else:
+	last[0] = value
+    return
+
+
+def observe(name, value):
+    """Add one observation, eg. a latency, of name."""
+    _observed.setdefault(name, []).append(value)
+    return
+
+
+def timeTiles(tiles, stage='read'):
+    """Generator, passes on each (key, dataTile) of tiles, adding the time
+    spent waiting for it, and its bytes, to stage.
+    """
+    tiles = iter(tiles)
+    while True:
+	start = time.time()
+	try:
+	    key, dataTile = tiles.next()
+	except StopIteration:
+	    return
+	add(stage, time.time() - start, dataTile.nbytes)
+	yield key, dataTile
+
+
+def mark():
+    """Returns the seconds of each stage so far, for subbandDone()."""
+    return dict([(stage, totals[0]) for stage, totals in _stages.items()])
+
+
+def subbandDone(since):
+    """Count a subband done, observing the read, write and attribute
+    seconds it took since the mark() since.
+    """
+    for stage in ('read', 'write', 'attributes'):
+	seconds = _stages.get(stage, [0.0])[0] - since.get(stage, 0.0)
+	observe('subband_' + stage + '_seconds', seconds)
+    count('subbands')
+    return
+
+
+def summary(values):
+    """Returns the count, sum, min, max, mean and QUANTILES of values."""
+    values = sorted(values)
+    result = {'count': len(values),
+	      'sum':   sum(values),
+	      'min':   values and values[0] or 0,
+	      'max':   values and values[-1] or 0,
+	      'mean':  values and sum(values) / float(len(values)) or 0,
+	      }
+    for q in QUANTILES:
+	result['p%g' % (100 * q)] = values and values[min(len(values) - 1,
+							   int(q * len(values)))] or 0
+    return result
+
+
+def snapshot():
+    """Returns the stage totals as a dictionary of dictionaries by stage,
+    with keys seconds, bytes and count.
+    """
+    stages = {}
+    for stage, (seconds, nbytes, n) in _stages.items():
+	stages[stage] = {'seconds': seconds, 'bytes': nbytes, 'count': n}
+    return stages
+
+
+def report(extra=None):
+    """Returns all metrics as one dictionary, with keys stages, counters
+    (with bytes_read and bytes_written from the stages), gauges ({'last',
+    'max'} of each), summaries (see summary()) and those of extra.
+    """
+    stages   = snapshot()
+    counters = dict(_counters)
+    counters['bytes_read']    = stages.get('read', {}).get('bytes', 0)
+    counters['bytes_written'] = stages.get('write', {}).get('bytes', 0)
+    result = {'stages':    stages,
+	      'counters':  counters,
+	      'gauges':    dict([(name, {'last': last, 'max': top})
+				 for name, (last, top) in _gauges.items()]),
+	      'summaries': dict([(name, summary(values))
+				 for name, values in _observed.items()]),
+	      }
+    if extra:
+	result.update(extra)
+    return result
+
+
+def prometheus(extra=None, prefix=PROMETHEUS_PREFIX):
+    """Returns the metrics of report() in the Prometheus text format.  The
+    numbers of extra become gauges.
+    """
+    result = report()
+    lines  = []
+
+    def metric(name, kind, helpText, samples):
+	lines.append("# HELP %s_%s %s" % (prefix, name, helpText))
+	lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+	for suffix, labels, value in samples:
+	    lines.append("%s_%s%s%s %r" % (prefix, name, suffix, labels, float(value)))
+	return
+
+    for field, helpText in (('seconds', 'Seconds spent in each build stage.'),
+			    ('bytes',   'Bytes through each build stage.'),
+			    ('count',   'Operations of each build stage.')):
+	metric('stage_' + field + '_total', 'counter', helpText,
+	       [('', '{stage="%s"}' % stage, totals[field])
+		for stage, totals in sorted(result['stages'].items())])
+    for name, value in sorted(result['counters'].items()):
+	metric(name + '_total', 'counter', 'Count of ' + name + '.',
+	       [('', '', value)])
+    for name, values in sorted(result['gauges'].items()):
+	metric(name, 'gauge', 'Last value of ' + name + '.', [('', '', values['last'])])
+	metric(name + '_max', 'gauge', 'Highest value of ' + name + '.',
+	       [('', '', values['max'])])
+    for name, values in sorted(result['summaries'].items()):
+	metric(name, 'summary', 'Summary of ' + name + '.',
+	       [('', '{quantile="%g"}' % q, values['p%g' % (100 * q)]) for q in QUANTILES] +
+	       [('_sum', '', values['sum']), ('_count', '', values['count'])])
+    for name, value in sorted((extra or {}).items()):
+	if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+	    metric(name, 'gauge', name + ' of the build.', [('', '', value)])
+    return "\n".join(lines) + "\n"
+
+
+def write(fName, extra=None):
+    """Write the metrics to fName: as a Prometheus text file if it is named
+    *.prom, else as a JSON summary.  extra is as for report().  The file is
+    replaced atomically, so a collector never reads half of it.
+    """
+    tmpName = fName + ".tmp"
+    fob = open(tmpName, "w")
+    try:
+	if fName.endswith(PROMETHEUS_SUFFIXES):
+	    fob.write(prometheus(extra))
+	else:
+	    json.dump(report(extra), fob, indent=1, sort_keys=True)
+    finally:
+	fob.close()
+    os.rename(tmpName, fName)
+    return
+
+
+class Progress(object):
+    """One-line console progress of a build through total subbands,
+    rewritten in place at most every interval seconds, with the read and
+    write rates.  By default it is only shown if stream, sys.stderr unless
+    given, is a terminal, so logs are not filled with it.
+    """
+
+    def __init__(self, total, stream=None, interval=PROGRESS_INTERVAL, show=None):
+	self.total    = total
+	self.stream   = stream or sys.stderr
+	self.interval = interval
+	if show is None:
+	    show = hasattr(self.stream, 'isatty') and self.stream.isatty()
+	self.show     = show
+	self.done     = 0
+	self.start    = time.time()
+	self.last     = 0.0
+	self.shown    = False
+
+    def line(self):
+	"""The progress line."""
+	elapsed = max(time.time() - self.start, 1e-6)
+	stages  = snapshot()
+	readMB  = stages.get('read', {}).get('bytes', 0) / 1e6
+	writeMB = stages.get('write', {}).get('bytes', 0) / 1e6
+	text    = "%d/%d subbands  %.1f MB/s read  %.1f MB/s written  %ds" % (
+	    self.done, self.total, readMB / elapsed, writeMB / elapsed, elapsed)
+	if 0 < self.done < self.total:
+	    text += "  ETA %ds" % (elapsed * (self.total - self.done) / self.done)
+	return text
+
+    def update(self, n=1):
+	"""n more subbands done."""
+	self.done += n
+	now = time.time()
+	if self.show and (now - self.last >= self.interval or self.done >= self.total):
+	    self.stream.write("\r" + self.line().ljust(79))
+	    self.stream.flush()
+	    self.last  = now
+	    self.shown = True
+	return
+
+    def close(self):
+	"""End the progress line."""
+	if self.shown:
+	    self.stream.write("\n")
+	    self.stream.flush()
+	    self.shown = False
+	return
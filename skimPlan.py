@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Build planner.
+#
+# Predicts the skim file a build would write, without writing it: every
+# group, dataset and table, with the attributes of each group from the
+# attribute schemas, dataset shapes and chunkshapes, their raw and estimated
+# stored sizes, and the build's wall time.  Discovery and group naming are
+# those of the build itself.
+#
+# Only image headers are read, through the header catalog where the results
+# directory has one (see skimCatalog), plus a few chunks of pixels, SAMPLES
+# in all, spread over the images.  Their read is timed, for the read rate,
+# and for a compressed build they are written through the build's filters
+# into a scratch file, for the compression ratio and rate.  PyTables is only
+# imported for that, for the stack, statistics and source layouts of a
+# --stack, --stats or --sources build, or to read the manifest of the file a
+# --resume build would add to.
+
+import sys
+import time
+import json
+import shutil
+import getopt
+import tempfile
+from   os.path import basename, exists, getsize, isdir, join
+import numpy
+import skimUtils
+import skimIngest
+import skimQuantize
+import skimPyramid
+import skimReaders
+import skimCatalog
+import groupNames
+import attributeSets
+
+SAMPLES = 8          # chunks of pixels sampled, over all images
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: '+ mod + ' [options] --run=yyyy-mm-ddThh:mm:ss obs\n\n' + \
+	'\tPlan the skim build of a pipeline run, with the same options as\n' + \
+	'\tskim: list the groups and datasets it would write, their shapes,\n' + \
+	'\tchunkshapes and sizes, and estimate its disk use and wall time.\n' + \
+	'\tOnly image headers, and a few sample chunks, are read.\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--json            write the plan as JSON\n' + \
+	'\t--samples=N       chunks sampled for the rate and compression\n' + \
+	'\t                  estimates (default '+str(SAMPLES)+', 0 reads no pixels)\n\n' + \
+	'\tFurther optional keyword arguments, as for skim:\n\n' + \
+	skimUtils.BUILD_USAGE
+    return useBurp
+
+
+def _node(nodes, path, kind, groupType=None, attrList=(), **info):
+    """Append the plan entry of one node to nodes."""
+    entry = {'path': path, 'kind': kind,
+	     'attributes': [key for key, value in attrList]}
+    if groupType:
+	entry['groupType'] = groupType
+    entry.update(info)
+    nodes.append(entry)
+    return entry
+
+
+def _dataset(nodes, path, kind, shape, chunkshape, fName=None, cube=False,
+	     quantize=None):
+    """Append the plan entry of an image dataset, float32 or quantized in
+    the mode quantize, with the chunk to sample from its image fName, if
+    any.
+    """
+    itemSize = skimIngest.ITEMSIZE
+    if quantize:
+	itemSize = skimQuantize.itemSize(quantize)
+    entry = _node(nodes, path, kind, shape=list(shape),
+		  chunkshape=list(chunkshape),
+		  rawBytes=int(numpy.prod(shape)) * itemSize)
+    # The float32 bytes read, twice for a quantized image, see
+    # skimQuantize.quantizer().
+    entry['_readBytes'] = int(numpy.prod(shape)) * skimIngest.ITEMSIZE
+    if quantize:
+	entry['quantize']    = quantize
+	entry['_readBytes'] *= 2
+    if fName:
+	entry['_source'] = (fName, cube)
+    return entry
+
+
+def _pyramid(nodes, where, planeShape, chunks):
+    """Append the plan entries of the pyramid levels of an image of the
+    plane shape planeShape, in the group where, see skimPyramid.  They are
+    binned from the tiles the image is written from, so read nothing more.
+    """
+    for n, shape in enumerate(skimPyramid.levelShapes(planeShape)):
+	entry = _dataset(nodes, where + '/' + skimPyramid.PYRAMIDNAME % (n + 1),
+			 'CArray', shape, skimIngest.chunkShape(shape, chunks))
+	entry['attributes'] = ['LEVEL', 'BINNING']
+	entry['_readBytes'] = 0
+    return
+
+
+def _pending(lofarFileName, nameStruct, resultsPath, aveImage):
+    """For a resumed build, returns a 3-tuple,
+
+    (nameStruct, aveBuilt, hasAverage),
+
+    the subset of nameStruct, and whether the average image, the build
+    would (re)write, see skimManifest, and whether the existing file has an
+    average image.  The existing file is only read.
+    """
+    import tables
+    import skimManifest
+    if not (exists(lofarFileName) and tables.isHDF5File(lofarFileName)):
+	return nameStruct, bool(aveImage), False
+    skyFile = tables.openFile(lofarFileName, mode="r")
+    try:
+	entries = {}
+	if skimManifest.SYSLOGGROUP + '/' + skimManifest.MANIFESTNAME in skyFile:
+	    entries = skimManifest.readManifest(
+		skyFile.getNode(skimManifest.SYSLOGGROUP, skimManifest.MANIFESTNAME))
+
+	def pending(nodePath, source):
+	    entry = entries.get(source)
+	    return not (nodePath in skyFile and entry is not None and
+			entry['NODE'] == nodePath and
+			skimManifest.isCurrent(entry, join(resultsPath, source)))
+
+	nameStruct = [sBand for sBand in nameStruct
+		      if pending('/'+sBand[1], sBand[-1])]
+	aveBuilt   = bool(aveImage) and pending('/AverageImages', aveImage)
+	hasAverage = '/AverageImages' in skyFile
+    finally:
+	skyFile.close()
+    return nameStruct, aveBuilt, hasAverage
+
+
+def layout(obs, runTimeLabel, tileBytes=skimIngest.TILEBYTES, chunks='plane',
+	   cube=False, stack=False, stackDepth=None, resume=False,
+	   fitsImages=None, average=False, pattern=None, recursive=False,
+	   quantize=None, pyramid=False, stats=False, sources=False,
+	   **ignored):
+    """Returns the plan of the nodes a skim.run() build with these keyword
+    arguments would write, in build order, as a dictionary with keys
+
+    file, resultsPath, images, kept, nodes,
+
+    nodes being a list of dictionaries with the path, kind and attributes
+    of each node, and for datasets their shape, chunkshape and rawBytes,
+    and quantize for a quantized one.  Subband images are sized as stored in
+    the quantize mode asked for, though one too wide in range for an
+    integer mode is stored as float32.  With pyramid, the pyramid levels of
+    each image follow its dataset; with stats, the /Statistics table and the
+    statistics attributes of each data group are planned, and with sources,
+    the sourceList table of each Source group.  Options that do not change
+    the layout are ignored.
+    """
+    lofarFileName       = skimUtils.mkOutFileName(obs, runTimeLabel)
+    resultsPath         = skimUtils.makePipeResultsPath(obs, runTimeLabel)
+    if fitsImages is None:
+	fitsImages = skimUtils.mkFitsImageList(resultsPath, pattern, recursive)
+    aveImage, imageList = fitsImages
+    skimCatalog.useCatalog(resultsPath, fitsImages)
+    nameStruct          = groupNames.GroupNames(imageList, pattern=pattern).makeGroupNames()
+    allBands            = nameStruct
+    nbands              = len(nameStruct)
+    aveBuilt            = bool(aveImage)
+    hasAverage          = False
+    if resume:
+	nameStruct, aveBuilt, hasAverage = _pending(lofarFileName, nameStruct,
+						    resultsPath, aveImage)
+
+    nodes      = []
+    attributes = attributeSets.AttributeSets()
+    attributes.initHeader('Root', obs=obs, nimages=len(imageList))
+    _node(nodes, '/', 'group', 'Root', attributes.attributeSet('Root'))
+    _node(nodes, '/SysLog', 'group', 'Syslog', attributeSets.groupAttributes('Syslog'))
+    _node(nodes, '/SysLog/manifest', 'table')
+
+    if aveBuilt:
+	aName = join(resultsPath, aveImage)
+	shape = skimReaders.slingShape(aName)
+	_node(nodes, '/AverageImages', 'group')
+	_dataset(nodes, '/AverageImages/averageImage', 'CArray', shape,
+		 skimIngest.chunkShape(shape, chunks), aName)
+	if pyramid:
+	    _pyramid(nodes, '/AverageImages', shape[-2:], chunks)
+    elif average and not aveImage and allBands and (nameStruct or not hasAverage):
+	shapes = set([skimReaders.slingShape(join(resultsPath, sBand[-1]))
+		      for sBand in allBands])
+	if len(shapes) == 1:
+	    shape = shapes.pop()
+	    _node(nodes, '/AverageImages', 'group')
+	    entry = _dataset(nodes, '/AverageImages/averageImage', 'CArray', shape,
+			     skimIngest.chunkShape(shape, chunks))
+	    # The images of kept subbands are read for the sum.
+	    entry['_readBytes'] = (int(numpy.prod(shape)) * skimIngest.ITEMSIZE *
+				   (nbands - len(nameStruct)))
+	    if pyramid:
+		_pyramid(nodes, '/AverageImages', shape, chunks)
+
+    statsAttrs = []
+    if stats:
+	import skimStats
+	statsAttrs = skimStats.ImageStats().attributes()
+	group      = '/' + skimStats.STATSGROUP
+	_node(nodes, group, 'group')
+	_node(nodes, group + '/' + skimStats.STATSNAME, 'table',
+	      attrList=[('PERCENTILES', None)])
+
+    if stack and nameStruct:
+	import skimStack
+	planeShape = skimReaders.slingShape(join(resultsPath, nameStruct[0][-1]))
+	chunkshape = skimStack.stackChunkShape(planeShape, stackDepth or skimStack.STACKDEPTH)
+	group      = '/' + skimStack.STACKGROUP
+	_node(nodes, group, 'group')
+	entry = _dataset(nodes, group + '/' + skimStack.STACKNAME, 'EArray',
+			 (len(nameStruct),) + tuple(planeShape), chunkshape)
+	entry['_sources'] = [join(resultsPath, sBand[-1]) for sBand in nameStruct]
+	_node(nodes, group + '/' + skimStack.INDEXNAME, 'table')
+
+    if sources:
+	import skimSources
+
+    for sBand in nameStruct:
+	fName  = join(resultsPath, sBand[-1])
+	imroot = '/' + sBand[1]
+	_node(nodes, imroot, 'group', 'Image', attributeSets.groupAttributes('Image'),
+	      source=sBand[-1])
+	dataGroup   = imroot + '/' + sBand[3]
+	datasetName = stack and skimStack.STACKNAME or "ImageDataArray_" + sBand[0]
+	_node(nodes, dataGroup, 'group', 'skyData',
+	      attributeSets.groupAttributes('skyData', DATASETNAME=datasetName) +
+	      statsAttrs)
+	if stack:
+	    _node(nodes, dataGroup + '/' + datasetName, 'link')
+	else:
+	    shape = skimReaders.slingShape(fName, cube)
+	    _dataset(nodes, dataGroup + '/' + datasetName, 'CArray', shape,
+		     skimIngest.chunkShape(shape, chunks), fName, cube,
+		     quantize)
+	    if pyramid:
+		_pyramid(nodes, dataGroup, shape[-2:], chunks)
+	wcs = skimReaders.slingWcs(fName)
+	_node(nodes, imroot + '/' + sBand[4], 'group', 'Coordinates',
+	      attributeSets.groupAttributes('Coordinates',
+					    **attributeSets.coordOverrides(wcs)))
+	_node(nodes, imroot + '/' + sBand[4] + '/LinearCoord', 'group', 'LinearCoord',
+	      attributeSets.groupAttributes('LinearCoord',
+					    **attributeSets.linearOverrides(wcs)))
+	_node(nodes, imroot + '/' + sBand[5], 'group', 'Source',
+	      attributeSets.groupAttributes('Source'))
+	if sources:
+	    _node(nodes, imroot + '/' + sBand[5] + '/' + skimSources.SOURCENAME,
+		  'table', attrList=[('ANALYSIS', None), ('DETECT', None),
+				     ('MINPIXELS', None), ('BOX', None)])
+	_node(nodes, imroot + '/' + sBand[6], 'group', 'ProcessHist',
+	      attributeSets.groupAttributes('ProcessHist'))
+
+    return {'file':        lofarFileName,
+	    'resultsPath': resultsPath,
+	    'images':      len(nameStruct),
+	    'kept':        nbands - len(nameStruct),
+	    'nodes':       nodes,
+	    }
+
+
+def _sampleKeys(dataShape, chunkshape, nsamples):
+    """Index tuples of up to nsamples whole chunks of a dataset, evenly
+    spaced through it in chunk order.
+    """
+    grid   = [max(1, -(-dim // size)) for dim, size in zip(dataShape, chunkshape)]
+    nchunk = int(numpy.prod(grid))
+    keys   = []
+    for n in range(min(nsamples, nchunk)):
+	idx = numpy.unravel_index(n * nchunk // nsamples, grid)
+	key = []
+	for i, dim, size in zip(idx, dataShape, chunkshape):
+	    start = max(0, min(i * size, dim - size))
+	    key.append(slice(start, min(start + size, dim)))
+	keys.append(tuple(key))
+    return keys
+
+
+def sampleChunks(nodes, samples=SAMPLES):
+    """Read up to samples chunks, spread over the datasets of nodes, and
+    return a 3-tuple,
+
+    (tiles, nbytes, seconds),
+
+    the float32 chunk arrays, their bytes, and the time taken to read them.
+    """
+    sources = []
+    for entry in nodes:
+	if '_source' in entry:
+	    fName, cube = entry['_source']
+	    sources.append((fName, cube, entry['shape'], entry['chunkshape']))
+	elif '_sources' in entry:
+	    for fName in entry['_sources']:
+		sources.append((fName, False, entry['shape'][1:],
+				entry['chunkshape'][1:]))
+    tiles = []
+    if not sources or samples <= 0:
+	return tiles, 0, 0.0
+    nsources = min(samples, len(sources))
+    start    = time.time()
+    for n in range(nsources):
+	fName, cube, shape, chunkshape = sources[n * len(sources) // nsources]
+	keys = _sampleKeys(shape, chunkshape, samples // nsources)
+	for key, dataTile in skimReaders.slingTiles(fName, keys, cube):
+	    tiles.append(numpy.array(dataTile, dtype=numpy.float32))
+    seconds = time.time() - start
+    return tiles, sum([tile.nbytes for tile in tiles]), seconds
+
+
+def quantizeSamples(tiles, mode, maxError=skimQuantize.MAXERROR):
+    """Returns the sample tiles as a build quantizing in mode would store
+    them, each quantized by its own range and noise.  The build takes the
+    range of the whole image, which the samples need not show, so for the
+    integer modes, whose offset it sets, their compression is rough.
+    """
+    stored = []
+    for tile in tiles:
+	finite = tile[numpy.isfinite(tile)]
+	lo = hi = None
+	if len(finite):
+	    lo, hi = finite.min(), finite.max()
+	quantizer = skimQuantize.Quantizer(mode, lo, hi,
+					   skimQuantize.noise(tile), maxError)
+	stored.append(quantizer.quantize(tile.copy()))
+    return stored
+
+
+def compression(tiles, filters, tmpDir=None):
+    """Write the sample tiles, each as one chunk of its own type, through
+    filters into a scratch HDF5 file.  Returns the 2-tuple (ratio, seconds)
+    of the raw to stored bytes and the time the writes took.
+    """
+    import tables
+    scratch = tempfile.mkdtemp(prefix='skimPlan', dir=tmpDir)
+    try:
+	sizes = []
+	for write in (False, True):
+	    # The empty file's size is that of everything but the chunks.
+	    h5Name = join(scratch, write and 'samples.h5' or 'empty.h5')
+	    h5File = tables.openFile(h5Name, mode="w")
+	    start  = time.time()
+	    for n in range(len(tiles)):
+		cArr = h5File.createCArray(h5File.root, 'sample%d' % n,
+					   tables.Atom.from_dtype(tiles[n].dtype),
+					   tiles[n].shape,
+					   filters=filters, chunkshape=tiles[n].shape)
+		if write:
+		    cArr[...] = tiles[n]
+	    h5File.close()
+	    writeTime = time.time() - start
+	    sizes.append(getsize(h5Name))
+    finally:
+	shutil.rmtree(scratch, ignore_errors=True)
+    nbytes = sum([tile.nbytes for tile in tiles])
+    return nbytes / float(max(sizes[1] - sizes[0], 1)), writeTime
+
+
+def plan(obs, runTimeLabel, samples=SAMPLES, **buildOpts):
+    """Returns the plan of a skim.run(obs, runTimeLabel, **buildOpts) build:
+    the layout() dictionary, each dataset entry with its estimated stored
+    bytes, estBytes, and the totals
+
+    rawBytes, estBytes, ratio, readRate, writeRate, seconds,
+
+    rates in bytes per second, measured on samples chunks (None if not
+    measured), and seconds the estimated wall time of the build (None
+    without a read rate).  With quantize, the compression of quantized
+    datasets is measured on the samples quantized, see quantizeSamples().
+    """
+    result  = layout(obs, runTimeLabel, **buildOpts)
+    nodes   = result['nodes']
+    tiles, nbytes, readTime = sampleChunks(nodes, samples)
+    ratio     = 1.0
+    qratio    = 1.0
+    writeRate = None
+    complib   = buildOpts.get('complib')
+    complevel = buildOpts.get('complevel')
+    quantize  = buildOpts.get('quantize')
+    if tiles and (complib or complevel):
+	import skimFilters
+	filters = skimFilters.makeFilters(complib, complevel,
+					  buildOpts.get('shuffle', True),
+					  buildOpts.get('bitshuffle', False))
+	ratio, writeTime = compression(tiles, filters)
+	if quantize:
+	    stored = quantizeSamples(tiles, quantize,
+				     buildOpts.get('maxError', skimQuantize.MAXERROR))
+	    qratio, writeTime = compression(stored, filters)
+	    nbytes = sum([tile.nbytes for tile in stored])
+	writeRate = nbytes / max(writeTime, 1e-6)
+
+    rawBytes  = 0
+    estBytes  = 0
+    readBytes = 0
+    for entry in nodes:
+	entry.pop('_source', None)
+	entry.pop('_sources', None)
+	readBytes += entry.pop('_readBytes', 0)
+	if 'rawBytes' in entry:
+	    entry['estBytes'] = int(entry['rawBytes'] /
+				    (entry.get('quantize') and qratio or ratio))
+	    rawBytes += entry['rawBytes']
+	    estBytes += entry['estBytes']
+    if estBytes:
+	ratio = rawBytes / float(estBytes)
+
+    readRate = None
+    seconds  = None
+    if nbytes and readTime > 0:
+	# The rate of one reader: reader processes share the disk, and the
+	# HDF5 writer is one process, so more workers are not counted on.
+	readRate = sum([tile.nbytes for tile in tiles]) / readTime
+	rate     = readRate
+	if buildOpts.get('bandwidth'):
+	    rate = min(rate, buildOpts['bandwidth'])
+	seconds = readBytes / rate
+	if writeRate:
+	    seconds = max(seconds, rawBytes / writeRate)
+    result.update({'rawBytes':  rawBytes,
+		   'estBytes':  estBytes,
+		   'ratio':     ratio,
+		   'readRate':  readRate,
+		   'writeRate': writeRate,
+		   'seconds':   seconds,
+		   })
+    return result
+
+
+def report(result):
+    print
+    print "Plan of", result['file']
+    print
+    for entry in result['nodes']:
+	line = "%-52s %-7s" % (entry['path'], entry['kind'])
+	if entry['attributes']:
+	    line += " %3d attrs" % len(entry['attributes'])
+	if 'shape' in entry:
+	    line += "  %s, chunks %s, %.1f MB -> %.1f MB" % (
+		"x".join([str(n) for n in entry['shape']]),
+		"x".join([str(n) for n in entry['chunkshape']]),
+		entry['rawBytes'] / 1e6, entry['estBytes'] / 1e6)
+	print line
+    print
+    print "%d subband images to write, %d kept" % (result['images'], result['kept'])
+    print "Image data %.1f MB, estimated %.1f MB stored (ratio %.2f)" % (
+	result['rawBytes'] / 1e6, result['estBytes'] / 1e6, result['ratio'])
+    if result['seconds'] is not None:
+	print "Sampled read %.1f MB/s%s, estimated wall time %.1f s" % (
+	    result['readRate'] / 1e6,
+	    result['writeRate'] and ", compressed write %.1f MB/s" % (result['writeRate'] / 1e6) or "",
+	    result['seconds'])
+    print
+    return
+
+
+def handleCLargs(args):
+    """Parse the command line, args being sys.argv.  Returns a 4-tuple,
+
+    (observation, runTimeLabel, asJson, planOpts),
+
+    where planOpts is a dictionary of keyword arguments for plan().
+    """
+    mod = basename(args[0])
+    long_options = ['help', 'run=', 'json', 'samples='] + skimUtils.BUILD_OPTIONS
+    try:
+	opts, arg = getopt.getopt(args[1:], '', long_options)
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if len(arg) != 1:
+	sys.exit(usage(mod))
+
+    runTimeLabel = None
+    asJson       = False
+    planOpts     = {}
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--run",):
+	    runTimeLabel = a
+	elif o in ("--json",):
+	    asJson = True
+	elif o in ("--samples",):
+	    planOpts['samples'] = skimUtils.intArg(o, a)
+	elif skimUtils.buildOption(o, a, planOpts):
+	    pass
+	else:
+	    sys.exit(usage(mod))
+    if runTimeLabel is None:
+	sys.exit(usage(mod))
+    if not isdir(skimUtils.makePipeResultsPath(arg[0], runTimeLabel)):
+	sys.exit("\n\n\tError: Path to directory "+runTimeLabel+" not found.\n")
+    return arg[0], runTimeLabel, asJson, planOpts
+
+
+if __name__ == '__main__':
+    obs, runTimeLabel, asJson, planOpts = handleCLargs(sys.argv)
+    if planOpts.get('cube') and planOpts.get('stack'):
+	sys.exit("\n\n\tError: Subband cubes cannot be stacked; use --cube or --stack.\n")
+    if planOpts.get('quantize') and planOpts.get('stack'):
+	sys.exit("\n\n\tError: Stacked subbands cannot be quantized; use --quantize or --stack.\n")
+    if planOpts.get('pyramid') and planOpts.get('stack'):
+	sys.exit("\n\n\tError: Stacked subbands have no pyramids; use --pyramid or --stack.\n")
+    if planOpts.get('sources') and planOpts.get('stack'):
+	sys.exit("\n\n\tError: Sources are not found in stacked subbands; use --sources or --stack.\n")
+    result = plan(obs, runTimeLabel, **planOpts)
+    if asJson:
+	print json.dumps(result, indent=1, sort_keys=True)
+    else:
+	report(result)
+    sys.exit(0)
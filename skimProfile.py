@@ -0,0 +1,245 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Build profiling.
+#
+# With start(profileDir), the named regions of a skim build are profiled,
+# each by a cProfile.Profile of its own, accumulated over all its calls:
+#
+# discover:      finding and naming the subband images
+# data:          reading and writing the image tiles of a dataset
+# createCArray:  creating the image datasets
+# attributes:    writing group attribute sets
+# finish:        closing the skim file
+#
+# Where tracemalloc is available, the memory allocated in each call of a
+# region is traced too, and summed by source line.  stop() writes into
+# profileDir, for each region,
+#
+# <region>.prof        the cProfile stats, for pstats or snakeviz
+# <region>.txt         the 40 functions of most cumulative time
+# <region>.alloc.txt   the 40 source lines that allocated the most memory
+#
+# and profile.collapsed, the call stacks of all regions merged, each rooted
+# at its region, in the collapsed-stack format of flamegraph.pl and
+# speedscope: one 'region;caller;...;function microseconds' line per stack.
+# cProfile keeps only caller -> callee times, so these stacks are estimated
+# by dividing each function's time among its callers in proportion.
+#
+# Regions nest; an inner region pauses the profiler of the outer one.  Until
+# start(), a profiled() function or a call() costs one test of a global.
+
+import os
+import pstats
+import cProfile
+from   os.path import basename, join, splitext
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+COLLAPSEDNAME = "profile.collapsed"
+TOPLINES      = 40
+
+_profileDir = None
+_profiles   = {}        # region: cProfile.Profile
+_allocs     = {}        # region: {(file, line): [bytes, count]}
+_active     = []        # stack of (region, tracemalloc snapshot or None)
+_tracing    = False     # tracemalloc started here
+
+
+def enabled():
+    """True while profiling."""
+    return _profileDir is not None
+
+
+def start(profileDir):
+    """Start profiling regions, for stop() to write into profileDir."""
+    global _profileDir, _tracing
+    if not os.path.isdir(profileDir):
+	os.makedirs(profileDir)
+    _profiles.clear()
+    _allocs.clear()
+    del _active[:]
+    _profileDir = profileDir
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+	tracemalloc.start()
+	_tracing = True
+    return
+
+
+def _snapshot():
+    """tracemalloc snapshot, less the allocations of tracemalloc and of this
+    module.
+    """
+    return tracemalloc.take_snapshot().filter_traces(
+	[tracemalloc.Filter(False, tracemalloc.__file__),
+	 tracemalloc.Filter(False, splitext(__file__)[0] + ".py")])
+
+
+def begin(region):
+    """Enter the named region, pausing the region it is in."""
+    if _active:
+	_profiles[_active[-1][0]].disable()
+    snapshot = None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+	snapshot = _snapshot()
+    _active.append((region, snapshot))
+    profile = _profiles.get(region)
+    if profile is None:
+	profile = _profiles[region] = cProfile.Profile()
+    profile.enable()
+    return
+
+
+def end():
+    """Leave the innermost region, resuming the one it is in."""
+    region, before = _active.pop()
+    _profiles[region].disable()
+    if before is not None:
+	allocs = _allocs.setdefault(region, {})
+	for stat in _snapshot().compare_to(before, 'lineno'):
+	    if stat.size_diff <= 0:
+		continue
+	    frame = stat.traceback[0]
+	    total = allocs.setdefault((frame.filename, frame.lineno), [0, 0])
+	    total[0] += stat.size_diff
+	    total[1] += stat.count_diff
+    if _active:
+	_profiles[_active[-1][0]].enable()
+    return
+
+
+def call(region, func, *args, **kwargs):
+    """Returns func(*args, **kwargs), called in the named region if
+    profiling.
+    """
+    if _profileDir is None:
+	return func(*args, **kwargs)
+    begin(region)
+    try:
+	return func(*args, **kwargs)
+    finally:
+	end()
+
+
+def profiled(region):
+    """Decorator, making every call of a function a call() in region."""
+    def decorate(func):
+	def profiledFunc(*args, **kwargs):
+	    if _profileDir is None:
+		return func(*args, **kwargs)
+	    return call(region, func, *args, **kwargs)
+	profiledFunc.__name__ = func.__name__
+	profiledFunc.__doc__  = func.__doc__
+	return profiledFunc
+    return decorate
+
+
+def _label(func):
+    """Collapsed-stack frame name of a pstats function key."""
+    fileName, line, name = func
+    if fileName == '~':
+	return name
+    return "%s (%s:%d)" % (name, basename(fileName), line)
+
+
+def _isOwn(func):
+    """True for a pstats function key of this module, or of the profiler."""
+    fileName, line, name = func
+    return (splitext(fileName)[0] == splitext(__file__)[0] or
+	    name.startswith("<method 'disable' of '_lsprof.Profiler'"))
+
+
+def collapsed(stats, root):
+    """Returns the collapsed-stack lines, rooted at root, of the pstats.Stats
+    stats.  The time of a function called by several callers is divided
+    among them in proportion to their cumulative times through it.
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+	for caller, edge in callers.items():
+	    callees.setdefault(caller, []).append((func, edge[3]))
+    lines = []
+
+    def walk(func, stack, share, path):
+	cc, nc, tt, ct, callers = stats.stats[func]
+	stack = stack + [_label(func)]
+	if tt * share > 0:
+	    lines.append("%s %d" % (";".join(stack), int(round(tt * share * 1e6))))
+	for callee, edgeTime in callees.get(func, []):
+	    calleeTime = stats.stats[callee][3]
+	    if callee in path or edgeTime <= 0 or calleeTime <= 0:
+		continue
+	    walk(callee, stack, share * min(1.0, edgeTime / calleeTime),
+		 path | set([callee]))
+	return
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+	# Roots are the functions called from outside the region, less the
+	# ends of end() and Profile.disable() that close it.
+	if callers or _isOwn(func):
+	    continue
+	walk(func, [root], 1.0, set([func]))
+    return lines
+
+
+def stop():
+    """Stop profiling, and write the profiles.  Returns the list of files
+    written.
+    """
+    global _profileDir, _tracing
+    profileDir = _profileDir
+    if profileDir is None:
+	return []
+    while _active:
+	end()
+    _profileDir = None
+    if _tracing:
+	tracemalloc.stop()
+	_tracing = False
+    written = []
+    lines   = []
+    for region, profile in sorted(_profiles.items()):
+	profile.create_stats()
+	if not profile.stats:
+	    continue
+	stats    = pstats.Stats(profile)
+	fileName = join(profileDir, region + ".prof")
+	stats.dump_stats(fileName)
+	written.append(fileName)
+	fileName = join(profileDir, region + ".txt")
+	fob = open(fileName, "w")
+	try:
+	    pstats.Stats(profile, stream=fob).sort_stats('cumulative').print_stats(TOPLINES)
+	finally:
+	    fob.close()
+	written.append(fileName)
+	lines.extend(collapsed(stats, region))
+    for region, allocs in sorted(_allocs.items()):
+	fileName = join(profileDir, region + ".alloc.txt")
+	fob = open(fileName, "w")
+	try:
+	    fob.write("%12s %9s  %s\n" % ("bytes", "blocks", "line"))
+	    top = sorted(allocs.items(), key=lambda item: -item[1][0])[:TOPLINES]
+	    for (source, line), (nbytes, count) in top:
+		fob.write("%12d %9d  %s:%d\n" % (nbytes, count, source, line))
+	finally:
+	    fob.close()
+	written.append(fileName)
+    fileName = join(profileDir, COLLAPSEDNAME)
+    fob = open(fileName, "w")
+    try:
+	fob.write("\n".join(lines) + (lines and "\n" or ""))
+    finally:
+	fob.close()
+    written.append(fileName)
+    _profiles.clear()
+    _allocs.clear()
+    return written
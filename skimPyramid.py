@@ -0,0 +1,176 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Image pyramids.
+#
+# Next to an image dataset, its pyramid: the datasets Pyramid1, Pyramid2, ...
+# of its first image plane binned 2x2, 4x4, ..., down to the first level no
+# larger than MINSIZE on either side.  A level pixel is the mean of the
+# finite ones of the 2x2 pixels it covers in the level above, NaN if there
+# are none; an odd last row or column is binned with what there is.  So a
+# quick look or a thumbnail reads a level of about its own size, see
+# preview(): 1 MB for a 512 pixel preview of an 8k image, rather than its
+# 256 MB plane.  In all, the levels add a third to the size of a plane.
+#
+# Levels are built from the ingest tiles as they pass, see Pyramid.tiles(),
+# with no read of their own: each level bins row pairs of the level above
+# as soon as they are there, and keeps at most one odd row back, so memory
+# stays within a tile.  Each level dataset carries its LEVEL and BINNING.
+
+import numpy
+import skimIngest
+import skimProfile
+
+PYRAMIDNAME = "Pyramid%d"
+MINSIZE     = 64
+
+
+def levelShapes(planeShape, minSize=MINSIZE):
+    """Returns the list of (nrows, ncols) shapes of the pyramid levels of an
+    image plane of shape planeShape.
+    """
+    shapes       = []
+    nrows, ncols = planeShape
+    while max(nrows, ncols) > minSize:
+	nrows, ncols = (nrows + 1) // 2, (ncols + 1) // 2
+	shapes.append((nrows, ncols))
+    return shapes
+
+
+def halve(rows):
+    """Returns the float32 2x2 bins of the (nrows, ncols) array rows, nrows
+    being even, or 1 for a last odd row: the mean of the finite values of
+    each bin, NaN if there are none.
+    """
+    finite = numpy.isfinite(rows)
+    if len(rows) > 1 and not rows.shape[1] % 2 and finite.all():
+	# The usual case, without the counts.
+	total  = rows[0::2].astype(numpy.float32)
+	total += rows[1::2]
+	total  = total[:, 0::2] + total[:, 1::2]
+	total *= 0.25
+	return total
+    values = numpy.where(finite, rows, numpy.float32(0))
+    values = values.astype(numpy.float32, copy=False)
+    counts = finite.astype(numpy.int8)
+    if len(rows) > 1:
+	values = values[0::2] + values[1::2]
+	counts = counts[0::2] + counts[1::2]
+    half   = rows.shape[1] // 2
+    total  = values[:, 0::2].copy()
+    number = counts[:, 0::2].copy()
+    total[:, :half]  += values[:, 1::2]
+    number[:, :half] += counts[:, 1::2]
+    total /= numpy.maximum(number, 1)
+    total[number == 0] = numpy.nan
+    return total
+
+
+class Pyramid(object):
+    """The pyramid of an image dataset of the plane shape planeShape, its
+    level datasets made in the group where of the open tables file skyFile,
+    with filters and under the chunk policy chunks, see skimIngest.
+    add() the tiles of the image, in row order, then close().
+    """
+
+    def __init__(self, skyFile, where, planeShape, filters=None, chunks='plane',
+		 minSize=MINSIZE):
+	import tables
+	self.levels  = []
+	self.pending = []
+	self.written = []
+	for n, shape in enumerate(levelShapes(planeShape, minSize)):
+	    cArr = skimProfile.call('createCArray', skyFile.createCArray, where,
+				    PYRAMIDNAME % (n + 1),
+				    tables.Float32Atom(),
+				    shape,
+				    filters=filters or tables.Filters(),
+				    chunkshape=skimIngest.chunkShape(shape, chunks),
+				    title="Pyramid level %d, binned %dx%d" % (
+					n + 1, 2 ** (n + 1), 2 ** (n + 1)))
+	    attrs = cArr._v_attrs
+	    attrs.LEVEL   = n + 1
+	    attrs.BINNING = 2 ** (n + 1)
+	    self.levels.append(cArr)
+	    self.pending.append(None)
+	    self.written.append(0)
+
+    def _feed(self, n, rows):
+	"""Bin rows, the next rows of the level above level n, into level n,
+	and on down.
+	"""
+	if self.pending[n] is not None:
+	    rows = numpy.concatenate([self.pending[n], rows])
+	    self.pending[n] = None
+	even = len(rows) - len(rows) % 2
+	if even < len(rows):
+	    # The rows may be in a reused ingest buffer.
+	    self.pending[n] = rows[even:].copy()
+	if even:
+	    self._write(n, halve(rows[:even]))
+	return
+
+    def _write(self, n, binned):
+	"""Write the next rows, binned, of level n, and feed them on down."""
+	self.levels[n][self.written[n]:self.written[n] + len(binned)] = binned
+	self.written[n] += len(binned)
+	if n + 1 < len(self.levels):
+	    self._feed(n + 1, binned)
+	return
+
+    def add(self, key, dataTile):
+	"""Add the tile at key of the image dataset, a band of whole rows.
+	Tiles of planes other than the first are ignored, as by
+	skimIngest.ImageSum.
+	"""
+	if not self.levels:
+	    return
+	for idx in key[:-2]:
+	    if not isinstance(idx, slice) and idx != 0:
+		return
+	plane = dataTile.reshape((-1,) + dataTile.shape[-2:])[0]
+	self._feed(0, plane)
+	return
+
+    def tiles(self, tiles):
+	"""Generator, passes on each (key, dataTile) of tiles, adding each."""
+	for key, dataTile in tiles:
+	    self.add(key, dataTile)
+	    yield key, dataTile
+	return
+
+    def close(self):
+	"""Bin the last odd row of each level, if any."""
+	for n in range(len(self.levels)):
+	    if self.pending[n] is not None:
+		rows, self.pending[n] = self.pending[n], None
+		self._write(n, halve(rows))
+	return
+
+
+def levels(group):
+    """Returns the pyramid level datasets in the group, coarsest last."""
+    found = []
+    n = 1
+    while PYRAMIDNAME % n in group:
+	found.append(getattr(group, PYRAMIDNAME % n))
+	n += 1
+    return found
+
+
+def preview(group, size=512, dataset=None):
+    """Returns the coarsest pyramid level of the image in group that is at
+    least size pixels on its longer side, or dataset, the image dataset
+    itself, if none is; None if there is neither.
+    """
+    best = dataset
+    for level in levels(group):
+	if max(level.shape) < size:
+	    break
+	best = level
+    return best
@@ -0,0 +1,218 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Quantized image storage.
+#
+# Restored images are noise limited: bits below the noise carry nothing but
+# noise, and defeat compression.  With a quantize mode, each subband image
+# dataset is stored quantized, to a step set by the image's own noise, so
+# that no pixel is off by more than maxError times the noise:
+#
+# noise:  float32, each value rounded to a multiple of the step, QSTEP.  The
+#         low mantissa bits are then mostly zero, and shuffle + compression
+#         takes them out.  Read as any float32 dataset.
+# int16:  scaled integers, as FITS does it, value = BZERO + BSCALE * stored,
+# int8:   with stored == BLANK for NaN (and other non-finite) pixels.  Where
+#         the image's range will not fit the integer type at that step, the
+#         image is stored in the noise mode instead, so that the bound holds.
+#
+# The noise is the robust (median absolute deviation) standard deviation of
+# a sample of the image's finite pixels.  Quantized datasets carry the
+# attributes of their mode, and QMODE, QNOISE and QMAXERR, the actual bound
+# on the error of the float32 values read back: half the step, plus half a
+# float32 step at the largest value, for their rounding to float32.  The
+# scaling itself is done in float64, both ways.  dequantize() and
+# readData() give back float32 values with numpy, without a per-pixel loop
+# in python.
+#
+# A quantizer measures its image before the first tile is written: one read
+# through the image, for its range and noise sample, on top of the ingest.
+
+import numpy
+import skimIngest
+import skimReaders
+
+QUANTIZE_MODES = ('noise', 'int16', 'int8')
+MAXERROR       = 0.125      # of the noise, ie. a step of a quarter sigma
+SAMPLES        = 1000000    # pixels sampled for the noise
+
+_intTypes = {'int16': (numpy.int16, 'Int16Atom'),
+	     'int8':  (numpy.int8,  'Int8Atom')}
+
+
+def noise(sample):
+    """Returns the robust standard deviation of the values of sample, from
+    their median absolute deviation, or 0.0 if there are none.
+    """
+    sample = sample[numpy.isfinite(sample)]
+    if not len(sample):
+	return 0.0
+    return float(1.4826 * numpy.median(numpy.abs(sample - numpy.median(sample))))
+
+
+def imageStats(fName, cube=False, tileBytes=skimIngest.TILEBYTES,
+	       samples=SAMPLES):
+    """Read through the image fName, or with cube=True its full data cube.
+    Returns a 3-tuple,
+
+    (minimum, maximum, sigma),
+
+    of its finite pixels, minimum and maximum None if there are none, and
+    sigma the noise of a regular sample of about samples pixels.
+    """
+    dataShape = skimReaders.slingShape(fName, cube)
+    stride    = max(1, int(numpy.prod(dataShape)) // samples)
+    lo = hi   = None
+    picked    = []
+    buffers   = {}
+    for key in skimIngest.tileKeys(dataShape, tileBytes):
+	dataTile = skimIngest.readTile([fName], key, cube, buffers)
+	finite   = dataTile[numpy.isfinite(dataTile)]
+	if len(finite):
+	    if lo is None or finite.min() < lo:
+		lo = finite.min()
+	    if hi is None or finite.max() > hi:
+		hi = finite.max()
+	picked.append(dataTile.ravel()[::stride].copy())
+    return lo, hi, noise(numpy.concatenate(picked))
+
+
+class Quantizer(object):
+    """Quantizes the tiles of one image, in mode, one of QUANTIZE_MODES, at a
+    step of 2 * maxError * sigma, given its finite range, lo to hi, and its
+    noise, sigma, see imageStats().  Where the bound cannot hold in an
+    integer mode, mode becomes 'noise'.  With no noise to go by, the step is
+    that of the range, in an integer mode, or none at all.
+    """
+
+    def __init__(self, mode, lo, hi, sigma, maxError=MAXERROR):
+	if mode not in QUANTIZE_MODES:
+	    raise ValueError("Unknown quantize mode, "+str(mode)+
+			     ". Use one of "+", ".join(QUANTIZE_MODES))
+	if not maxError > 0:
+	    raise ValueError("The maximum quantization error must be > 0, got "+
+			     str(maxError))
+	self.sigma = sigma
+	self.step  = 2.0 * maxError * sigma
+	self.zero  = 0.0
+	self.top   = 0.0
+	if lo is not None:
+	    self.top = max(abs(float(lo)), abs(float(hi)))
+	if mode in _intTypes:
+	    if lo is None:
+		lo = hi = 0.0
+	    dtype     = _intTypes[mode][0]
+	    levels    = numpy.iinfo(dtype).max - numpy.iinfo(dtype).min - 1
+	    rangeStep = (float(hi) - float(lo)) / levels
+	    if not self.step:
+		self.step = rangeStep or 1.0
+	    if rangeStep > self.step:
+		mode = 'noise'
+	    else:
+		self.zero = (float(hi) + float(lo)) / 2.0
+	self.mode = mode
+
+    def atom(self):
+	"""The tables atom of the dataset."""
+	import tables
+	if self.mode in _intTypes:
+	    return getattr(tables, _intTypes[self.mode][1])()
+	return tables.Float32Atom()
+
+    def maxError(self):
+	"""The bound on the error of the values read back, as float32."""
+	if not self.step:
+	    return 0.0
+	ulp = float(numpy.spacing(numpy.float32(self.top + self.step)))
+	return self.step / 2.0 + ulp / 2.0
+
+    def attributes(self):
+	"""The (key, value) list of the dataset's quantization attributes."""
+	attrList = [('QMODE',   self.mode),
+		    ('QNOISE',  self.sigma),
+		    ('QMAXERR', self.maxError())]
+	if self.mode in _intTypes:
+	    attrList += [('BSCALE', self.step),
+			 ('BZERO',  self.zero),
+			 ('BLANK',  int(numpy.iinfo(_intTypes[self.mode][0]).min))]
+	else:
+	    attrList += [('QSTEP', self.step)]
+	return attrList
+
+    def quantize(self, dataTile):
+	"""Returns the quantized float32 dataTile, quantized in place, or for an
+	integer mode its scaled integers.
+	"""
+	if not self.step:
+	    return dataTile
+	steps  = numpy.subtract(dataTile, self.zero, dtype=numpy.float64)
+	steps *= 1.0 / self.step
+	numpy.rint(steps, out=steps)
+	if self.mode not in _intTypes:
+	    numpy.multiply(steps, self.step, out=dataTile, casting='unsafe')
+	    return dataTile
+	dtype  = _intTypes[self.mode][0]
+	top    = numpy.iinfo(dtype).max
+	stored = numpy.empty(dataTile.shape, dtype)
+	finite = numpy.isfinite(steps)
+	numpy.clip(steps, -top, top, out=steps)
+	numpy.copyto(stored, steps, casting='unsafe', where=finite)
+	stored[~finite] = numpy.iinfo(dtype).min
+	return stored
+
+    def tiles(self, tiles):
+	"""Generator, passes on each (key, dataTile) of tiles quantized."""
+	for key, dataTile in tiles:
+	    yield key, self.quantize(dataTile)
+	return
+
+
+def itemSize(mode):
+    """The bytes per pixel of a dataset quantized in mode, as it asks;
+    an image too wide in range for an integer mode takes 4, see Quantizer.
+    """
+    if mode in _intTypes:
+	return numpy.dtype(_intTypes[mode][0]).itemsize
+    return numpy.dtype(numpy.float32).itemsize
+
+
+def quantizer(fName, mode, maxError=MAXERROR, cube=False,
+	      tileBytes=skimIngest.TILEBYTES):
+    """Returns the Quantizer of the image fName, or with cube=True of its
+    full data cube, see imageStats().
+    """
+    lo, hi, sigma = imageStats(fName, cube, tileBytes)
+    return Quantizer(mode, lo, hi, sigma, maxError)
+
+
+def dequantize(data, attrs):
+    """Returns the float32 values of data read from a dataset with the
+    attributes attrs, its _v_attrs or a dictionary: for scaled integers
+    BZERO + BSCALE * data, NaN where data == BLANK; float data as they are.
+    """
+    if data.dtype.kind == 'f':
+	return data
+    if isinstance(attrs, dict):
+	get = attrs.get
+    else:
+	get = lambda key: getattr(attrs, key)
+    values = numpy.multiply(data, get('BSCALE'), dtype=numpy.float64)
+    values += get('BZERO')
+    values = values.astype(numpy.float32)
+    values[data == get('BLANK')] = numpy.nan
+    return values
+
+
+def readData(node, key=Ellipsis):
+    """Returns node[key] of an image dataset node as float32, see
+    dequantize().
+    """
+    data = node[key]
+    if 'BSCALE' not in node._v_attrs:
+	return data
+    return dequantize(numpy.asarray(data), node._v_attrs)
@@ -0,0 +1,396 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Reading skim files.
+#
+# A SkimReader opens a skim file once and indexes its Image groups by
+# subband: the image dataset of each, its own ImageDataArray_SBnnn or its row
+# of the /SkyCube stack, see skimStack, its frequency and its LinearCoord
+# world coordinates.  It serves
+#
+# cutout():     a pixel box of an image plane
+# skyCutout():  a box about a sky position, see skyToPixel()
+# plane():      a full image plane
+# spectrum():   the values of a pixel through all subbands
+# preview():    the pyramid level for a preview size, see skimPyramid
+# statistics(): the image statistics taken at build time, see skimStats
+#
+# all as float32, quantized images given back as values, see skimQuantize.
+# Cutouts and spectra read whole chunks, only those they touch, and keep
+# them in a ChunkCache, so that a query near an earlier one is served from
+# memory without touching HDF5 at all.  Full planes are read straight from
+# the file, past the cache, so as not to flush it.
+#
+# Sky positions are converted, by skyToPixel() and pixelToSky(), with the
+# zenithal projections of the images' CTYPEs, ZENITHAL below; others are
+# taken as linear.
+
+import math
+import itertools
+from   collections import OrderedDict
+import numpy
+import tables
+import skimStack
+import skimPyramid
+import skimQuantize
+import skimStats
+
+CACHEBYTES = 64 * 1024 * 1024
+ZENITHAL   = ('SIN', 'TAN', 'ARC', 'ZEA', 'STG')
+LONGITUDES = ('RA', 'GLON', 'ELON')
+LATITUDES  = ('DEC', 'GLAT', 'ELAT')
+
+
+class ChunkCache(object):
+    """Least recently used cache of decompressed chunks, of at most maxBytes
+    in all, by (dataset path, chunk index).
+    """
+
+    def __init__(self, maxBytes=CACHEBYTES):
+	self.maxBytes = maxBytes
+	self.nbytes   = 0
+	self.hits     = 0
+	self.misses   = 0
+	self._chunks  = OrderedDict()   # least recently used first
+
+    def get(self, key):
+	"""Returns the chunk at key, or None."""
+	chunk = self._chunks.pop(key, None)
+	if chunk is None:
+	    self.misses += 1
+	    return None
+	self.hits += 1
+	self._chunks[key] = chunk
+	return chunk
+
+    def put(self, key, chunk):
+	"""Keep chunk at key, dropping the least recently used chunks to make
+	room.  A chunk larger than the cache is not kept.
+	"""
+	if chunk.nbytes > self.maxBytes:
+	    return
+	if key in self._chunks:
+	    self.nbytes -= self._chunks.pop(key).nbytes
+	while self._chunks and self.nbytes + chunk.nbytes > self.maxBytes:
+	    self.nbytes -= self._chunks.popitem(last=False)[1].nbytes
+	self._chunks[key] = chunk
+	self.nbytes      += chunk.nbytes
+	return
+
+    def clear(self):
+	"""Drop all chunks."""
+	self._chunks.clear()
+	self.nbytes = 0
+	return
+
+    def __len__(self):
+	return len(self._chunks)
+
+
+def readBox(node, box, cache=None):
+    """Returns the float32 values of node in box, a (start, stop) pair per
+    dimension within its shape, read chunk by chunk through the ChunkCache
+    cache, if given.
+    """
+    chunkShape = node.chunkshape or node.shape
+    out        = numpy.empty([stop - start for start, stop in box], numpy.float32)
+    ranges     = [range(start // size, (stop - 1) // size + 1)
+		  for (start, stop), size in zip(box, chunkShape)]
+    for index in itertools.product(*ranges):
+	key   = (node._v_pathname, index)
+	chunk = None
+	if cache is not None:
+	    chunk = cache.get(key)
+	if chunk is None:
+	    chunkKey = tuple([slice(i * size, min((i + 1) * size, length))
+			      for i, size, length in zip(index, chunkShape, node.shape)])
+	    chunk = numpy.asarray(skimQuantize.readData(node, chunkKey),
+				  dtype=numpy.float32)
+	    if cache is not None:
+		cache.put(key, chunk)
+	source = []
+	target = []
+	for i, size, (start, stop) in zip(index, chunkShape, box):
+	    lo = max(start, i * size)
+	    hi = min(stop, (i + 1) * size)
+	    source.append(slice(lo - i * size, hi - i * size))
+	    target.append(slice(lo - start, hi - start))
+	out[tuple(target)] = chunk[tuple(source)]
+    return out
+
+
+def _celestial(coords):
+    """The (CRVAL, CRPIX, CDELT, 2x2 PC, projection) of the celestial axes
+    of the LinearCoord attributes coords; ValueError if they are not its
+    first two axes.
+    """
+    names = [str(name).upper() for name in coords['AXIS_NAMES']]
+    if len(names) < 2 or not (names[0].split('-')[0] in LONGITUDES and
+			      names[1].split('-')[0] in LATITUDES):
+	raise ValueError("No celestial axes first in "+str(names))
+    return (coords['REFERENCE_VALUE'], coords['REFERENCE_PIXEL'],
+	    coords['INCREMENT'], numpy.asarray(coords['PC'])[:2, :2],
+	    names[0][5:8])
+
+
+def skyToPixel(coords, lon, lat):
+    """Returns the zero-based (y, x) image pixel of the sky position lon, lat
+    in degrees, given the LinearCoord attributes coords of the image (a
+    dictionary, see attributeSets.linearOverrides()) with its celestial axes
+    first.  ValueError if it has none, or if the position is not on the
+    projection.
+    """
+    crval, crpix, cdelt, pc, proj = _celestial(coords)
+    if proj in ZENITHAL:
+	a, d   = math.radians(lon), math.radians(lat)
+	a0, d0 = math.radians(crval[0]), math.radians(crval[1])
+	# Native spherical coordinates, the reference point at the pole.
+	sinTheta = (math.sin(d) * math.sin(d0) +
+		    math.cos(d) * math.cos(d0) * math.cos(a - a0))
+	theta    = math.asin(max(-1.0, min(1.0, sinTheta)))
+	phi      = math.pi + math.atan2(-math.cos(d) * math.sin(a - a0),
+					math.sin(d) * math.cos(d0) -
+					math.cos(d) * math.sin(d0) * math.cos(a - a0))
+	if proj == 'SIN':
+	    if theta < 0:
+		raise ValueError("Position beyond the SIN hemisphere")
+	    r = math.cos(theta)
+	elif proj == 'TAN':
+	    if theta <= 0:
+		raise ValueError("Position beyond the TAN hemisphere")
+	    r = math.cos(theta) / math.sin(theta)
+	elif proj == 'ARC':
+	    r = math.pi / 2 - theta
+	elif proj == 'ZEA':
+	    r = math.sqrt(2 * (1 - math.sin(theta)))
+	else:
+	    r = 2 * math.tan((math.pi / 2 - theta) / 2)
+	x = math.degrees(r) * math.sin(phi)
+	y = -math.degrees(r) * math.cos(phi)
+    else:
+	x = lon - crval[0]
+	y = lat - crval[1]
+    px, py = numpy.linalg.solve(pc, [x / cdelt[0], y / cdelt[1]])
+    return py + crpix[1] - 1, px + crpix[0] - 1
+
+
+def pixelToSky(coords, y, x):
+    """Returns the sky positions (lon, lat), in degrees, of the zero-based
+    image pixels y, x, numbers or arrays, the inverse of skyToPixel().
+    """
+    crval, crpix, cdelt, pc, proj = _celestial(coords)
+    px  = numpy.asarray(x, dtype=numpy.float64) + 1 - crpix[0]
+    py  = numpy.asarray(y, dtype=numpy.float64) + 1 - crpix[1]
+    xi  = cdelt[0] * (pc[0, 0] * px + pc[0, 1] * py)
+    eta = cdelt[1] * (pc[1, 0] * px + pc[1, 1] * py)
+    if proj not in ZENITHAL:
+	return crval[0] + xi, crval[1] + eta
+    r   = numpy.radians(numpy.hypot(xi, eta))
+    phi = numpy.arctan2(xi, -eta)
+    if proj == 'SIN':
+	theta = numpy.arccos(numpy.minimum(r, 1.0))
+    elif proj == 'TAN':
+	theta = numpy.arctan2(1.0, r)
+    elif proj == 'ARC':
+	theta = numpy.pi / 2 - r
+    elif proj == 'ZEA':
+	theta = numpy.pi / 2 - 2 * numpy.arcsin(numpy.minimum(r / 2, 1.0))
+    else:
+	theta = numpy.pi / 2 - 2 * numpy.arctan(r / 2)
+    a0, d0 = numpy.radians(crval[0]), numpy.radians(crval[1])
+    dphi   = phi - numpy.pi
+    lat    = numpy.arcsin(numpy.sin(theta) * numpy.sin(d0) +
+			  numpy.cos(theta) * numpy.cos(d0) * numpy.cos(dphi))
+    lon    = a0 + numpy.arctan2(-numpy.cos(theta) * numpy.sin(dphi),
+				numpy.sin(theta) * numpy.cos(d0) -
+				numpy.cos(theta) * numpy.sin(d0) * numpy.cos(dphi))
+    return numpy.degrees(lon) % 360.0, numpy.degrees(lat)
+
+
+def subbandKey(subband):
+    """Returns the subband number of subband, a number or an ID like 'SB061'
+    or '061'.
+    """
+    if isinstance(subband, basestring):
+	subband = subband.upper().lstrip('SB')
+    return int(subband)
+
+
+class SkimReader(object):
+    """Read access to the skim file fileName, with a ChunkCache of cacheBytes
+    for cutouts and spectra.  close() when done.
+    """
+
+    def __init__(self, fileName, cacheBytes=CACHEBYTES):
+	self.fileName = fileName
+	self.skyFile  = tables.openFile(fileName, mode="r")
+	self.cache    = ChunkCache(cacheBytes)
+	self.images   = {}
+	self.stack    = None
+	root          = self.skyFile.root
+	stackPath     = '/' + skimStack.STACKGROUP + '/' + skimStack.STACKNAME
+	if stackPath in self.skyFile:
+	    self.stack = self.skyFile.getNode(stackPath)
+	for name, group in root._v_groups.items():
+	    if not name.startswith('Image') or 'skyData' not in group:
+		continue
+	    dataGroup = group.skyData
+	    attrs     = dataGroup._v_attrs
+	    image     = {'group':     group._v_pathname,
+			 'dataGroup': dataGroup,
+			 'row':       None,
+			 'frequency': None,
+			 'coords':    {}}
+	    if 'STACK_ROW' in attrs:
+		image['node'] = self.stack
+		image['row']  = int(attrs.STACK_ROW)
+	    elif 'DATASETNAME' in attrs and attrs.DATASETNAME in dataGroup:
+		image['node'] = getattr(dataGroup, attrs.DATASETNAME)
+	    else:
+		continue
+	    if 'Coordinates' in group and 'LinearCoord' in group.Coordinates:
+		linAttrs = group.Coordinates.LinearCoord._v_attrs
+		image['coords'] = dict([(key, getattr(linAttrs, key))
+					for key in linAttrs._v_attrnamesuser])
+		image['frequency'] = self._frequency(image['coords'])
+	    self.images[int(name[len('Image'):])] = image
+
+    def close(self):
+	"""Close the skim file."""
+	self.cache.clear()
+	self.skyFile.close()
+	return
+
+    def _frequency(self, coords):
+	"""The frequency in Hz of the first plane, from the coordinates."""
+	for n, name in enumerate(coords.get('AXIS_NAMES', [])):
+	    if str(name).upper().startswith('FREQ'):
+		return (coords['REFERENCE_VALUE'][n] +
+			(1 - coords['REFERENCE_PIXEL'][n]) * coords['INCREMENT'][n])
+	return None
+
+    def _image(self, subband):
+	"""The index entry of subband; KeyError if there is none."""
+	key = subbandKey(subband)
+	if key not in self.images:
+	    raise KeyError("No subband "+str(subband)+" in "+self.fileName)
+	return self.images[key]
+
+    def subbands(self):
+	"""The sorted list of subband numbers."""
+	return sorted(self.images)
+
+    def frequencies(self):
+	"""The frequencies in Hz, or NaN where not known, of subbands()."""
+	return numpy.array([self.images[key]['frequency'] or numpy.nan
+			    for key in self.subbands()])
+
+    def planeShape(self, subband):
+	"""The (nrows, ncols) of the image of subband."""
+	return self._image(subband)['node'].shape[-2:]
+
+    def nplanes(self, subband):
+	"""The number of image planes of subband, more than one for a cube."""
+	image = self._image(subband)
+	lead  = image['node'].shape[:-2]
+	if image['row'] is not None:
+	    lead = lead[1:]
+	return int(numpy.prod(lead))
+
+    def _lead(self, image, plane):
+	"""The leading (index, index + 1) pairs of a plane of image."""
+	lead = image['node'].shape[:-2]
+	if image['row'] is not None:
+	    return [(image['row'], image['row'] + 1)]
+	if plane < 0 or plane >= max(1, int(numpy.prod(lead))):
+	    raise IndexError("No plane "+str(plane)+" of "+image['group'])
+	if not lead:
+	    return []
+	return [(i, i + 1) for i in numpy.unravel_index(plane, lead)]
+
+    def cutout(self, subband, rows, cols, plane=0):
+	"""Returns the float32 pixel box of rows (start, stop) by cols (start,
+	stop) of plane of the image of subband, NaN where it is off the image.
+	"""
+	image        = self._image(subband)
+	nrows, ncols = image['node'].shape[-2:]
+	out = numpy.empty((rows[1] - rows[0], cols[1] - cols[0]), numpy.float32)
+	out.fill(numpy.nan)
+	y0, y1 = max(rows[0], 0), min(rows[1], nrows)
+	x0, x1 = max(cols[0], 0), min(cols[1], ncols)
+	if y0 < y1 and x0 < x1:
+	    box = self._lead(image, plane) + [(y0, y1), (x0, x1)]
+	    out[y0 - rows[0]:y1 - rows[0], x0 - cols[0]:x1 - cols[0]] = \
+		readBox(image['node'], box, self.cache).reshape(y1 - y0, x1 - x0)
+	return out
+
+    def pixel(self, subband, lon, lat):
+	"""Returns the zero-based (y, x) pixel of the image of subband at the
+	sky position lon, lat in degrees, see skyToPixel().
+	"""
+	image = self._image(subband)
+	if not image['coords']:
+	    raise ValueError("No coordinates for "+image['group'])
+	return skyToPixel(image['coords'], lon, lat)
+
+    def skyCutout(self, subband, lon, lat, size, plane=0):
+	"""Returns the size by size pixel cutout of plane of the image of
+	subband, centred on the sky position lon, lat in degrees.
+	"""
+	y, x = self.pixel(subband, lon, lat)
+	y0   = int(round(y)) - size // 2
+	x0   = int(round(x)) - size // 2
+	return self.cutout(subband, (y0, y0 + size), (x0, x0 + size), plane)
+
+    def plane(self, subband, plane=0):
+	"""Returns the full float32 image plane of subband, read past the
+	cache.
+	"""
+	image = self._image(subband)
+	key   = tuple([start for start, stop in self._lead(image, plane)])
+	return numpy.asarray(skimQuantize.readData(image['node'], key + (Ellipsis,)),
+			     dtype=numpy.float32)
+
+    def spectrum(self, y, x, plane=0):
+	"""Returns the float32 values of pixel y, x of plane through the
+	subbands(), in their order, see frequencies().
+	"""
+	keys = self.subbands()
+	out  = numpy.empty(len(keys), numpy.float32)
+	if keys and all([self.images[key]['row'] is not None for key in keys]):
+	    nrows, ncols = self.stack.shape[-2:]
+	    if not (0 <= y < nrows and 0 <= x < ncols):
+		raise IndexError("No pixel "+str((y, x))+" in the stack")
+	    values = readBox(self.stack, [(0, self.stack.shape[0]), (y, y + 1),
+					  (x, x + 1)], self.cache).ravel()
+	    for n, key in enumerate(keys):
+		out[n] = values[self.images[key]['row']]
+	    return out
+	for n, key in enumerate(keys):
+	    out[n] = self.cutout(key, (y, y + 1), (x, x + 1), plane)[0, 0]
+	return out
+
+    def statistics(self, subband):
+	"""Returns the statistics of the image of subband as a dictionary of
+	its skimStats attributes, empty if it was built without.
+	"""
+	attrs = self._image(subband)['dataGroup']._v_attrs
+	names = [name for name, value in skimStats.ImageStats().attributes()]
+	return dict([(name, getattr(attrs, name)) for name in names
+		     if name in attrs])
+
+    def preview(self, subband, size=512):
+	"""Returns the float32 pyramid level of the image of subband for a
+	preview of size pixels, see skimPyramid.preview(); with no level
+	large enough, its first plane.
+	"""
+	image = self._image(subband)
+	level = skimPyramid.preview(image['dataGroup'], size)
+	if level is None:
+	    return self.plane(subband)
+	return level[:]
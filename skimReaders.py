@@ -0,0 +1,158 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Reader backends.
+#
+# Each kind of input image is read by a backend module with the functions
+#
+#   slingShape(fName, cube=False)        2D plane, or full data, shape
+#   slingTiles(fName, keys, cube=False)  generator of (key, dataTile)
+#   slingWcs(fName)                      world coordinates, as from
+#                                        fitsHandlers.wcsKeywords()
+#   slingFrequency(fName)                first channel frequency, Hz, or NaN
+#
+# and optionally
+#
+#   readTile(fName, key, cube, out)      one tile, converted into out
+#
+# for a backend that can convert its data into a native float32 buffer in
+# one pass, as fitsHandlers does with BSCALE/BZERO; for the others, readTile()
+# below copies slingTiles() tiles into the buffer.
+#
+# A backend is registered here by name with the file name suffixes, and the
+# signature, it is known by, and its module is only imported the first time
+# one of its images is read.  So a command line that never reads a CASA
+# image never imports pyrap, and one that only prints its usage imports no
+# reader at all.  The ingest code reads every image through the functions
+# below, whatever its type, so one build can take a mix of them.
+
+import os
+from   os.path import isdir, join
+import numpy
+
+# (name, module name, file name suffixes, signature) of each backend, in the
+# order they are tried.  A signature is the leading bytes of the file, or a
+# function of the file name that is true for the backend's images.
+READERS = []
+
+_modules = {}
+
+
+def register(name, moduleName, suffixes=(), signature=None):
+    """Register the reader backend module moduleName as name, for images
+    whose file names end in one of suffixes or, failing that, that match
+    signature.  A backend of the same name is replaced.
+    """
+    for n in range(len(READERS)):
+	if READERS[n][0] == name:
+	    del READERS[n]
+	    break
+    READERS.append((name, moduleName, tuple(suffixes), signature))
+    _modules.pop(name, None)
+    return
+
+
+def suffixes():
+    """Returns the tuple of the image file name suffixes of all backends."""
+    found = ()
+    for name, moduleName, names, signature in READERS:
+	found += names
+    return found
+
+
+def _isCasaImage(fName):
+    return isdir(fName) and os.path.exists(join(fName, 'table.dat'))
+
+
+def readerName(fName):
+    """Returns the name of the backend that reads the image fName: by its
+    suffix, else by its signature.  IOError if no backend knows it.
+    """
+    lower = fName.lower()
+    for name, moduleName, names, signature in READERS:
+	if names and lower.endswith(names):
+	    return name
+    head = None
+    for name, moduleName, names, signature in READERS:
+	if callable(signature):
+	    if signature(fName):
+		return name
+	elif signature:
+	    if head is None:
+		head = ''
+		if not isdir(fName):
+		    fob = open(fName, 'rb')
+		    try:
+			head = fob.read(80)
+		    finally:
+			fob.close()
+	    if head.startswith(signature):
+		return name
+    raise IOError(fName + ": no reader for this type of image.")
+
+
+def reader(fName):
+    """Returns the backend module that reads the image fName, importing it
+    on first use.
+    """
+    name = readerName(fName)
+    if name not in _modules:
+	for entry in READERS:
+	    if entry[0] == name:
+		_modules[name] = __import__(entry[1])
+		break
+    return _modules[name]
+
+
+def slingShape(fName, cube=False):
+    return reader(fName).slingShape(fName, cube)
+
+def slingTiles(fName, keys, cube=False):
+    return reader(fName).slingTiles(fName, keys, cube)
+
+def readTile(fName, key, cube=False, out=None):
+    """Returns the tile at key of the image fName as native float32, in the
+    array out if given, see the backend's readTile().
+    """
+    backend = reader(fName)
+    if hasattr(backend, 'readTile'):
+	return backend.readTile(fName, key, cube, out)
+    for key, dataTile in backend.slingTiles(fName, [key], cube):
+	if out is None:
+	    return numpy.require(dataTile, numpy.float32, ['C', 'A', 'O'])
+	out[...] = dataTile
+	return out
+
+def slingWcs(fName):
+    return reader(fName).slingWcs(fName)
+
+def slingFrequency(fName):
+    return reader(fName).slingFrequency(fName)
+
+
+def sourceStat(fName):
+    """Returns the (size, mtime) of an input image: of the file or, for an
+    image that is a directory, as a CASA image is, the total size of the
+    files in it and the latest of their mtimes.
+    """
+    if not isdir(fName):
+	fStat = os.stat(fName)
+	return fStat.st_size, fStat.st_mtime
+    size  = 0
+    mtime = os.stat(fName).st_mtime
+    for dirPath, dirNames, fileNames in os.walk(fName):
+	for name in fileNames:
+	    fStat = os.stat(join(dirPath, name))
+	    size += fStat.st_size
+	    mtime = max(mtime, fStat.st_mtime)
+    return size, mtime
+
+
+register('fits', 'fitsHandlers', ('.fits', '.fit', '.fts'), 'SIMPLE  =')
+register('casa', 'casaHandlers', ('.img', '.image'),       _isCasaImage)
+register('npy',  'npyHandlers',  ('.npy',),                '\x93NUMPY')
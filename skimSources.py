@@ -0,0 +1,308 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Source finding.
+#
+# A SourceFinder takes the first plane of a subband image from its ingest
+# tiles as they pass, see SourceFinder.tiles(), so that it costs no read of
+# its own, and once the plane is complete, find() detects its sources, with
+# numpy and scipy.ndimage and no loop over pixels or sources in python:
+#
+# 1. Background and noise: the median and robust (MAD) deviation of each
+#    BOX by BOX box, from every other pixel of every other row, once clipped
+#    at CLIP deviations, smoothed by a 3x3 median filter, and interpolated
+#    bilinearly between box centres.  The medians of all boxes come from one
+#    partition, see _median().  The background is subtracted in place.
+# 2. Islands: the 8-connected regions above ANALYSIS times the noise, kept
+#    if they hold at least MINPIXELS pixels and a peak above DETECT times it.
+# 3. Moments: of the positive residual of each island, its centroid, and
+#    the major and minor standard deviations and position angle of its
+#    second moments; its peak, summed flux, and the background and noise at
+#    its peak.
+#
+# writeSources() writes them as the sourceList table of the image's Source
+# group, with its NSOURCES, and indexes on FLUX (completely sorted, for
+# readSorted()), RA and DEC.  RA and DEC are NaN for an image without
+# celestial coordinates, see skimQuery.pixelToSky().
+#
+# So a SourceFinder is not a streaming stage: each tile is copied into a
+# float32 plane as it passes, 4 bytes a pixel, 256 MB for an 8k by 8k image,
+# held on top of the ingest tiles until find().  Detection needs the plane
+# whole: the background of a box is smoothed with those of its neighbours,
+# and an island may run across any number of tiles, so that it can only be
+# labelled once all of them are in.  scipy is needed only for source
+# finding, and only imported for it, see _ndimage().
+
+import numpy
+import tables
+import skimQuery
+
+ndimage = None          # scipy.ndimage, once imported
+
+SOURCENAME = "sourceList"
+BOX        = 64         # pixels, side of the background boxes
+CLIP       = 3.0        # deviations, of the background clipping
+ANALYSIS   = 3.0        # deviations, island threshold
+DETECT     = 5.0        # deviations, peak threshold
+MINPIXELS  = 3
+BANDROWS   = 1024       # rows of the background subtracted at a time
+
+
+class SourceEntry(tables.IsDescription):
+    ID         = tables.Int32Col(pos=0)
+    X          = tables.Float64Col(pos=1)     # zero-based pixel centroid
+    Y          = tables.Float64Col(pos=2)
+    RA         = tables.Float64Col(pos=3)     # degrees
+    DEC        = tables.Float64Col(pos=4)
+    PEAK       = tables.Float32Col(pos=5)     # background subtracted
+    PEAK_SNR   = tables.Float32Col(pos=6)
+    FLUX       = tables.Float64Col(pos=7)     # sum over the island
+    NPIX       = tables.Int32Col(pos=8)
+    MAJOR      = tables.Float32Col(pos=9)     # standard deviations, pixels
+    MINOR      = tables.Float32Col(pos=10)
+    PA         = tables.Float32Col(pos=11)    # degrees, from +x towards +y
+    BACKGROUND = tables.Float32Col(pos=12)    # at the peak
+    RMS        = tables.Float32Col(pos=13)
+
+
+def _ndimage():
+    """Returns scipy.ndimage, importing it on first use, or None if scipy
+    is not there.
+    """
+    global ndimage
+    if ndimage is None:
+	try:
+	    from scipy import ndimage
+	except ImportError:
+	    return None
+    return ndimage
+
+
+def available():
+    """True if sources can be found here, ie. scipy.ndimage is there."""
+    return _ndimage() is not None
+
+
+def _weights(pixels, size, box):
+    """The lower and upper box indices of pixels, and the float32 weights
+    of the upper, for interpolation between the centres of size boxes.
+    """
+    t  = (numpy.asarray(pixels) + 0.5) / box - 0.5
+    i0 = numpy.clip(numpy.floor(t).astype(numpy.intp), 0, size - 1)
+    i1 = numpy.minimum(i0 + 1, size - 1)
+    return i0, i1, numpy.clip(t - i0, 0.0, 1.0).astype(numpy.float32)
+
+
+def interpolate(mesh, y, x, box=BOX):
+    """Returns the values of mesh, one per box, interpolated bilinearly
+    between box centres at the pixels y, x, integer arrays of one shape,
+    and held flat beyond the outer centres.
+    """
+    j0, j1, v = _weights(y, mesh.shape[0], box)
+    i0, i1, u = _weights(x, mesh.shape[1], box)
+    return ((mesh[j0, i0] * (1 - u) + mesh[j0, i1] * u) * (1 - v) +
+	    (mesh[j1, i0] * (1 - u) + mesh[j1, i1] * u) * v)
+
+
+def interpolateRows(mesh, start, stop, ncols, box=BOX):
+    """Returns the rows start to stop of the ncols wide image of mesh, as
+    by interpolate(), but separably: across, then down.
+    """
+    i0, i1, u = _weights(numpy.arange(ncols), mesh.shape[1], box)
+    across    = mesh[:, i0] * (1 - u) + mesh[:, i1] * u
+    j0, j1, v = _weights(numpy.arange(start, stop), mesh.shape[0], box)
+    v         = v[:, None]
+    return across[j0] * (1 - v) + across[j1] * v
+
+
+def _median(values, missing):
+    """Returns the median of each row of the 2D array values, leaving out
+    those where missing, NaN for a row of nothing else.  The m left out of
+    a row are taken as -inf and +inf by turns, m // 2 of them -inf, so the
+    median of the rest is at known places by the middle of the row, and one
+    partition there serves all rows.
+    """
+    fill   = numpy.where(numpy.cumsum(missing, axis=1) % 2, numpy.inf, -numpy.inf)
+    values = numpy.where(missing, fill.astype(values.dtype), values)
+    size   = values.shape[1]
+    middle = sorted(set([max((size - 1) // 2 - 1, 0), (size - 1) // 2, size // 2]))
+    values = numpy.partition(values, middle, axis=1)
+    m      = missing.sum(axis=1)
+    rows   = numpy.arange(len(values))
+    lo     = numpy.maximum(m // 2 + (size - m - 1) // 2, 0)
+    hi     = numpy.minimum(m // 2 + (size - m) // 2, size - 1)
+    median = (values[rows, lo] + values[rows, hi]) / 2
+    median[m == size] = numpy.nan
+    return median
+
+
+def backgroundMesh(plane, box=BOX, clip=CLIP):
+    """Returns the float32 (background, noise) meshes of plane, one value
+    per box by box box.
+    """
+    nrows, ncols = plane.shape
+    ny, nx = -(-nrows // box), -(-ncols // box)
+    padded = numpy.empty((ny * box, nx * box), numpy.float32)
+    padded.fill(numpy.nan)
+    padded[:nrows, :ncols] = plane
+    sample  = padded.reshape(ny, box, nx, box)[:, ::2, :, ::2]
+    sample  = sample.transpose(0, 2, 1, 3).reshape(ny * nx, -1)
+    missing = ~numpy.isfinite(sample)
+    empty   = missing.all(axis=1)
+    saved   = numpy.seterr(invalid='ignore')
+    try:
+	for n in range(2):
+	    median = _median(sample, missing)
+	    dev    = numpy.abs(sample - median[:, None])
+	    sigma  = 1.4826 * _median(dev, missing)
+	    if n == 0:
+		missing |= dev > clip * sigma[:, None]
+	noisy = ~empty & (sigma > 0)
+    finally:
+	numpy.seterr(**saved)
+    # Boxes without a background or noise get the median of the others.
+    meshes = []
+    for mesh, good in ((median, ~empty), (sigma, noisy)):
+	fill = good.any() and numpy.median(mesh[good]) or 0.0
+	mesh = numpy.where(good, mesh, fill).reshape(ny, nx)
+	meshes.append(_ndimage().median_filter(mesh, size=3, mode='nearest').astype(numpy.float32))
+    return meshes[0], meshes[1]
+
+
+class SourceFinder(object):
+    """Finds the sources of an image plane of shape planeShape, add()ed tile
+    by tile into a copy of the whole plane.  Only the first image plane is
+    taken, as by skimIngest.ImageSum.
+    """
+
+    def __init__(self, planeShape):
+	if not available():
+	    raise ImportError("Source finding needs scipy.ndimage")
+	self.planeShape = tuple(planeShape)
+	self.plane      = numpy.empty(self.planeShape, numpy.float32)
+	self.plane.fill(numpy.nan)
+
+    def add(self, key, dataTile):
+	"""Add the tile at key of the image dataset."""
+	for idx in key[:-2]:
+	    if not isinstance(idx, slice) and idx != 0:
+		return
+	rows, cols = key[-2:]
+	self.plane[rows, cols] = dataTile.reshape((-1,) + dataTile.shape[-2:])[0]
+	return
+
+    def tiles(self, tiles):
+	"""Generator, passes on each (key, dataTile) of tiles, adding each."""
+	for key, dataTile in tiles:
+	    self.add(key, dataTile)
+	    yield key, dataTile
+	return
+
+    def find(self, coords=None):
+	"""Returns the sources of the plane as a numpy record array of
+	SourceEntry rows, brightest peak first, with RA and DEC from the
+	LinearCoord attributes coords if given (a dictionary, see
+	attributeSets.linearOverrides()).  The plane is left background
+	subtracted.
+	"""
+	plane        = self.plane
+	nrows, ncols = plane.shape
+	bgMesh, rmsMesh = backgroundMesh(plane)
+	mask = numpy.zeros(plane.shape, bool)
+	for start in range(0, nrows, BANDROWS):
+	    stop  = min(start + BANDROWS, nrows)
+	    band  = plane[start:stop]
+	    band -= interpolateRows(bgMesh, start, stop, ncols)
+	    level = interpolateRows(rmsMesh, start, stop, ncols)
+	    level *= ANALYSIS
+	    # With no noise at all, as in a constant image, nothing stands out.
+	    level[level <= 0] = numpy.inf
+	    saved = numpy.seterr(invalid='ignore')
+	    try:
+		numpy.greater_equal(band, level, out=mask[start:stop])
+	    finally:
+		numpy.seterr(**saved)
+	labels, nlabels = _ndimage().label(mask, structure=numpy.ones((3, 3)))
+	del mask
+
+	# The island pixels, in label order, brightest last in each.
+	pixels = numpy.flatnonzero(labels)
+	label  = labels.ravel()[pixels]
+	del labels
+	ys, xs = divmod(pixels, ncols)
+	resid  = plane.ravel()[pixels]
+	noise  = interpolate(rmsMesh, ys, xs)
+	snr    = resid / noise
+	order  = numpy.lexsort((snr, label))
+	label, ys, xs, resid, noise, snr = [a[order] for a in
+					    (label, ys, xs, resid, noise, snr)]
+	npix   = numpy.bincount(label, minlength=nlabels + 1)[1:]
+	peaks  = numpy.cumsum(npix) - 1
+	keep   = (snr[peaks] >= DETECT) & (npix >= MINPIXELS)
+
+	# Moments about each peak, of the positive residual.
+	weight = numpy.maximum(resid, 0).astype(numpy.float64)
+	dx     = xs - xs[peaks][label - 1]
+	dy     = ys - ys[peaks][label - 1]
+	def total(values):
+	    return numpy.bincount(label, weights=values, minlength=nlabels + 1)[1:]
+	w      = numpy.maximum(total(weight), 1e-30)
+	mx     = total(weight * dx) / w
+	my     = total(weight * dy) / w
+	sxx    = numpy.maximum(total(weight * dx * dx) / w - mx * mx, 0)
+	syy    = numpy.maximum(total(weight * dy * dy) / w - my * my, 0)
+	sxy    = total(weight * dx * dy) / w - mx * my
+	half   = (sxx + syy) / 2
+	diff   = numpy.sqrt(((sxx - syy) / 2) ** 2 + sxy ** 2)
+
+	sources = numpy.zeros(int(keep.sum()), dtype=tables.Description(
+	    SourceEntry().columns)._v_dtype)
+	peaks   = peaks[keep]
+	sources['X']          = (xs[peaks] + mx[keep])
+	sources['Y']          = (ys[peaks] + my[keep])
+	sources['PEAK']       = resid[peaks]
+	sources['PEAK_SNR']   = snr[peaks]
+	sources['FLUX']       = total(resid.astype(numpy.float64))[keep]
+	sources['NPIX']       = npix[keep]
+	sources['MAJOR']      = numpy.sqrt(half + diff)[keep]
+	sources['MINOR']      = numpy.sqrt(numpy.maximum(half - diff, 0))[keep]
+	sources['PA']         = numpy.degrees(0.5 * numpy.arctan2(2 * sxy, sxx - syy))[keep]
+	sources['BACKGROUND'] = interpolate(bgMesh, ys[peaks], xs[peaks])
+	sources['RMS']        = noise[peaks]
+	sources['RA']         = numpy.nan
+	sources['DEC']        = numpy.nan
+	if coords and len(sources):
+	    try:
+		sources['RA'], sources['DEC'] = skimQuery.pixelToSky(coords,
+								     sources['Y'],
+								     sources['X'])
+	    except ValueError:
+		pass
+	sources = sources[numpy.argsort(-sources['PEAK'], kind='mergesort')]
+	sources['ID'] = numpy.arange(len(sources))
+	return sources
+
+
+def writeSources(skyFile, sourceHook, sources):
+    """Write the sources, as from SourceFinder.find(), into the sourceList
+    table of the Source group sourceHook, and set its NSOURCES.
+    """
+    table = skyFile.createTable(sourceHook, SOURCENAME, SourceEntry,
+				title="Source List",
+				expectedrows=max(len(sources), 1))
+    if len(sources):
+	table.append(sources)
+    table.flush()
+    for name, value in (('ANALYSIS', ANALYSIS), ('DETECT', DETECT),
+			('MINPIXELS', MINPIXELS), ('BOX', BOX)):
+	skyFile.setNodeAttr(table, name, value)
+    table.cols.FLUX.createCSIndex()
+    table.cols.RA.createIndex()
+    table.cols.DEC.createIndex()
+    skyFile.setNodeAttr(sourceHook, 'NSOURCES', len(sources))
+    return table
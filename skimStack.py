@@ -0,0 +1,189 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Consolidated subband stack.
+#
+# Optionally, the image planes of all subbands are written into one
+# extendable (subband, y, x) dataset,
+#
+# /SkyCube/skyCube
+# /SkyCube/subbandIndex
+#
+# chunked through STACKDEPTH subbands at a time, so that a per-pixel
+# spectrum across all subbands is a handful of chunk reads from a single
+# dataset, skyCube[:, y, x].  subbandIndex maps each subband ID to its stack
+# row, frequency, Image group and source file.  The skyData group of each
+# subband then holds no dataset of its own, only a soft link to the stack and
+# its STACK_ROW.
+
+import time
+import itertools
+from   os.path import join, basename
+import tables
+import skimReaders
+import skimIngest
+import skimMetrics
+import skimProfile
+import skimStats
+
+STACKGROUP = "SkyCube"
+STACKNAME  = "skyCube"
+INDEXNAME  = "subbandIndex"
+STACKDEPTH = 8          # subbands per chunk
+
+
+class SubbandIndex(tables.IsDescription):
+    SUBBAND   = tables.Int32Col(pos=0)
+    ROW       = tables.Int32Col(pos=1)
+    FREQUENCY = tables.Float64Col(pos=2)   # Hz
+    GROUP     = tables.StringCol(32, pos=3)
+    FILENAME  = tables.StringCol(256, pos=4)
+
+
+def stackChunkShape(planeShape, stackDepth=STACKDEPTH):
+    """Returns the (stackDepth, side, side) chunkshape of the stack, side
+    being the largest power of two that keeps a chunk within
+    skimIngest.CHUNKBYTES.
+    """
+    nrows, ncols = planeShape
+    side = 1
+    while (2*side) ** 2 * stackDepth * skimIngest.ITEMSIZE <= skimIngest.CHUNKBYTES:
+	side *= 2
+    return (stackDepth, min(side, nrows), min(side, ncols))
+
+
+def stackTasks(fileNames, planeShape, stackDepth=STACKDEPTH,
+	       tileBytes=skimIngest.TILEBYTES, start=0):
+    """Generator over the skimIngest.slingTiles() tile tasks that fill the
+    stack rows start onwards from fileNames.  Each tile is a band of rows
+    through stackDepth subbands, ie. through whole chunks, so that no chunk
+    is written more than once and memory stays within tileBytes.
+    """
+    nrows, ncols = planeShape
+    chunkRows = stackChunkShape(planeShape, stackDepth)[1]
+    nchunks   = max(1, tileBytes // (stackDepth * chunkRows * ncols *
+				     skimIngest.ITEMSIZE))
+    bands     = min(nchunks * chunkRows, nrows)
+    for first in range(0, len(fileNames), stackDepth):
+	group = fileNames[first:first+stackDepth]
+	sbs   = slice(start+first, start+first+len(group))
+	for row in range(0, nrows, bands):
+	    rows = slice(row, min(row+bands, nrows))
+	    yield (sbs, rows, slice(None)), group, (rows, slice(None)), False
+    return
+
+
+@skimProfile.profiled('data')
+def writeStack(earr, tiles):
+    """Write each (key, dataTile) of tiles into the stack, extending it as
+    new subband rows arrive.  Timed as skimIngest.writeTiles() is.
+    """
+    for key, dataTile in skimMetrics.timeTiles(tiles):
+	start = time.time()
+	if key[0].stop > earr.nrows:
+	    earr.truncate(key[0].stop)
+	earr[key] = dataTile
+	skimMetrics.add('write', time.time() - start, dataTile.nbytes)
+    return
+
+
+def buildStack(skyFile, nameStruct, resultsPath, filters=None, workers=1,
+	       depth=None, tileBytes=skimIngest.TILEBYTES,
+	       stackDepth=STACKDEPTH, bandwidth=None, imageSum=None, stats=None):
+    """Build the /SkyCube group: the skyCube stack of all subband image planes,
+    in nameStruct order, and its subbandIndex table.  workers, depth,
+    tileBytes and bandwidth are as for skimIngest.slingImages().  Returns a
+    dictionary of stack rows by subband name, eg. {'SB000': 0, ...}.
+    Pass a skimIngest.ImageSum as imageSum to sum the planes as they pass,
+    and a dictionary as stats to collect the skimStats.ImageStats of each
+    stack row in it.
+
+    If the file already holds a stack, as on a resumed build, the rows of
+    subbands already in its index are rewritten in place and new subbands are
+    appended to the end of the stack.
+
+    All subband images must have the same plane shape; ValueError if not.
+    """
+    fileNames  = [join(resultsPath, sBand[-1]) for sBand in nameStruct]
+    shapes     = [skimReaders.slingShape(fName) for fName in fileNames]
+    if '/' + STACKGROUP in skyFile:
+	earr  = skyFile.getNode('/'+STACKGROUP, STACKNAME)
+	index = skyFile.getNode('/'+STACKGROUP, INDEXNAME)
+	planeShape = earr.shape[1:]
+    elif shapes:
+	planeShape = shapes[0]
+	stackroot  = skyFile.createGroup(skyFile.root, STACKGROUP,
+					title="All Subband Images")
+	earr  = skyFile.createEArray(stackroot, STACKNAME, tables.Float32Atom(),
+				     (0,) + planeShape,
+				     title="Subband, y, x Image Stack",
+				     filters=filters or tables.Filters(),
+				     chunkshape=stackChunkShape(planeShape, stackDepth),
+				     expectedrows=len(fileNames))
+	index = skyFile.createTable(stackroot, INDEXNAME, SubbandIndex,
+				    title="Subband Index of "+STACKNAME)
+    else:
+	return {}
+
+    for fName, shape in zip(fileNames, shapes):
+	if tuple(shape) != tuple(planeShape):
+	    raise ValueError("Cannot stack "+basename(fName)+", shape "+
+			     str(tuple(shape))+" is not "+str(tuple(planeShape)))
+
+    # Index table rows of the subbands already stacked.
+    known = {}
+    for entry in index:
+	known[entry['SUBBAND']] = entry.nrow
+
+    stackRows = {}
+    tasks     = []
+    newNames  = []
+    nextRow   = earr.nrows
+    for n in range(len(nameStruct)):
+	sBand   = nameStruct[n]
+	subband = int(sBand[0][2:])
+	if subband in known:
+	    row = index.cols.ROW[known[subband]]
+	    index.cols.FREQUENCY[known[subband]] = skimReaders.slingFrequency(fileNames[n])
+	    tasks.append(stackTasks([fileNames[n]], planeShape, stackDepth,
+				    tileBytes, start=row))
+	else:
+	    row = nextRow
+	    nextRow += 1
+	    newNames.append(fileNames[n])
+	    index.row['SUBBAND']   = subband
+	    index.row['ROW']       = row
+	    index.row['FREQUENCY'] = skimReaders.slingFrequency(fileNames[n])
+	    index.row['GROUP']     = '/' + sBand[1]
+	    index.row['FILENAME']  = sBand[-1]
+	    index.row.append()
+	stackRows[sBand[0]] = row
+    index.flush()
+    if index.cols.SUBBAND.index is None:
+	index.cols.SUBBAND.createIndex()
+
+    tasks.append(stackTasks(newNames, planeShape, stackDepth, tileBytes,
+			    start=earr.nrows))
+    tiles = skimIngest.throttle(skimIngest.slingTiles(itertools.chain(*tasks),
+						      workers=workers, depth=depth),
+				bandwidth)
+    if imageSum is not None:
+	tiles = imageSum.tiles(tiles, stacked=True)
+    if stats is not None:
+	tiles = skimStats.stackStats(tiles, stats)
+    writeStack(earr, tiles)
+    return stackRows
+
+
+def linkStack(skyFile, datasetHook, row):
+    """Make a subband's data group a reference into the stack: a soft link
+    named skyCube to /SkyCube/skyCube, and the subband's STACK_ROW.
+    """
+    skyFile.createSoftLink(datasetHook, STACKNAME, '/'+STACKGROUP+'/'+STACKNAME)
+    skyFile.setNodeAttr(datasetHook, 'STACK_ROW', row)
+    return
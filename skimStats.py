@@ -0,0 +1,234 @@
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Image statistics.
+#
+# The statistics of each subband image, taken from its ingest tiles as they
+# pass, see ImageStats.tiles(), so that quality control and display ranges
+# need no read of the data: the count of its pixels and of its NaN (and
+# other non-finite) pixels, and of the finite ones the minimum, maximum,
+# mean, standard deviation, RMS and PERCENTILES.  As for skimIngest.ImageSum,
+# only the first plane of a cube is taken.
+#
+# Mean and deviation are merged tile by tile (Chan et al.), in float64.
+# Percentiles come from a histogram of the top 16 bits of each float32
+# value, sign, exponent and 7 mantissa bits: 65536 fixed bins, each within
+# 1/128 of its value, made with one bincount and merged by adding.  So a
+# percentile is good to better than 1%, at any scale, linearly interpolated
+# within its bin.
+#
+# The statistics of each image are written as attributes of its skyData
+# group, DATAMIN, DATAMAX, DATAMEAN, DATASTD, DATARMS, NPIXELS, NNAN,
+# PERCENTILES and PERCENTILE_VALUES, and as a row of the per-file table
+# /Statistics/imageStatistics, indexed by SUBBAND.
+
+import numpy
+import tables
+
+STATSGROUP  = "Statistics"
+STATSNAME   = "imageStatistics"
+PERCENTILES = (0.1, 1.0, 5.0, 25.0, 50.0, 75.0, 95.0, 99.0, 99.9)
+NBINS       = 1 << 16
+_half       = NBINS // 2
+
+# Lower edges of the bins of non-negative values, by bin.
+_edges = (numpy.arange(_half + 1, dtype=numpy.uint32) << 16).view(numpy.float32)
+
+
+class ImageStatistics(tables.IsDescription):
+    SUBBAND     = tables.Int32Col(pos=0)
+    GROUP       = tables.StringCol(32, pos=1)
+    NPIXELS     = tables.Int64Col(pos=2)
+    NNAN        = tables.Int64Col(pos=3)
+    MIN         = tables.Float64Col(pos=4)
+    MAX         = tables.Float64Col(pos=5)
+    MEAN        = tables.Float64Col(pos=6)
+    STD         = tables.Float64Col(pos=7)
+    RMS         = tables.Float64Col(pos=8)
+    PERCENTILES = tables.Float64Col(shape=(len(PERCENTILES),), pos=9)
+
+
+class ImageStats(object):
+    """Running statistics of one image, from its values as they pass."""
+
+    def __init__(self):
+	self.npixels = 0
+	self.count   = 0            # finite values
+	self.mean    = 0.0
+	self.m2      = 0.0          # sum of squared deviations from the mean
+	self.lo      = None
+	self.hi      = None
+	self.hist    = numpy.zeros(NBINS, dtype=numpy.int64)
+
+    def update(self, values):
+	"""Add the float32 array values."""
+	values = numpy.asarray(values, dtype=numpy.float32)
+	self.npixels += values.size
+	valid  = numpy.isfinite(values)
+	if valid.all():
+	    finite = values.ravel()
+	else:
+	    finite = values[valid]
+	n      = finite.size
+	if not n:
+	    return
+	mean = finite.sum(dtype=numpy.float64) / n
+	dev  = finite - numpy.float32(mean)
+	m2   = numpy.square(dev, out=dev).sum(dtype=numpy.float64)
+	self._merge(n, mean, m2, float(finite.min()), float(finite.max()))
+	self.hist += numpy.bincount(numpy.right_shift(finite.view(numpy.uint32), 16,
+						      dtype=numpy.intp),
+				    minlength=NBINS)
+	return
+
+    def _merge(self, n, mean, m2, lo, hi):
+	"""Merge in the count, mean, squared deviations and range of other
+	values.
+	"""
+	total      = self.count + n
+	delta      = mean - self.mean
+	self.mean += delta * n / total
+	self.m2   += m2 + delta * delta * self.count * n / total
+	self.count = total
+	if self.lo is None or lo < self.lo:
+	    self.lo = lo
+	if self.hi is None or hi > self.hi:
+	    self.hi = hi
+	return
+
+    def merge(self, other):
+	"""Merge in the ImageStats other, eg. of another part of the image."""
+	self.npixels += other.npixels
+	if other.count:
+	    self._merge(other.count, other.mean, other.m2, other.lo, other.hi)
+	    self.hist += other.hist
+	return
+
+    def add(self, key, dataTile):
+	"""Add the tile at key of an image dataset.  Tiles of planes other
+	than the first are ignored.
+	"""
+	for idx in key[:-2]:
+	    if not isinstance(idx, slice) and idx != 0:
+		return
+	self.update(dataTile.reshape((-1,) + dataTile.shape[-2:])[0])
+	return
+
+    def tiles(self, tiles):
+	"""Generator, passes on each (key, dataTile) of tiles, adding each."""
+	for key, dataTile in tiles:
+	    self.add(key, dataTile)
+	    yield key, dataTile
+	return
+
+    def std(self):
+	"""The standard deviation of the finite values, NaN if none."""
+	if not self.count:
+	    return numpy.nan
+	return (self.m2 / self.count) ** 0.5
+
+    def rms(self):
+	"""The root mean square of the finite values, NaN if none."""
+	if not self.count:
+	    return numpy.nan
+	return (self.m2 / self.count + self.mean ** 2) ** 0.5
+
+    def percentiles(self, levels=PERCENTILES):
+	"""Returns the float64 array of the percentiles levels of the finite
+	values, all NaN if there are none.
+	"""
+	if not self.count:
+	    return numpy.array([numpy.nan] * len(levels))
+	# The bins in ascending order of value: negatives, largest first,
+	# then the rest.
+	counts = numpy.concatenate([self.hist[:_half - 1:-1], self.hist[:_half]])
+	above  = numpy.cumsum(counts)
+	values = []
+	for level in levels:
+	    rank  = level / 100.0 * (self.count - 1)
+	    n     = min(int(numpy.searchsorted(above, rank, side='right')), NBINS - 1)
+	    below = above[n] - counts[n]
+	    frac  = min(1.0, max(0.0, (rank - below + 0.5) / max(counts[n], 1)))
+	    if n < _half:
+		mag     = _half - 1 - n
+		lo, hi  = -_edges[mag + 1], -_edges[mag]
+	    else:
+		lo, hi  = _edges[n - _half], _edges[n - _half + 1]
+	    values.append(min(self.hi, max(self.lo, lo + frac * (hi - lo))))
+	return numpy.array(values, dtype=numpy.float64)
+
+    def attributes(self):
+	"""The (key, value) list of the image's statistics attributes."""
+	lo, hi, mean = self.lo, self.hi, self.mean
+	if not self.count:
+	    lo = hi = mean = numpy.nan
+	return [('NPIXELS',           self.npixels),
+		('NNAN',              self.npixels - self.count),
+		('DATAMIN',           lo),
+		('DATAMAX',           hi),
+		('DATAMEAN',          mean),
+		('DATASTD',           self.std()),
+		('DATARMS',           self.rms()),
+		('PERCENTILES',       numpy.array(PERCENTILES)),
+		('PERCENTILE_VALUES', self.percentiles()),
+		]
+
+
+def stackStats(tiles, stats):
+    """Generator, passes on each (key, dataTile) of the (subband, y, x)
+    stack tiles, adding each plane to the ImageStats of its stack row in the
+    dictionary stats, made there on first use.
+    """
+    for key, dataTile in tiles:
+	for n, plane in enumerate(dataTile):
+	    row = key[0].start + n
+	    if row not in stats:
+		stats[row] = ImageStats()
+	    stats[row].update(plane)
+	yield key, dataTile
+    return
+
+
+def openTable(skyFile):
+    """Returns the statistics table of an open skim file, creating it if
+    need be.
+    """
+    if '/' + STATSGROUP + '/' + STATSNAME in skyFile:
+	return skyFile.getNode('/'+STATSGROUP, STATSNAME)
+    if '/' + STATSGROUP not in skyFile:
+	skyFile.createGroup(skyFile.root, STATSGROUP, title="Image Statistics")
+    table = skyFile.createTable('/'+STATSGROUP, STATSNAME, ImageStatistics,
+				title="Statistics of each Subband Image")
+    skyFile.setNodeAttr(table, 'PERCENTILES', numpy.array(PERCENTILES))
+    table.cols.SUBBAND.createIndex()
+    return table
+
+
+def record(table, subband, group, attrList):
+    """Record the statistics of the image of subband, a number, in its Image
+    group, group, replacing any earlier row of the subband.  attrList is as
+    from ImageStats.attributes().
+    """
+    for rowNum in reversed(table.getWhereList('SUBBAND == sb',
+					      condvars={'sb': subband})):
+	table.removeRows(rowNum, rowNum+1)
+    attrs = dict(attrList)
+    row   = table.row
+    row['SUBBAND']     = subband
+    row['GROUP']       = group
+    row['NPIXELS']     = attrs['NPIXELS']
+    row['NNAN']        = attrs['NNAN']
+    row['MIN']         = attrs['DATAMIN']
+    row['MAX']         = attrs['DATAMAX']
+    row['MEAN']        = attrs['DATAMEAN']
+    row['STD']         = attrs['DATASTD']
+    row['RMS']         = attrs['DATARMS']
+    row['PERCENTILES'] = attrs['PERCENTILE_VALUES']
+    row.append()
+    table.flush()
+    return
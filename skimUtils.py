@@ -7,10 +7,91 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
-import sys, glob
-import os
+import sys
+import re
+import time
 from   os.path import basename, isdir, join
 import getopt
+import skimIngest
+import skimDiscovery
+import skimMetrics
+import skimProfile
+import skimQuantize
+import skimPyramid
+
+# Options setting the skim build, common to all skim command lines.  Each
+# sets a keyword argument of skim.run() and skimAll.buildSkim(), see
+# buildOption().
+BUILD_OPTIONS = ['workers=',
+		 'depth=',
+		 'tilemb=',
+		 'complib=',
+		 'complevel=',
+		 'noshuffle',
+		 'bitshuffle',
+		 'chunks=',
+		 'cube',
+		 'stack',
+		 'stackdepth=',
+		 'resume',
+		 'mbps=',
+		 'average',
+		 'pattern=',
+		 'recursive',
+		 'metrics=',
+		 'tree',
+		 'profile=',
+		 'quantize=',
+		 'maxerror=',
+		 'pyramid',
+		 'stats',
+		 'sources'
+		 ]
+
+BUILD_USAGE = '\t--workers=N       read subband images with N reader processes (default 1)\n' + \
+	      '\t--depth=N         image tiles read ahead of the HDF5 writer (default 2*workers)\n' + \
+	      '\t--tilemb=N        size in MB of the image tiles copied into the file (default 16)\n' + \
+	      '\t--complib=LIB     compress image datasets with LIB, one of zlib, lzo, bzip2,\n' + \
+	      '\t                  blosc, or a blosc codec, eg. blosc:lz4\n' + \
+	      '\t--complevel=N     compression level, 0-9 (default 5 with --complib)\n' + \
+	      '\t--noshuffle       do not byte shuffle ahead of compression\n' + \
+	      '\t--bitshuffle      bit shuffle instead (blosc only)\n' + \
+	      '\t--chunks=POLICY   chunk layout for the expected reads: "plane" (default)\n' + \
+	      '\t                  for whole-plane reads, "tile" for cutouts, "cube" for\n' + \
+	      '\t                  per-pixel reads through the planes of --cube datasets\n' + \
+	      '\t--cube            store the full Stokes/channel cube of each subband, not\n' + \
+	      '\t                  just its first image plane\n' + \
+	      '\t--stack           write all subband planes into one (subband, y, x) dataset,\n' + \
+	      '\t                  /SkyCube/skyCube, for fast per-pixel spectra\n' + \
+	      '\t--stackdepth=N    subbands per chunk of the stack (default 8)\n' + \
+	      '\t--resume          add to an existing skim file: only new, changed or\n' + \
+	      '\t                  half-written images are (re)built\n' + \
+	      '\t--mbps=N          cap the image copy rate at N MB/s\n' + \
+	      '\t--average         with no average image in the results, store the\n' + \
+	      '\t                  average of the subband images, summed as they are\n' + \
+	      '\t                  copied\n' + \
+	      '\t--pattern=REGEX   regular expression of the subband ID in the image file\n' + \
+	      '\t                  names, its digits as group 1 (default "SB(\\d+)")\n' + \
+	      '\t--recursive       find images in the directories under the run directory\n' + \
+	      '\t                  too\n' + \
+	      '\t--metrics=FILE    write the build metrics to FILE, as a Prometheus text\n' + \
+	      '\t                  file if it is named *.prom, else as JSON\n' + \
+	      '\t--tree            print the full node tree of the skim file when done\n' + \
+	      '\t--profile=DIR     profile the build stages into DIR: cProfile stats,\n' + \
+	      '\t                  allocations where tracemalloc is available, and\n' + \
+	      '\t                  collapsed stacks for flame graphs\n' + \
+	      '\t--quantize=MODE   store subband images quantized to their noise: "noise"\n' + \
+	      '\t                  for rounded float32, "int16" or "int8" for scaled\n' + \
+	      '\t                  integers with BSCALE/BZERO attributes\n' + \
+	      '\t--maxerror=X      largest quantization error, in units of the image noise\n' + \
+	      '\t                  (default '+str(skimQuantize.MAXERROR)+')\n' + \
+	      '\t--pyramid         also store each image binned 2x2, 4x4, ... down to\n' + \
+	      '\t                  '+str(skimPyramid.MINSIZE)+' pixels, for previews\n' + \
+	      '\t--stats           store the statistics of each subband image, taken as\n' + \
+	      '\t                  it is copied, as attributes and in /Statistics\n' + \
+	      '\t--sources         find the sources of each subband image as it is copied,\n' + \
+	      '\t                  into the sourceList table of its Source group (scipy)\n\n'
+
 
 def usage(mod):
 
@@ -23,7 +104,7 @@ def usage(mod):
        '\tOBS/results/\n'+\
        '\tOBS/vds/\n\n'+ \
        '\twhere pipeline produced images exist under the "results/" directory.\n\n'+\
-       '\t[options] allow only one keyword argument:\n\n' + \
+       '\t[options] require one keyword argument:\n\n' + \
        '\t--run=yyyy-mm-ddThh:mm:ss\n\n' + \
        '\twhere yyyy-mm-ddThh:mm:ss is an ISO 8601 standard time field format\n'+ \
        '\tand where that time represents a "results" subdirectory name, which is the\n'+ \
@@ -40,18 +121,26 @@ def usage(mod):
        '\t2009-10-13T13:46:55/\n' + \
        '\t2009-10-13T15:26:51/\n\n' + \
        '\tExample: skim images for a particular pipeline run of L2009_13591_8\n\n'+ \
-       '\t% skim --run=2009-10-13T13:44:49 /pipeline_runtime/jobs/L2009_13591_8\n\n'
+       '\t% skim --run=2009-10-13T13:44:49 /pipeline_runtime/jobs/L2009_13591_8\n\n'+ \
+       '\tFurther optional keyword arguments:\n\n' + BUILD_USAGE
 
     return useBurp
 
 
 def handleCLargs(args):
-    mod = basename(sys.argv[0])
+    """Parse the command line, args being sys.argv.  Returns a 3-tuple,
+
+    (observation, runTimeLabel, clOpts),
+
+    where clOpts is a dictionary of keyword arguments for skim.run() and
+    skimAll.buildSkim(), holding only those options passed on the command line.
+    """
+    mod = basename(args[0])
     long_options = ['help',
 		    'run='
-		    ]
+		    ] + BUILD_OPTIONS
     try:
-	opts, arg = getopt.getopt(sys.argv[1:],'',long_options)
+	opts, arg = getopt.getopt(args[1:],'',long_options)
     except getopt.GetoptError:
 	sys.exit(usage(mod))
 
@@ -62,31 +151,150 @@ def handleCLargs(args):
     if len(arg) != 1:
        	sys.exit(usage(mod))
 
-    observation = arg[0]
-    cl_switches = []
-    # cl_switches is left as a hook for handling possible future options,
-    # options that do not exist at the moment. -kra, 21.10.2009.
+    observation  = arg[0]
+    runTimeLabel = None
+    clOpts       = {}
+
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+
+	elif o in ("--run",):
+	    runTimeLabel = a
+	    imPath = join(observation,"results",runTimeLabel)
+	    if not isdir(imPath):
+		msg="\n\n\tError: Path to directory "+runTimeLabel+" not found.\n"
+		sys.exit(msg)
+
+	elif buildOption(o, a, clOpts):
+	    pass
+
+	else:
+	    sys.exit(usage(mod))
+
+    if runTimeLabel is None:
+	sys.exit(usage(mod))
+
+    return observation, runTimeLabel, clOpts
+
+
+def intArg(option, value):
+    """Return the integer value of a command line option, or exit with a
+    message saying which option was bad.
+    """
+    try:
+	return int(value)
+    except ValueError:
+	sys.exit("\n\n\tError: "+option+" requires an integer, got '"+value+"'.\n")
+
+
+def floatArg(option, value):
+    """Return the float value of a command line option, or exit with a
+    message saying which option was bad.
+    """
+    try:
+	return float(value)
+    except ValueError:
+	sys.exit("\n\n\tError: "+option+" requires a number, got '"+value+"'.\n")
+
+
+def buildOption(o, a, clOpts):
+    """Set the skim build keyword argument of command line option o, with
+    value a, in the clOpts dictionary.  Returns False if o is not one of
+    BUILD_OPTIONS.
+    """
+    if o in ("--workers", "--depth"):
+	clOpts[o[2:]] = intArg(o, a)
 
-    if opts:
-	for o, a in opts:
-	    if a:
-		cl_switches.append(o+"="+a)
-	    else:
-		cl_switches.append(o)
+    elif o in ("--tilemb",):
+	clOpts['tileBytes'] = intArg(o, a) * 1024 * 1024
 
-	    if o in ("--help",):
-		sys.exit(usage(mod))
+    elif o in ("--complib",):
+	import skimFilters
+	if not skimFilters.available(a):
+	    sys.exit("\n\n\tError: --complib "+a+" is not available here; use one of "+
+		     ", ".join([lib for lib in skimFilters.COMPLIBS
+				if skimFilters.available(lib)])+
+		     ", or a blosc codec.\n")
+	clOpts['complib'] = a
 
-	    if o in ("--run",):
-		runTimeLabel = a
-		imPath = join(observation,"results",runTimeLabel)
-		if not isdir(imPath):
-		    msg="\n\n\tError: Path to directory "+runTimeLabel+" not found.\n"
-		    sys.exit(msg)
-	    else:
-		sys.exit(usage(mod))
+    elif o in ("--complevel",):
+	clOpts['complevel'] = intArg(o, a)
 
-    return observation, runTimeLabel
+    elif o in ("--noshuffle",):
+	clOpts['shuffle'] = False
+
+    elif o in ("--bitshuffle",):
+	clOpts['bitshuffle'] = True
+
+    elif o in ("--chunks",):
+	if a not in skimIngest.CHUNK_POLICIES:
+	    sys.exit("\n\n\tError: --chunks must be one of "+
+		     ", ".join(skimIngest.CHUNK_POLICIES)+".\n")
+	clOpts['chunks'] = a
+
+    elif o in ("--cube",):
+	clOpts['cube'] = True
+
+    elif o in ("--stack",):
+	clOpts['stack'] = True
+
+    elif o in ("--stackdepth",):
+	clOpts['stackDepth'] = intArg(o, a)
+
+    elif o in ("--resume",):
+	clOpts['resume'] = True
+
+    elif o in ("--mbps",):
+	clOpts['bandwidth'] = intArg(o, a) * 1024 * 1024
+
+    elif o in ("--average",):
+	clOpts['average'] = True
+
+    elif o in ("--pattern",):
+	try:
+	    clOpts['pattern'] = skimDiscovery.compilePattern(a).pattern
+	except (re.error, ValueError), err:
+	    sys.exit("\n\n\tError: Bad --pattern '"+a+"': "+str(err)+".\n")
+
+    elif o in ("--recursive",):
+	clOpts['recursive'] = True
+
+    elif o in ("--metrics",):
+	clOpts['metrics'] = a
+
+    elif o in ("--tree",):
+	clOpts['tree'] = True
+
+    elif o in ("--profile",):
+	clOpts['profile'] = a
+
+    elif o in ("--quantize",):
+	if a not in skimQuantize.QUANTIZE_MODES:
+	    sys.exit("\n\n\tError: --quantize must be one of "+
+		     ", ".join(skimQuantize.QUANTIZE_MODES)+".\n")
+	clOpts['quantize'] = a
+
+    elif o in ("--maxerror",):
+	clOpts['maxError'] = floatArg(o, a)
+	if not clOpts['maxError'] > 0:
+	    sys.exit("\n\n\tError: --maxerror must be > 0.\n")
+
+    elif o in ("--pyramid",):
+	clOpts['pyramid'] = True
+
+    elif o in ("--stats",):
+	clOpts['stats'] = True
+
+    elif o in ("--sources",):
+	import skimSources
+	if not skimSources.available():
+	    sys.exit("\n\n\tError: --sources needs scipy.\n")
+	clOpts['sources'] = True
+
+    else:
+	return False
+    return True
 
 
 def mkSimpleFileName(obsName):
@@ -116,25 +324,22 @@ def makePipeResultsPath(obsDir, pipeLabel):
     return join(obsDir,"results",pipeLabel)
 
 
-def mkFitsImageList(pipeResults):
+@skimProfile.profiled('discover')
+def mkFitsImageList(pipeResults, pattern=None, recursive=False):
     """Method will return a 2-tuple, where element 0 will be the name of the
     averaged image found, if any, and a list of the observation's subband fits
-    images.
+    images, in subband order.  pattern is the regular expression of the
+    subband ID in the image names, and with recursive the directories under
+    pipeResults are searched too; see skimDiscovery.
 
     eg, return (aveImage, fitslist),
 
     where aveImage is either a filename string, or None.
     """
-    fitsList = []
-    aveIm = ''
-    curdir=os.getcwd()
-    os.chdir(pipeResults)
-    imList = glob.glob("*.fits")
-    aveIm, subbandImList = handleAveIm(imList)
-    for im in subbandImList:
-	fitsList.append(im)
-    os.chdir(curdir)
-    return (aveIm,fitsList)
+    start  = time.time()
+    images = skimDiscovery.discover(pipeResults, pattern, recursive)
+    skimMetrics.add('discover', time.time() - start, count=len(images[1]))
+    return images
 
 
 def handleAveIm(imList):
@@ -158,16 +363,20 @@ def handleAveIm(imList):
     return (aveIm, imList)
 
 
-def finish(skyFile, logger):
-    """Finish off the file."""
-    print "Processing complete."
-    print
-    print "LOFAR Sky Image file form:"
-    print
-    print skyFile
-    logger.debug("Processing complete.")
-    logger.debug("LOFAR Sky Image file form:")
-    logger.info(str(skyFile))
+@skimProfile.profiled('finish')
+def finish(skyFile, logger, tree=False):
+    """Finish off the file.  The full node tree of the file is printed only
+    with tree=True; it is long, and costly for files of many subbands.
+    """
+    counters = skimMetrics.report()['counters']
+    logger.info("Processing complete: %s, %d subbands and %.1f MB written.",
+		skyFile.filename, counters.get('subbands', 0),
+		counters['bytes_written'] / 1e6)
+    if tree:
+	print
+	print "LOFAR Sky Image file form:"
+	print
+	print skyFile
     skyFile.close()
     del skyFile
     return
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# $Id$
+# ---------------------------------------------------------------------
+__version__      = '$Revision$'[11:-3]
+__version_date__ = '$Date$'[7:-3]
+__author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
+# ---------------------------------------------------------------------
+
+# Watch mode.
+#
+# Skims the results directories of an observation while the imaging pipeline
+# is still writing them, so that conversion overlaps with imaging.  Every
+# run directory, OBS/results/<runTimeLabel>/, is polled for *.fits images.
+# An image is taken to be complete once its size and mtime have not changed
+# for 'settle' seconds, and is then added to the run's skim file by a resumed
+# skim.run(), see skimManifest.  Only the images that have settled since the
+# last pass are read.
+#
+# A run is finalized when its completion marker file appears, and all of its
+# images have settled: the skim file is brought up to date one last time,
+# with the full image list, and the run is no longer watched.
+#
+# Between passes the skim file is closed, so it can be read at any time.
+#
+# A build that fails, on an unreadable or half-written image say, is logged
+# and the watch goes on.  Its new images stay pending, and are retried one
+# by one, to single out the one at fault, after BACKOFF seconds, doubling
+# with each failure up to MAXBACKOFF.  An image in RETRIES failed builds is
+# given up on, and left out of the run, until it is rewritten.
+
+import sys
+import os
+import time
+import getopt
+import logging
+from   os.path import basename, isdir, join
+import skim
+import skimUtils
+import skimDiscovery
+import skimReaders
+
+POLL       = 2.0        # seconds between directory scans
+SETTLE     = 5.0        # seconds an image must stay unchanged to be skimmed
+MARKER     = "DONE"     # completion marker written to a run directory
+RETRIES    = 3        # failed builds before an image is given up on
+BACKOFF    = 30.0     # seconds before a failed build is retried
+MAXBACKOFF = 600.0
+
+
+def usage(mod):
+    useBurp = '\n\tUsage: '+ mod + ' [options] obs\n\n' + \
+	'\tWatch the "results/" run directories of the observation directory\n' + \
+	'\tobs, and skim their subband images as the imaging pipeline writes\n' + \
+	'\tthem.  Each run is finalized when its completion marker appears.\n\n' + \
+	'\t[options]\n\n' + \
+	'\t--poll=S          seconds between directory scans (default 2)\n' + \
+	'\t--settle=S        seconds an image must stay unchanged before it is\n' + \
+	'\t                  skimmed (default 5)\n' + \
+	'\t--marker=NAME     completion marker file name (default DONE)\n' + \
+	'\t--exit            exit once every run found has been finalized,\n' + \
+	'\t                  rather than watching for new runs\n\n' + \
+	'\tFurther optional keyword arguments, as for skim:\n\n' + \
+	skimUtils.BUILD_USAGE
+    return useBurp
+
+
+def settledImages(resultsPath, seen, settle, now, recursive=False):
+    """Returns a 2-tuple,
+
+    (settled, pending),
+
+    the sorted lists of the images in resultsPath, and with recursive
+    the directories under it, that have, and have not yet, stayed unchanged
+    for settle seconds.  seen is the dictionary of (size, mtime, since) of
+    each image, kept by the caller between scans.
+    """
+    settled = []
+    pending = []
+    for fName in skimDiscovery.findImages(resultsPath, recursive=recursive):
+	try:
+	    stamp = skimReaders.sourceStat(join(resultsPath, fName))
+	except OSError:
+	    continue
+	last = seen.get(fName)
+	if last is None or last[:2] != stamp:
+	    seen[fName] = stamp + (now,)
+	    pending.append(fName)
+	elif now - last[2] >= settle:
+	    settled.append(fName)
+	else:
+	    pending.append(fName)
+    return settled, pending
+
+
+def watchRun(obs, runTimeLabel, state, logger, settle=SETTLE, marker=MARKER,
+	     now=None, **clOpts):
+    """One pass over one run directory.  Skims the images that have settled
+    since the last pass, and finalizes the run once its marker is there and
+    nothing is pending.  state is the run's dictionary, kept by the caller
+    between passes.  A failed build is logged, and retried in a later pass,
+    see RETRIES and BACKOFF.  Returns True once the run is finalized.
+    """
+    resultsPath = skimUtils.makePipeResultsPath(obs, runTimeLabel)
+    if now is None:
+	now = time.time()
+    state.setdefault('seen', {})
+    state.setdefault('skimmed', set())
+    state.setdefault('failures', {})
+    state.setdefault('attempts', 0)
+    state.setdefault('retryAt', 0.0)
+    failures         = state['failures']
+    finished         = os.path.exists(join(resultsPath, marker))
+    settled, pending = settledImages(resultsPath, state['seen'], settle, now,
+				     clOpts.get('recursive', False))
+    # An image rewritten after it was skimmed, or given up on, is skimmed
+    # again once settled.
+    state['skimmed'].difference_update(pending)
+    for fName in pending:
+	failures.pop(fName, None)
+    settled          = [fName for fName in settled if failures.get(fName, 0) < RETRIES]
+    new              = [fName for fName in settled if fName not in state['skimmed']]
+    held             = []
+    if len(new) > 1 and [fName for fName in new if fName in failures]:
+	new, held = new[:1], new[1:]
+	settled   = [fName for fName in settled if fName not in held]
+    final            = finished and not pending and not held
+    if (new or final) and now >= state['retryAt']:
+	logger.info(runTimeLabel + ": skimming " + (", ".join(new) or "nothing new") +
+		    (final and ", finalizing" or ""))
+	clOpts['resume'] = True
+	try:
+	    skim.run(obs, runTimeLabel, logger,
+		     fitsImages=skimDiscovery.splitImages(settled, clOpts.get('pattern')),
+		     **clOpts)
+	except Exception:
+	    logger.exception(runTimeLabel + ": build failed, retried in a later pass")
+	    state['attempts'] += 1
+	    state['retryAt']   = now + min(BACKOFF * 2 ** (state['attempts'] - 1),
+					   MAXBACKOFF)
+	    for fName in new:
+		failures[fName] = failures.get(fName, 0) + 1
+		if failures[fName] >= RETRIES:
+		    logger.error(runTimeLabel + ": giving up on " + fName +
+				 " after %d failed builds" % RETRIES)
+	    return False
+	state['attempts'] = 0
+	state['retryAt']  = 0.0
+	for fName in new:
+	    failures.pop(fName, None)
+	state['skimmed'].update(new)
+	return final
+    return False
+
+
+def watch(obs, logger, poll=POLL, settle=SETTLE, marker=MARKER,
+	  exitWhenDone=False, **clOpts):
+    """Watch the run directories of the observation directory obs, and keep
+    their skim files up to date with the settled images in them, see
+    watchRun().  clOpts are passed on to skim.run().  Watches for ever, or
+    with exitWhenDone until every run found has been finalized.
+    """
+    resultsDir = join(obs, "results")
+    runs       = {}
+    logger.info("Watching " + resultsDir + " ...")
+    while True:
+	now = time.time()
+	if isdir(resultsDir):
+	    for runTimeLabel in sorted(os.listdir(resultsDir)):
+		if not isdir(join(resultsDir, runTimeLabel)):
+		    continue
+		state = runs.setdefault(runTimeLabel, {'final': False})
+		if state['final']:
+		    continue
+		state['final'] = watchRun(obs, runTimeLabel, state, logger,
+					  settle=settle, marker=marker, now=now,
+					  **clOpts)
+		if state['final']:
+		    logger.info(runTimeLabel + ": finalized " +
+				skimUtils.mkOutFileName(obs, runTimeLabel))
+	if exitWhenDone and runs and all([state['final'] for state in runs.values()]):
+	    return
+	time.sleep(poll)
+
+
+def handleCLargs(args):
+    """Parse the command line, args being sys.argv.  Returns a 2-tuple,
+
+    (observation, watchOpts),
+
+    where watchOpts is a dictionary of keyword arguments for watch().
+    """
+    mod = basename(args[0])
+    long_options = ['help', 'poll=', 'settle=', 'marker=', 'exit'
+		    ] + skimUtils.BUILD_OPTIONS
+    try:
+	opts, arg = getopt.getopt(args[1:], '', long_options)
+    except getopt.GetoptError:
+	sys.exit(usage(mod))
+    if len(arg) != 1:
+	sys.exit(usage(mod))
+
+    watchOpts = {}
+    for o, a in opts:
+	if o in ("--help",):
+	    sys.exit(usage(mod))
+	elif o in ("--poll", "--settle"):
+	    try:
+		watchOpts[o[2:]] = float(a)
+	    except ValueError:
+		sys.exit("\n\n\tError: "+o+" requires a number of seconds, got '"+a+"'.\n")
+	elif o in ("--marker",):
+	    watchOpts['marker'] = a
+	elif o in ("--exit",):
+	    watchOpts['exitWhenDone'] = True
+	elif skimUtils.buildOption(o, a, watchOpts):
+	    pass
+	else:
+	    sys.exit(usage(mod))
+
+    if not isdir(arg[0]):
+	sys.exit("\n\n\tError: Observation directory "+arg[0]+" not found.\n")
+    return arg[0], watchOpts
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format="%(asctime)s %(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    obs, watchOpts = handleCLargs(sys.argv)
+    try:
+	watch(obs, logger, **watchOpts)
+    except KeyboardInterrupt:
+	logger.info("Stopped.")
+    sys.exit(0)
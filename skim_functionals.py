@@ -7,14 +7,23 @@ __version_date__ = '$Date$'[7:-3]
 __author__       = "K.R. Anderson, <k.r.anderson@uva.nl>"
 # ---------------------------------------------------------------------
 
+import logging
 from   os.path import join
 import tables
-import fitsHandlers
+import skimReaders
+import skimIngest
+import skimStack
+import skimManifest
 import groupNames
 import attributeSets
+import skimMetrics
+import skimProfile
+import skimQuantize
+import skimPyramid
+import skimStats
 import skimUtils
 
-def initialize(obs, runTimeLabel):
+def initialize(obs, runTimeLabel, pattern=None, recursive=False):
     """Initial setup for building a skim file.  nameStruct below is a structured
     tuple, wherein each tuple element has the name of the sub-band, and the
     group names for all subgroups for the particular sub-band image.
@@ -23,25 +32,31 @@ def initialize(obs, runTimeLabel):
 
     ('SB061','Image061','Sub-band061','skyData',
     'Coordinates','Linear-coord','Source', 'ProcessHist')
+
+    pattern and recursive set how the subband images are found, see
+    skimDiscovery.
     """
 
     lofarFileName       = skimUtils.mkOutFileName(obs,runTimeLabel)
     resultsPath         = skimUtils.makePipeResultsPath(obs,runTimeLabel)
-    aveImage, imageList = skimUtils.mkFitsImageList(resultsPath)
-    nameObj             = groupNames.GroupNames(imageList)
+    aveImage, imageList = skimUtils.mkFitsImageList(resultsPath, pattern,
+							    recursive)
+    nameObj             = groupNames.GroupNames(imageList, pattern=pattern)
     nameStruct          = nameObj.makeGroupNames()
     attrs               = attributeSets.AttributeSets()
     return (lofarFileName, resultsPath, aveImage, imageList, nameStruct, attrs)
 
 
-def buildRoot(obs, lofarFileName, nimages, attrs):
-    skyFile     = tables.openFile(lofarFileName, mode="w", title="LOFAR Sky Image")
+def buildRoot(obs, lofarFileName, nimages, attrs, resume=False):
+    """Open the skim file and set its root attributes.  With resume=True an
+    existing skim file is opened for adding to, see skimManifest.openSkim().
+    """
+    skyFile, fresh = skimManifest.openSkim(lofarFileName, resume)
     root        = skyFile.root
-    attributues = attrs
+    attributes  = attrs
     attributes.initHeader('Root',obs=obs, nimages=nimages)
     rootHeader = attributes.attributeSet('Root')
-    for key, val in rootHeader:
-	root.key = val
+    attributeSets.writeAttributes(root, rootHeader)
     return skyFile
 
 
@@ -50,131 +65,294 @@ def buildSysLog(skyFile, attrs):
     See LOFAR-USG-ICD-004, et al for specification.
     """
     root = skyFile.root
-    attributes = attrs
+    if "/SysLog" in skyFile:
+	return skyFile
     syslog = skyFile.createGroup(root, "SysLog", title = "Root System Log")
-    attributes.initHeader('Syslog')
-    syslogHeader = attributes.attributeSet('Syslog')
-    for key, value in syslogHeader:
-	syslog.key = value
+    attributeSets.writeAttributes(syslog, attributeSets.groupAttributes('Syslog'))
     return skyFile
 
 
-def buildAveIm(skyFile, aveImage):
-    """Find an average image in output results, if there.
+def buildAveIm(skyFile, aveImage, resultsPath, tileBytes=skimIngest.TILEBYTES,
+	       filters=None, chunks='plane', manifest=None, bandwidth=None,
+	       pyramid=False, checksums=False):
+    """Find an average image in output results, if there.  filters is the
+    tables.Filters of the dataset, see skimFilters.makeFilters(), and chunks
+    its chunk policy, see skimIngest.chunkShape().  With a manifest table, see
+    skimManifest.openManifest(), an unchanged average image already in the
+    file is kept, and a new one recorded, with its checksum if checksums,
+    see skimManifest.record().  bandwidth caps the copy rate, in
+    bytes per second, see skimIngest.throttle().  With pyramid=True, its
+    pyramid is built as it is copied, see skimPyramid.
     """
-    root = skyFile.root
+    root  = skyFile.root
+    aName = join(resultsPath,aveImage)
+    if manifest is not None and aveImage != '':
+	entries = skimManifest.readManifest(manifest)
+	if not skimManifest.isPending(skyFile, entries, '/AverageImages',
+				      aveImage, aName):
+	    logging.getLogger().info("Average image %s unchanged.", aveImage)
+	    return skyFile
     if aveImage != '':
-	print "Got average image,",aveImage,"handling ...\n"
-	aName     = join(resultsPath,aveImage)
+	logging.getLogger().debug("Got average image %s, handling ...", aveImage)
 	aveImroot =  skyFile.createGroup(root,"AverageImages",title = "Image Sums")
 	atom      = tables.Float32Atom()
-	dataChunk, dataShape = fitsHandlers.slingData(aName)
-	filters   = tables.Filters()
-	cArr = skyFile.createCArray(aveImroot,
-				    "averageImage",
-				    atom,
-				    dataShape,
-				    filters=filters,
-				    title="Incoherent Sum Image"
-				    )
-	cArr[:,:] = dataChunk
+	dataShape = skimReaders.slingShape(aName)
+	cArr = skimProfile.call('createCArray', skyFile.createCArray, aveImroot,
+				"averageImage",
+				atom,
+				dataShape,
+				filters=filters or tables.Filters(),
+				chunkshape=skimIngest.chunkShape(dataShape, chunks),
+				title="Incoherent Sum Image"
+				)
+	keys  = skimIngest.tileKeys(dataShape, tileBytes, chunks)
+	tiles = skimIngest.slingTiles([(key, [aName], key, False) for key in keys])
+	tiles = skimIngest.throttle(tiles, bandwidth)
+	if pyramid:
+	    levels = skimPyramid.Pyramid(skyFile, aveImroot, dataShape[-2:],
+					 filters, chunks)
+	    tiles  = levels.tiles(tiles)
+	skimIngest.writeTiles(cArr, tiles)
+	if pyramid:
+	    levels.close()
+	if manifest is not None:
+	    skimManifest.record(skyFile, manifest, aveImage, aName, '/AverageImages',
+				checksums)
     else: pass
     return skyFile
 
 
-def buildImageGrps(skyFile, nameStruct):
-    print "Root built. \nAttaching image groups now..."
-    root = skyFile.root
+def buildImageGrps(skyFile, nameStruct, resultsPath, attrs, workers=1, depth=None,
+		   tileBytes=skimIngest.TILEBYTES, filters=None, chunks='plane',
+		   cube=False, stackRows=None, manifest=None, bandwidth=None,
+		   imageSum=None, quantize=None, maxError=skimQuantize.MAXERROR,
+		   pyramid=False, stats=None, stackStats=None, sources=False,
+		   checksums=False):
+    """Attach all image groups.  Subband image tiles are read ahead by the ingest
+    pipeline, see skimIngest.slingImages(), and written here in nameStruct order.
+    If the subband images were stacked, pass the stack rows returned by
+    skimStack.buildStack() as stackRows; the data groups then refer to the stack.
+    With a manifest table, see skimManifest.openManifest(), each completed
+    image group is recorded in it, with checksums if checksums, see
+    skimManifest.record(); pass only skimManifest.pendingSubbands().
+    bandwidth caps the ingest rate, see skimIngest.slingImages().  Pass a
+    skimIngest.ImageSum as imageSum to sum the image planes as they pass.
+    quantize and maxError set the skimQuantize.Quantizer, and pyramid, as for
+    buildDataGrp().  With a stats table, see skimStats.openTable(), the
+    statistics of each image are taken as it passes, written as data group
+    attributes and recorded in the table; for stacked images, pass the
+    dictionary of their skimStats.ImageStats by stack row, as filled by
+    skimStack.buildStack(), as stackStats.  With sources=True, the sources
+    of each image are found as it passes, see buildSourceGrp().  Progress is
+    shown on the console, and the read, write and attribute seconds of each
+    subband observed, see skimMetrics.
+    """
+    logger     = logging.getLogger()
+    root       = skyFile.root
+    attributes = attrs
+    if sources:
+	import skimSources
+    if stackRows:
+	fileNames = []
+    else:
+	fileNames = [join(resultsPath, sBand[-1]) for sBand in nameStruct]
+    images     = skimIngest.slingImages(fileNames, workers=workers, depth=depth,
+					tileBytes=tileBytes, chunks=chunks,
+					cube=cube, bandwidth=bandwidth)
+    progress   = skimMetrics.Progress(len(nameStruct))
     for sBand in nameStruct:
 	imGroup = sBand[1]
-	print "Got file "+ sBand[-1]+ ".\nGlomming ",imGroup," onto ",root,"... \n\n"
+	since   = skimMetrics.mark()
 	imroot = skyFile.createGroup(root, imGroup, title = sBand[2])
-	attributes.initHeader('Image')
-	imHeader = attributes.attributeSet('Image')
-	for key, value in imHeader:
-	    imroot.key = value
-	print "success!"
-	print "glomming data to image group...", imGroup
+	attributeSets.writeAttributes(imroot, attributeSets.groupAttributes('Image'))
+	finder = None
+	wcs    = None
 
 	# append associated sub-groups to this new Image Group
 
 	for newGroup in sBand[3:7]:
 	    # Data groups require a dataset space
 	    if "Data" in newGroup:
-		print "Datagroup found..."
-		print "Image group is",imGroup+";"," Data group is",newGroup,"\n\n"
-		buildDataGrp(skyFile,imroot,sBand)
+		imageStats = None
+		if stats is not None:
+		    imageStats = skimStats.ImageStats()
+		if stackRows:
+		    if stats is not None:
+			imageStats = (stackStats or {}).get(stackRows[sBand[0]],
+							    imageStats)
+		    buildStackDataGrp(skyFile,imroot,sBand,attributes,
+				      stackRows[sBand[0]])
+		else:
+		    fName, dataShape, tiles = images.next()
+		    if imageSum is not None:
+			tiles = imageSum.tiles(tiles)
+		    quantizer = None
+		    if quantize:
+			quantizer = skimQuantize.quantizer(fName, quantize, maxError,
+							   cube, tileBytes)
+			if quantizer.mode != quantize:
+			    logger.info("%s too wide in range for %s, stored as %s.",
+					sBand[-1], quantize, quantizer.mode)
+		    if sources:
+			finder = skimSources.SourceFinder(dataShape[-2:])
+		    buildDataGrp(skyFile,imroot,sBand,attributes,dataShape,tiles,
+				 filters=filters,chunks=chunks,quantizer=quantizer,
+				 pyramid=pyramid,stats=imageStats,finder=finder)
+		if stats is not None:
+		    attrList = imageStats.attributes()
+		    attributeSets.writeAttributes(skyFile.getNode(imroot, newGroup),
+						  attrList)
+		    skimStats.record(stats, int(sBand[0][2:]), '/'+imGroup,
+				     attrList)
 		continue
 	    elif "Coord" in newGroup:
-		print "Coorindate group found. ...\n"
-		print "glomming Coordinates groups...\n"
-		print "Groups glommed:",imroot, newGroup
-		buildCoordGrp(skyFile,imroot,sBand)
+		wcs = skimReaders.slingWcs(join(resultsPath, sBand[-1]))
+		buildCoordGrp(skyFile,imroot,sBand,attributes,wcs=wcs)
 		continue
 	    #---------------------- Source Group ------------------------#
 	    elif "Source" in newGroup:
-		print "Source group found.  building ...\n"
-		buildSourceGrp(skyFile,imroot,sBand)
+		buildSourceGrp(skyFile,imroot,sBand,attributes,finder=finder,
+			       wcs=wcs)
+		finder = None
 		continue
 	    #---------------------- ProcHist Group ----------------------#
 	    elif "ProcessHist" in newGroup:
-		print "Process History group found. building ...\n"
-		buildProcGrp(skyFile,imroot, sBand, resultsPath)
+		buildProcHist(skyFile,imroot,sBand,attributes)
+	if manifest is not None:
+	    skimManifest.record(skyFile, manifest, sBand[-1],
+				join(resultsPath, sBand[-1]), '/'+imGroup,
+				checksums)
+	skimMetrics.subbandDone(since)
+	progress.update()
+	logger.debug("Built %s from %s", imGroup, sBand[-1])
+    progress.close()
+    return skyFile
+
+
+def buildSumIm(skyFile, imageSum, nimages, filters=None, chunks='plane',
+	       pyramid=False):
+    """Write the average image of a skimIngest.ImageSum, summed from nimages
+    subband images, as the AverageImages group, replacing any there, with
+    its pyramid if pyramid=True, see skimPyramid.
+    """
+    root = skyFile.root
+    logging.getLogger().debug("Writing the summed average image ...")
+    if "/AverageImages" in skyFile:
+	skyFile.removeNode("/AverageImages", recursive=True)
+    aveImroot = skyFile.createGroup(root,"AverageImages",title = "Image Sums")
+    cArr = skimProfile.call('createCArray', skyFile.createCArray, aveImroot,
+			    "averageImage",
+			    tables.Float32Atom(),
+			    imageSum.planeShape,
+			    filters=filters or tables.Filters(),
+			    chunkshape=skimIngest.chunkShape(imageSum.planeShape, chunks),
+			    title="Incoherent Average Image"
+			    )
+    average = imageSum.average()
+    cArr[:] = average
+    skyFile.setNodeAttr(cArr, 'NIMAGES', nimages)
+    if pyramid:
+	levels = skimPyramid.Pyramid(skyFile, aveImroot, imageSum.planeShape,
+				     filters, chunks)
+	levels.add((slice(None), slice(None)), average)
+	levels.close()
     return skyFile
 
 
-def buildDataGrp(skyFile, imroot, sBand, resultsPath):
-    """ Build a full data group, with a populated dataset array."""
-    newGroup    = sBand[3:7]
+def buildDataGrp(skyFile, imroot, sBand, attrs, dataShape, tiles,
+		 filters=None, chunks='plane', quantizer=None, pyramid=False,
+		 stats=None, finder=None):
+    """ Build a full data group, with a dataset array populated from an
+    iterator of (row, dataTile), see skimIngest.slingImages().  With a
+    skimQuantize.Quantizer, the data are stored quantized by it.  With
+    pyramid=True, the data group gets the pyramid of the image, see
+    skimPyramid.  With a skimStats.ImageStats as stats, the statistics of
+    the image are taken in it, and with a skimSources.SourceFinder as
+    finder, its first plane."""
+    newGroup    = sBand[3]
     datasetHook = skyFile.createGroup(imroot, newGroup, title=newGroup)
     datasetName = "ImageDataArray_"+sBand[0]
-    attributes.initHeader('skyData')
-    attributes.dataHeader["DATASETNAME"] = datasetName
-    dataHeader = attributes.attributeSet('skyData')
-    for key, value in dataHeader:
-	datasetHook.key = value
-	#---------------------- Dataset Arrays ------------------------#
-	fName = join(resultsPath, sBand[-1])
-	atom  = tables.Float32Atom()
-	dataChunk, dataShape = fitsHandlers.slingData(fName)
-	filters   = tables.Filters()
-	print "populating dataset arrays ..."
-	cArr = skyFile.createCArray(datasetHook,
-				    datasetName,
-				    atom,
-				    dataShape,
-				    filters=filters,
-				    title=newGroup)
-	cArr[:,:] = dataChunk
+    attributeSets.writeAttributes(datasetHook,
+				  attributeSets.groupAttributes('skyData',
+								DATASETNAME=datasetName))
+    #---------------------- Dataset Arrays ------------------------#
+    atom    = tables.Float32Atom()
+    if quantizer is not None:
+	atom  = quantizer.atom()
+    cArr = skimProfile.call('createCArray', skyFile.createCArray, datasetHook,
+			    datasetName,
+			    atom,
+			    dataShape,
+			    filters=filters or tables.Filters(),
+			    chunkshape=skimIngest.chunkShape(dataShape, chunks),
+			    title=newGroup)
+    if stats is not None:
+	tiles = stats.tiles(tiles)
+    if finder is not None:
+	tiles = finder.tiles(tiles)
+    # Levels are binned from the float tiles, before quantizing.
+    if pyramid:
+	levels = skimPyramid.Pyramid(skyFile, datasetHook, dataShape[-2:],
+				     filters, chunks)
+	tiles  = levels.tiles(tiles)
+    if quantizer is not None:
+	tiles = quantizer.tiles(tiles)
+	attributeSets.writeAttributes(cArr, quantizer.attributes())
+    skimIngest.writeTiles(cArr, tiles)
+    if pyramid:
+	levels.close()
     return skyFile
 
-def buildCoordGrp(skyFile, imroot, sBand):
-    newGroup = sBand[3:7]
-    coordroot = skyFile.createGroup(imroot, newGroup, title = newGroup)
-    attributes.initHeader('Coordinates')
-    coordsHeader = attributes.attributeSet('Coordinates')
-    for key, value in coordsHeader:
-	coordroot.key = value
-	# this is the sub band identifier: +sBand[0][2:]
-	skyFile.createGroup(coordroot,"LinearCoord", \
-			    title = "Linear Coordinates, Subband "+sBand[0][2:])
-	continue
+def buildStackDataGrp(skyFile, imroot, sBand, attrs, stackRow):
+    """ Build a data group referring to row stackRow of the subband stack,
+    see skimStack.linkStack()."""
+    newGroup    = sBand[3]
+    datasetHook = skyFile.createGroup(imroot, newGroup, title=newGroup)
+    attributeSets.writeAttributes(datasetHook,
+				  attributeSets.groupAttributes('skyData',
+								DATASETNAME=skimStack.STACKNAME))
+    skimStack.linkStack(skyFile, datasetHook, stackRow)
+    return skyFile
+
+def buildCoordGrp(skyFile, imroot, sBand, attrs, wcs=None):
+    """ Build the Coordinates group and its LinearCoord group, with the world
+    coordinates wcs of the image, see skimReaders.slingWcs()."""
+    newGroup   = sBand[4]
+    coordroot  = skyFile.createGroup(imroot, newGroup, title = newGroup)
+    coordOverrides  = {}
+    linearOverrides = {}
+    if wcs:
+	coordOverrides  = attributeSets.coordOverrides(wcs)
+	linearOverrides = attributeSets.linearOverrides(wcs)
+    attributeSets.writeAttributes(coordroot,
+				  attributeSets.groupAttributes('Coordinates',
+								**coordOverrides))
+    # this is the sub band identifier: +sBand[0][2:]
+    linroot = skyFile.createGroup(coordroot,"LinearCoord", \
+				  title = "Linear Coordinates, Subband "+sBand[0][2:])
+    attributeSets.writeAttributes(linroot,
+				  attributeSets.groupAttributes('LinearCoord',
+								**linearOverrides))
     return
 
 
-def buildSourceGrp(skyFile, imroot, sBand):
+def buildSourceGrp(skyFile, imroot, sBand, attrs, finder=None, wcs=None):
+    """ Build the Source group, with the sources found by a
+    skimSources.SourceFinder, finder, if given, at the world coordinates
+    wcs of the image."""
+    newGroup   = sBand[5]
     sourceHook = skyFile.createGroup(imroot, newGroup, title = newGroup)
-    attributes.initHeader('Source')
-    sourceHeader = attributes.attributeSet('Source')
-    for key, value in sourceHeader:
-	sourceHook.key = value
+    attributeSets.writeAttributes(sourceHook, attributeSets.groupAttributes('Source'))
+    if finder is not None:
+	import skimSources
+	found = finder.find(wcs and attributeSets.linearOverrides(wcs))
+	skimSources.writeSources(skyFile, sourceHook, found)
+	logging.getLogger().debug("Found %d sources in %s", len(found), sBand[-1])
     return
 
-def buildProcHist(skyFile, imroot, sBand):
+def buildProcHist(skyFile, imroot, sBand, attrs):
+    newGroup     = sBand[6]
     prochistHook =  skyFile.createGroup(imroot, newGroup, title = newGroup)
-    attributes.initHeader('ProcessHist')
-    prochistHeader = attributes.attributeSet('ProcessHist')
-    for key, value in prochistHeader:
-	prochistHook.key = value
+    attributeSets.writeAttributes(prochistHook,
+				  attributeSets.groupAttributes('ProcessHist'))
     return
-